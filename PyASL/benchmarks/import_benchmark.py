@@ -0,0 +1,101 @@
+"""
+Import-time benchmark.
+
+Times cold imports of the package and of every pipeline runner, plus
+`python -m pyasl.pipelines.run_pipeline --help`, each in a fresh
+interpreter, and reports which heavy dependencies (TensorFlow, nipype,
+matplotlib, pandas, ...) each of them pulled in.
+
+    python benchmarks/import_benchmark.py [--repeat 5] [--budget-ms 300]
+
+Run it from the repository root with `pyasl` importable (installed, or on
+PYTHONPATH).
+
+Exits non-zero if `run_pipeline --help` is slower than the budget or if a
+non-DL target imports TensorFlow.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+HEAVY = ("tensorflow", "keras", "nipype", "matplotlib", "pandas", "skimage", "scipy", "nibabel")
+
+TARGETS = [
+    "pyasl",
+    "pyasl.pipelines.run_pipeline",
+    "pyasl.pipelines.asltbx_pipeline",
+    "pyasl.pipelines.asl_mricloud_pipeline",
+    "pyasl.pipelines.oxford_asl_pipeline",
+    "pyasl.pipelines.preclinical_pcasl_pipeline",
+    "pyasl.pipelines.preclinical_mti_pipeline",
+    "pyasl.pipelines.custom_pipeline",
+    "pyasl.pipelines.dlasl_pipeline",
+]
+
+_PROBE = (
+    "import sys, time, json\n"
+    "t = time.perf_counter()\n"
+    "import {target}\n"
+    "dt = time.perf_counter() - t\n"
+    "print(json.dumps([dt, [m for m in {heavy!r} if m in sys.modules]]))\n"
+)
+
+
+def time_import(target: str, repeat: int) -> Dict:
+    """Median in-process import time (ms) of `target` over fresh interpreters."""
+    times: List[float] = []
+    loaded: List[str] = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(target=target, heavy=HEAVY)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        dt, loaded = json.loads(out.strip().splitlines()[-1])
+        times.append(dt * 1000.0)
+    return {"target": target, "ms": statistics.median(times), "loaded": loaded}
+
+
+def time_cli_help(repeat: int) -> float:
+    """Median wall time (ms, interpreter start-up included) of `run_pipeline --help`."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "pyasl.pipelines.run_pipeline", "--help"],
+            capture_output=True, check=True,
+        )
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return statistics.median(times)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="pyasl import-time benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per target")
+    parser.add_argument("--budget-ms", type=float, default=300.0, help="budget for run_pipeline --help")
+    args = parser.parse_args(argv)
+
+    ok = True
+    print(f"{'target':48s} {'ms':>8s}  heavy modules loaded")
+    for target in TARGETS:
+        r = time_import(target, args.repeat)
+        print(f"{r['target']:48s} {r['ms']:8.1f}  {', '.join(r['loaded']) or '-'}")
+        if "tensorflow" in r["loaded"] and not target.endswith("dlasl_pipeline"):
+            print(f"  FAIL: {target} imports TensorFlow")
+            ok = False
+
+    help_ms = time_cli_help(args.repeat)
+    verdict = "ok" if help_ms <= args.budget_ms else "FAIL"
+    print(f"{'run_pipeline --help (wall)':48s} {help_ms:8.1f}  budget {args.budget_ms:.0f} ms: {verdict}")
+    ok = ok and help_ms <= args.budget_ms
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
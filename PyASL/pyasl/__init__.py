@@ -1,9 +1,20 @@
 __version__ = "0.2.1"
 
-from .utils.data_import import load_data
-from .pipelines.run_pipeline import run_pipeline
-
 __all__ = [
     "load_data",
     "run_pipeline",
-]
\ No newline at end of file
+]
+
+
+def __getattr__(name):
+    # Resolved on first use so `import pyasl` stays cheap (no pandas, nipype,
+    # TensorFlow or matplotlib until a pipeline actually needs them)
+    if name == "load_data":
+        from .utils.data_import import load_data
+
+        return load_data
+    if name == "run_pipeline":
+        from .pipelines.run_pipeline import run_pipeline
+
+        return run_pipeline
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,17 +1,17 @@
 """
 Coregister
 ----------
-SPM-based coregistration of ASL data.
+Coregistration of ASL data, with SPM (default) or the native NMI engine.
 """
 
 import os
-from nipype.interfaces import spm
+from pyasl.utils.spm_batch import run_spm, spm_batch
 import logging
 logger = logging.getLogger(__name__)
 
 class Coregister:
     """
-    Perform SPM-based coregistration of ASL data.
+    Perform coregistration of ASL data.
 
     This class wraps the SPM `Coregister` interface to align perfusion
     and optional M0 images to the corresponding anatomical reference
@@ -30,26 +30,51 @@ class Coregister:
             Metadata describing ASL datasets, including anatomical, perfusion,
             and optional M0 image names.
         config : dict
-            Coregistration options (e.g., SPM `jobtype`).
+            Coregistration options (e.g., SPM `jobtype`). `backend: native`
+            runs `pyasl.utils.rigid_registration.coregister_files` instead of
+            SPM, with the SPM defaults (`separation`, `tolerance`, `fwhm`,
+            `write_interp`) and `n_jobs` threads for reslicing.
 
         Returns
         -------
         None
             The function executes SPM Coregister and saves the aligned files.
         """
-        logger.info("ASLtbx: Coregister ASL data...")
-        for key, value in data_descrip["Images"].items():
-            key = key.replace("rawdata", "derivatives")
-            PG = os.path.join(key, "anat", f"{value['anat']}.nii")
-            for asl_file in value["asl"]:
-                PF = os.path.join(key, "perf", f"mean{asl_file}.nii")
-                PO = [PF, os.path.join(key, "perf", f"r{asl_file}.nii")]
-                if value["M0"]:
-                    PO.append(os.path.join(key, "perf", f"{value['M0']}.nii"))
-
-                coreg = spm.Coregister()
-                coreg.inputs.target = PG
-                coreg.inputs.source = PF
-                coreg.inputs.apply_to_files = PO
-                coreg.inputs.jobtype = config.get("jobtype", "estwrite")
-                coreg.run()
\ No newline at end of file
+        backend = str(config.get("backend", "spm")).lower()
+        if backend not in ("spm", "native"):
+            raise ValueError(f"Coregister backend must be 'spm' or 'native', got '{backend}'")
+        logger.info("ASLtbx: Coregister ASL data (%s)...", backend)
+        with spm_batch("Coregister"):
+            for key, value in data_descrip["Images"].items():
+                key = key.replace("rawdata", "derivatives")
+                PG = os.path.join(key, "anat", f"{value['anat']}.nii")
+                for asl_file in value["asl"]:
+                    PF = os.path.join(key, "perf", f"mean{asl_file}.nii")
+                    PO = [PF, os.path.join(key, "perf", f"r{asl_file}.nii")]
+                    if value["M0"]:
+                        PO.append(os.path.join(key, "perf", f"{value['M0']}.nii"))
+
+                    if backend == "native":
+                        from pyasl.utils.rigid_registration import (
+                            COREG_HIST_FWHM, COREG_SEPARATION, COREG_TOLERANCE, coregister_files,
+                        )
+
+                        coregister_files(
+                            PG, PF, PO,
+                            jobtype=config.get("jobtype", "estwrite"),
+                            sep=config.get("separation", COREG_SEPARATION),
+                            tol=config.get("tolerance", COREG_TOLERANCE),
+                            fwhm=config.get("fwhm", COREG_HIST_FWHM),
+                            write_interp=config.get("write_interp", 4),
+                            n_jobs=config.get("n_jobs", -1),
+                        )
+                        continue
+
+                    from nipype.interfaces import spm
+
+                    coreg = spm.Coregister()
+                    coreg.inputs.target = PG
+                    coreg.inputs.source = PF
+                    coreg.inputs.apply_to_files = PO
+                    coreg.inputs.jobtype = config.get("jobtype", "estwrite")
+                    run_spm(coreg, f"Coregister {asl_file}")
@@ -5,13 +5,49 @@ Calculate CBF maps and related perfusion metrics using ASLtbx logic.
 """
 
 
+import io
 import os
+import tempfile
+from functools import lru_cache
 import numpy as np
 import nibabel as nib
+from nibabel.arraywriters import get_slope_inter, make_array_writer
+from nibabel.volumeutils import finite_range
 from pyasl.utils.utils import load_img
+from pyasl.utils.results_store import ResultsStore, resolve_db_path, session_ids
 import logging
 logger = logging.getLogger(__name__)
 
+
+@lru_cache(maxsize=32)
+def _sinc_kernel(normloc: float, lenx: int) -> np.ndarray:
+    """Sinc weights for interpolating `lenx` samples at `normloc` (read-only)."""
+    weight = np.sinc(np.arange(lenx) - normloc)
+    swei = np.sum(weight)
+    if np.abs(swei - 1) > 0.1:
+        weight /= swei
+    weight.flags.writeable = False
+    return weight
+
+
+@lru_cache(maxsize=32)
+def _sinc_pair_weights(perfno: int, ncon: int, normloc: float, label_first: bool) -> np.ndarray:
+    """
+    Weights (ncon, perfno) mapping control frames to the sinc-interpolated
+    control of every pair, with the 6-frame window clipped at the series ends.
+    """
+    if label_first:
+        offsets = np.array([-4, -3, -2, -1, 0, 1])
+    else:
+        offsets = np.array([-3, -2, -1, 0, 1, 2])
+    kernel = _sinc_kernel(normloc, len(offsets))
+    W = np.zeros((ncon, perfno))
+    for p in range(perfno):
+        idx = np.clip(p + offsets, 0, perfno - 1)
+        np.add.at(W[:, p], idx, kernel)
+    W.flags.writeable = False
+    return W
+
 class PerfusionQuantify:
     """
     PerfusionQuantify
@@ -56,6 +92,10 @@ class PerfusionQuantify:
         SubtractionType = config.get("SubtractionType", 0)
         SubtrationOrder = config.get("SubtrationOrder", 1)
         Timeshift = config.get("Timeshift", 0.5)
+        Vectorized = config.get("Vectorized", True)
+        StreamFlag = config.get("StreamFlag", False)
+        MemoryBudgetMB = config.get("MemoryBudgetMB", 1024)
+        ResultsDB = config.get("results_db")
 
         self.asltbx_perf_subtract(
             data_descrip,
@@ -68,12 +108,19 @@ class PerfusionQuantify:
             SubtractionType,
             SubtrationOrder,
             Timeshift,
+            Vectorized,
+            StreamFlag,
+            MemoryBudgetMB,
+            ResultsDB,
         )
     
     def asltbx_sinc_interpVec(self, x: np.ndarray, u: float):
         """
         Sinc interpolation of each row in x at position u.
 
+        The weights depend only on u and the window length, so they are
+        cached and shared by all voxels and pairs.
+
         Parameters
         ----------
         x : np.ndarray
@@ -86,17 +133,8 @@ class PerfusionQuantify:
         y : np.ndarray
             Interpolated values for each row.
         """
-        dim, lenx = x.shape
-        u = np.tile(u, (dim, 1))
-        m = np.tile(np.arange(lenx), (dim, 1))
-        weight = np.sinc(m - np.tile(u, (1, lenx)))
-        swei = np.sum(weight, axis=1)
-        if np.abs(swei[0] - 1) > 0.1:
-            weight /= np.tile(swei.reshape(dim, 1), (1, lenx))
-
-        y = np.sum(x * weight, axis=1)
-
-        return y
+        weight = _sinc_kernel(float(u), x.shape[1])
+        return x @ weight
 
     def asltbx_perf_subtract(
         self,
@@ -110,6 +148,10 @@ class PerfusionQuantify:
         SubtractionType,
         SubtrationOrder,
         Timeshift,
+        Vectorized=True,
+        StreamFlag=False,
+        MemoryBudgetMB=1024,
+        ResultsDB=None,
     ):
         """
         Subtracts label and control images to compute perfusion-weighted images.
@@ -120,6 +162,15 @@ class PerfusionQuantify:
             Dataset description.
         QuantFlag, M0wmcsf, MaskFlag, MeanFlag, BOLDFlag, PerfFlag, SubtractionType, SubtrationOrder, Timeshift : various
             Processing and quantification options.
+        Vectorized : bool
+            Process all label/control pairs at once as (pairs x voxels) arrays
+            instead of looping over pairs. Both paths give identical results.
+        StreamFlag : bool
+            Read the series in z-slabs and write the 4D outputs slab by slab,
+            keeping the working set within `MemoryBudgetMB` megabytes.
+        ResultsDB : str, optional
+            SQLite results database to append the global signal of every
+            series to (config key `results_db`; see pyasl.utils.results_store).
 
         Returns
         -------
@@ -174,6 +225,24 @@ class PerfusionQuantify:
             else:
                 useM0 = True
 
+        quant = {
+            "QuantFlag": QuantFlag,
+            "M0b": M0b if QuantFlag != 0 else None,
+            "useM0": useM0,
+            "MaskFlag": MaskFlag,
+            "BOLDFlag": BOLDFlag,
+            "PerfFlag": PerfFlag,
+            "SubtractionType": SubtractionType,
+            "SubtrationOrder": SubtrationOrder,
+            "Timeshift": Timeshift,
+            "Delaytime": Delaytime,
+            "BloodT1": BloodT1,
+            "r1a": r1a,
+            "labeff": labeff,
+            "qTI": qTI,
+            "lmbda": lmbda,
+        }
+
         for key, value in data_descrip["Images"].items():
             key = key.replace("rawdata", "derivatives")
             if QuantFlag == 0:
@@ -186,12 +255,16 @@ class PerfusionQuantify:
                         M0 = m0all
                 elif data_descrip["M0Type"] == "Included":
                     P = os.path.join(key, "perf", f"srr{value['asl'][0]}.nii")
-                    V, data = load_img(P)
+                    if StreamFlag:
+                        V = nib.load(P)
+                        data = V.dataobj
+                    else:
+                        V, data = load_img(P)
                     num_m0 = 0
                     M0 = np.zeros(data.shape[:3])
                     for i, volume_type in enumerate(data_descrip["ASLContext"]):
                         if volume_type == "m0scan":
-                            M0 += data[:, :, :, i]
+                            M0 += np.nan_to_num(np.asarray(data[:, :, :, i], dtype=np.float64))
                             num_m0 += 1
                     M0 /= num_m0
 
@@ -199,9 +272,13 @@ class PerfusionQuantify:
                 Pmask = os.path.join(key, "perf", f"{asl_file}_mask_perf_cbf.nii")
                 Vmask, maskdat = load_img(Pmask)
                 Pall = os.path.join(key, "perf", f"srr{asl_file}.nii")
-                Vall, alldat = load_img(Pall)
+                if StreamFlag:
+                    # Read slab by slab from the image proxy later on
+                    Vall = nib.load(Pall)
+                else:
+                    Vall, alldat = load_img(Pall)
                 if QuantFlag == 0 and useM0:
-                    if not np.array_equal(M0.shape, alldat.shape[:3]):
+                    if not np.array_equal(M0.shape, Vall.shape[:3]):
                         raise ValueError(
                             "M0 image size is different from the perfusion images"
                         )
@@ -222,173 +299,204 @@ class PerfusionQuantify:
                         labidx.append(i)
 
                 perfno = len(labidx)
-                BOLDimg4D = np.zeros(
-                    (alldat.shape[0], alldat.shape[1], alldat.shape[2], perfno)
-                )
-                CBFimg4D = np.zeros_like(BOLDimg4D)
-                perfimg4D = np.zeros_like(BOLDimg4D)
-                gs = np.zeros((perfno, 4))
-                for p in range(perfno):
-                    Vlabimg = alldat[:, :, :, labidx[p]]
-
-                    if SubtractionType == 0:
-                        Vconimg = alldat[:, :, :, conidx[p]]
-                    elif SubtractionType == 1:
-                        Vconimg = alldat[:, :, :, conidx[p]]
-                        if data_descrip["LabelControl"]:
-                            if p > 0:
-                                Vconimg = (Vconimg + alldat[:, :, :, conidx[p - 1]]) / 2
-                        else:
-                            if p < perfno - 1:
-                                Vconimg = (Vconimg + alldat[:, :, :, conidx[p + 1]]) / 2
-                    else:
-                        if data_descrip["LabelControl"]:
-                            idx = p + np.array([-4, -3, -2, -1, 0, 1])
-                            normloc = 3 - Timeshift
-                        else:
-                            idx = p + np.array([-3, -2, -1, 0, 1, 2])
-                            normloc = 2 + Timeshift
-                        idx[idx < 0] = 0
-                        idx[idx > perfno - 1] = perfno - 1
-                        idx_arr = np.array(idx).astype(int)
-                        conidx_arr = np.array(conidx).astype(int)
-                        nimg = alldat[:, :, :, conidx_arr[idx_arr]]
-                        nimg = np.reshape(nimg, (-1, nimg.shape[3]))
-                        tmpimg = self.asltbx_sinc_interpVec(nimg[brain_ind, :], normloc)
-                        Vconimg = np.zeros(nimg.shape[0])
-                        Vconimg[brain_ind] = tmpimg
-                        Vconimg = np.reshape(Vconimg, alldat.shape[:3])
-
-                    perfimg = Vconimg - Vlabimg
-                    if SubtrationOrder == 0:
-                        perfimg = -1.0 * perfimg
-
-                    if MaskFlag:
-                        perfimg = perfimg * maskdat
-
-                    slicetimearray = np.ones(
-                        (alldat.shape[0] * alldat.shape[1], alldat.shape[2])
+                means = None
+                if StreamFlag:
+                    gs, means = self._perf_subtract_stream(
+                        Vall,
+                        maskdat,
+                        MaskFlag,
+                        conidx,
+                        labidx,
+                        M0 if (QuantFlag == 0 and useM0) else None,
+                        data_descrip,
+                        quant,
+                        MemoryBudgetMB,
+                        os.path.join(key, "perf"),
+                        asl_file,
                     )
-                    Slicetime = 0
-                    if "SliceDuration" in data_descrip:
-                        Slicetime = data_descrip["SliceDuration"] * 1000
-                    for sss in range(alldat.shape[2]):
-                        slicetimearray[:, sss] = slicetimearray[:, sss] * sss * Slicetime
-                    slicetimearray = slicetimearray.ravel()
-                    slicetimearray = slicetimearray[vxidx]
-
-                    BOLDimg = (Vconimg + Vlabimg) / 2
-                    meanbold = BOLDimg
-                    BOLDimg4D[:, :, :, p] = BOLDimg
-
-                    cbfimg = np.zeros(perfimg.shape)
-                    if data_descrip["ArterialSpinLabelingType"] == "PASL":
-                        TI = Delaytime + slicetimearray
-                        tperf = perfimg.flat[vxidx]
-                        tmpsig = meanbold.flat[vxidx]
-                        tcbf = np.zeros_like(vxidx)
-                        effidx = np.where(abs(tmpsig) > 1e-3 * np.mean(tmpsig))
-                        effidx = np.ravel_multi_index(effidx, tmpsig.shape)
-                        efftperf = tperf[effidx]
-                        TI = TI.flat[effidx]
-                        if QuantFlag:
-                            tcbf[effidx] = (
-                                efftperf
-                                * 6000
-                                * 1000
-                                / (
-                                    2
-                                    * M0b
-                                    * np.exp(-TI / BloodT1)
-                                    * data_descrip["BolusCutOffDelayTime"]
+                elif Vectorized:
+                    BOLDimg4D, CBFimg4D, perfimg4D, cbf_m, perf_m = self._perf_subtract_pairs(
+                        alldat,
+                        maskdat,
+                        vxidx,
+                        conidx,
+                        labidx,
+                        M0 if (QuantFlag == 0 and useM0) else None,
+                        data_descrip,
+                        quant,
+                    )
+                    sums, counts = self._global_sums(cbf_m, perf_m)
+                    gs = sums / counts
+                else:
+                    # Outputs whose flags are off are not allocated
+                    shape4 = alldat.shape[:3] + (perfno,)
+                    CBFimg4D = np.zeros(shape4)
+                    BOLDimg4D = np.zeros(shape4) if BOLDFlag else None
+                    perfimg4D = np.zeros(shape4) if PerfFlag else None
+                    gs = np.zeros((perfno, 4))
+                    for p in range(perfno):
+                        Vlabimg = alldat[:, :, :, labidx[p]]
+
+                        if SubtractionType == 0:
+                            Vconimg = alldat[:, :, :, conidx[p]]
+                        elif SubtractionType == 1:
+                            Vconimg = alldat[:, :, :, conidx[p]]
+                            if data_descrip["LabelControl"]:
+                                if p > 0:
+                                    Vconimg = (Vconimg + alldat[:, :, :, conidx[p - 1]]) / 2
+                            else:
+                                if p < perfno - 1:
+                                    Vconimg = (Vconimg + alldat[:, :, :, conidx[p + 1]]) / 2
+                        else:
+                            if data_descrip["LabelControl"]:
+                                idx = p + np.array([-4, -3, -2, -1, 0, 1])
+                                normloc = 3 - Timeshift
+                            else:
+                                idx = p + np.array([-3, -2, -1, 0, 1, 2])
+                                normloc = 2 + Timeshift
+                            idx[idx < 0] = 0
+                            idx[idx > perfno - 1] = perfno - 1
+                            idx_arr = np.array(idx).astype(int)
+                            conidx_arr = np.array(conidx).astype(int)
+                            nimg = alldat[:, :, :, conidx_arr[idx_arr]]
+                            nimg = np.reshape(nimg, (-1, nimg.shape[3]))
+                            tmpimg = self.asltbx_sinc_interpVec(nimg[brain_ind, :], normloc)
+                            Vconimg = np.zeros(nimg.shape[0])
+                            Vconimg[brain_ind] = tmpimg
+                            Vconimg = np.reshape(Vconimg, alldat.shape[:3])
+
+                        perfimg = Vconimg - Vlabimg
+                        if SubtrationOrder == 0:
+                            perfimg = -1.0 * perfimg
+
+                        if MaskFlag:
+                            perfimg = perfimg * maskdat
+
+                        slicetimearray = np.ones(
+                            (alldat.shape[0] * alldat.shape[1], alldat.shape[2])
+                        )
+                        Slicetime = 0
+                        if "SliceDuration" in data_descrip:
+                            Slicetime = data_descrip["SliceDuration"] * 1000
+                        for sss in range(alldat.shape[2]):
+                            slicetimearray[:, sss] = slicetimearray[:, sss] * sss * Slicetime
+                        slicetimearray = slicetimearray.ravel()
+                        slicetimearray = slicetimearray[vxidx]
+
+                        BOLDimg = (Vconimg + Vlabimg) / 2
+                        meanbold = BOLDimg
+                        if BOLDFlag:
+                            BOLDimg4D[:, :, :, p] = BOLDimg
+
+                        cbfimg = np.zeros(perfimg.shape)
+                        if data_descrip["ArterialSpinLabelingType"] == "PASL":
+                            TI = Delaytime + slicetimearray
+                            tperf = perfimg.flat[vxidx]
+                            tmpsig = meanbold.flat[vxidx]
+                            tcbf = np.zeros_like(vxidx)
+                            effidx = np.where(abs(tmpsig) > 1e-3 * np.mean(tmpsig))
+                            effidx = np.ravel_multi_index(effidx, tmpsig.shape)
+                            efftperf = tperf[effidx]
+                            TI = TI.flat[effidx]
+                            if QuantFlag:
+                                tcbf[effidx] = (
+                                    efftperf
+                                    * 6000
                                     * 1000
-                                    * labeff
-                                    * qTI
+                                    / (
+                                        2
+                                        * M0b
+                                        * np.exp(-TI / BloodT1)
+                                        * data_descrip["BolusCutOffDelayTime"]
+                                        * 1000
+                                        * labeff
+                                        * qTI
+                                    )
                                 )
-                            )
-                        else:
-                            if useM0:
-                                eM0 = M0.flat[vxidx]
                             else:
-                                eM0 = Vconimg.flat[vxidx]
-                            effM0 = eM0[effidx]
-                            tcbf[effidx] = (
-                                lmbda
-                                * efftperf
-                                * 6000
+                                if useM0:
+                                    eM0 = M0.flat[vxidx]
+                                else:
+                                    eM0 = Vconimg.flat[vxidx]
+                                effM0 = eM0[effidx]
+                                tcbf[effidx] = (
+                                    lmbda
+                                    * efftperf
+                                    * 6000
+                                    * 1000
+                                    / (
+                                        2
+                                        * effM0
+                                        * np.exp(-TI / BloodT1)
+                                        * data_descrip["BolusCutOffDelayTime"]
+                                        * 1000
+                                        * labeff
+                                        * qTI
+                                    )
+                                )
+                            multi_idx = np.unravel_index(vxidx, cbfimg.shape)
+                            cbfimg[multi_idx] = tcbf
+
+                        elif (
+                            data_descrip["ArterialSpinLabelingType"] == "CASL"
+                            or data_descrip["ArterialSpinLabelingType"] == "PCASL"
+                        ):
+                            omega = Delaytime + slicetimearray
+                            locMask = Vconimg.flat[vxidx]
+                            tperf = perfimg.flat[vxidx]
+                            tcbf = np.zeros_like(vxidx)
+                            effidx = np.where(abs(locMask) > 1e-3 * np.mean(locMask))
+                            effidx = np.ravel_multi_index(effidx, locMask.shape)
+                            omega = omega.flat[effidx]
+                            efftperf = tperf[effidx]
+                            if QuantFlag:
+                                efftcbf = efftperf / M0b
+                            else:
+                                if useM0:
+                                    eM0 = M0.flat[vxidx]
+                                else:
+                                    eM0 = Vconimg.flat[vxidx]
+                                effM0 = eM0[effidx]
+                                efftcbf = efftperf / effM0
+                            efftcbf = (
+                                6000
                                 * 1000
+                                * lmbda
+                                * efftcbf
+                                * r1a
                                 / (
                                     2
-                                    * effM0
-                                    * np.exp(-TI / BloodT1)
-                                    * data_descrip["BolusCutOffDelayTime"]
-                                    * 1000
                                     * labeff
-                                    * qTI
-                                )
-                            )
-                        multi_idx = np.unravel_index(vxidx, cbfimg.shape)
-                        cbfimg[multi_idx] = tcbf
-
-                    elif (
-                        data_descrip["ArterialSpinLabelingType"] == "CASL"
-                        or data_descrip["ArterialSpinLabelingType"] == "PCASL"
-                    ):
-                        omega = Delaytime + slicetimearray
-                        locMask = Vconimg.flat[vxidx]
-                        tperf = perfimg.flat[vxidx]
-                        tcbf = np.zeros_like(vxidx)
-                        effidx = np.where(abs(locMask) > 1e-3 * np.mean(locMask))
-                        effidx = np.ravel_multi_index(effidx, locMask.shape)
-                        omega = omega.flat[effidx]
-                        efftperf = tperf[effidx]
-                        if QuantFlag:
-                            efftcbf = efftperf / M0b
-                        else:
-                            if useM0:
-                                eM0 = M0.flat[vxidx]
-                            else:
-                                eM0 = Vconimg.flat[vxidx]
-                            effM0 = eM0[effidx]
-                            efftcbf = efftperf / effM0
-                        efftcbf = (
-                            6000
-                            * 1000
-                            * lmbda
-                            * efftcbf
-                            * r1a
-                            / (
-                                2
-                                * labeff
-                                * (
-                                    np.exp(-omega * r1a)
-                                    - np.exp(
-                                        -1
-                                        * (data_descrip["LabelingDuration"] * 1000 + omega)
-                                        * r1a
+                                    * (
+                                        np.exp(-omega * r1a)
+                                        - np.exp(
+                                            -1
+                                            * (data_descrip["LabelingDuration"] * 1000 + omega)
+                                            * r1a
+                                        )
                                     )
                                 )
                             )
-                        )
-                        tcbf[effidx] = efftcbf
-                        multi_idx = np.unravel_index(vxidx, cbfimg.shape)
-                        cbfimg[multi_idx] = tcbf
-
-                    CBFimg4D[:, :, :, p] = cbfimg
-                    perfimg4D[:, :, :, p] = perfimg
-
-                    nanmask = np.isnan(cbfimg)
-                    outliermask = (cbfimg < -40) | (cbfimg > 150)
-                    maskdat = maskdat.astype(bool)
-                    sigmask = maskdat & (~outliermask) & (~nanmask)
-                    wholemask = maskdat & (~nanmask)
-                    outliercleaned_maskind = np.where(sigmask)
-                    whole_ind = np.where(wholemask)
-
-                    gs[p, 1] = np.mean(cbfimg[outliercleaned_maskind])
-                    gs[p, 3] = np.mean(cbfimg[whole_ind])
-                    gs[p, 0] = np.mean(perfimg[outliercleaned_maskind])
-                    gs[p, 2] = np.mean(perfimg[whole_ind])
+                            tcbf[effidx] = efftcbf
+                            multi_idx = np.unravel_index(vxidx, cbfimg.shape)
+                            cbfimg[multi_idx] = tcbf
+
+                        CBFimg4D[:, :, :, p] = cbfimg
+                        if PerfFlag:
+                            perfimg4D[:, :, :, p] = perfimg
+
+                        nanmask = np.isnan(cbfimg)
+                        outliermask = (cbfimg < -40) | (cbfimg > 150)
+                        maskdat = maskdat.astype(bool)
+                        sigmask = maskdat & (~outliermask) & (~nanmask)
+                        wholemask = maskdat & (~nanmask)
+                        outliercleaned_maskind = np.where(sigmask)
+                        whole_ind = np.where(wholemask)
+
+                        gs[p, 1] = np.mean(cbfimg[outliercleaned_maskind])
+                        gs[p, 3] = np.mean(cbfimg[whole_ind])
+                        gs[p, 0] = np.mean(perfimg[outliercleaned_maskind])
+                        gs[p, 2] = np.mean(perfimg[whole_ind])
 
                 np.savetxt(
                     os.path.join(key, "perf", f"{asl_file}_globalsg.txt"),
@@ -396,45 +504,465 @@ class PerfusionQuantify:
                     fmt="%0.5f",
                     header="Perf_outliercleaned,CBF_outliercleaned,Perf_whole,CBF_whole",
                 )
+                if ResultsDB:
+                    subject, session = session_ids(key)
+                    with ResultsStore(resolve_db_path(ResultsDB, key)) as store:
+                        store.set_global_signal(subject, session, asl_file, gs)
+
+                if not StreamFlag:
+                    header = Vall.header.copy()
+                    affine = Vall.affine.copy()
+                    header.set_data_shape(CBFimg4D.shape)
+                    VCBFimg = nib.Nifti1Image(CBFimg4D, affine, header)
+                    VCBFimg.header["descrip"] = b"asltbx_pipeline"
+                    VCBFimg.to_filename(os.path.join(key, "perf", f"{asl_file}_CBF.nii"))
 
-                header = Vall.header.copy()
-                affine = Vall.affine.copy()
-                header.set_data_shape(CBFimg4D.shape)
-                VCBFimg = nib.Nifti1Image(CBFimg4D, affine, header)
-                VCBFimg.header["descrip"] = b"asltbx_pipeline"
-                VCBFimg.to_filename(os.path.join(key, "perf", f"{asl_file}_CBF.nii"))
+                    if BOLDFlag:
+                        VBOLDimg = nib.Nifti1Image(BOLDimg4D, affine, header)
+                        VBOLDimg.header["descrip"] = b"asltbx_pipeline"
+                        VBOLDimg.to_filename(os.path.join(key, "perf", f"{asl_file}_BOLD.nii"))
 
-                if BOLDFlag:
-                    VBOLDimg = nib.Nifti1Image(BOLDimg4D, affine, header)
-                    VBOLDimg.header["descrip"] = b"asltbx_pipeline"
-                    VBOLDimg.to_filename(os.path.join(key, "perf", f"{asl_file}_BOLD.nii"))
+                    if PerfFlag:
+                        Vperfimg = nib.Nifti1Image(perfimg4D, affine, header)
+                        Vperfimg.header["descrip"] = b"asltbx_pipeline"
+                        Vperfimg.to_filename(os.path.join(key, "perf", f"{asl_file}_PERF.nii"))
 
-                if PerfFlag:
-                    Vperfimg = nib.Nifti1Image(perfimg4D, affine, header)
-                    Vperfimg.header["descrip"] = b"asltbx_pipeline"
-                    Vperfimg.to_filename(os.path.join(key, "perf", f"{asl_file}_PERF.nii"))
+                    if MeanFlag:
+                        means = {"CBF": np.mean(CBFimg4D, axis=3)}
+                        if PerfFlag:
+                            means["PERF"] = np.mean(perfimg4D, axis=3)
+                        if BOLDFlag:
+                            means["BOLD"] = np.mean(BOLDimg4D, axis=3)
 
                 if MeanFlag:
                     header = Vmask.header.copy()
                     affine = Vmask.affine.copy()
                     header.set_data_dtype(np.float32)
-                    mCBFimg = np.mean(CBFimg4D, axis=3)
-                    VmCBFimg = nib.Nifti1Image(mCBFimg, affine, header)
+                    VmCBFimg = nib.Nifti1Image(means["CBF"], affine, header)
                     VmCBFimg.header["descrip"] = b"asltbx_pipeline"
                     VmCBFimg.to_filename(os.path.join(key, "perf", f"{asl_file}_mCBF.nii"))
                     if PerfFlag:
-                        mPERFimg = np.mean(perfimg4D, axis=3)
-                        VmPERFimg = nib.Nifti1Image(mPERFimg, affine, header)
+                        VmPERFimg = nib.Nifti1Image(means["PERF"], affine, header)
                         VmPERFimg.header["descrip"] = b"asltbx_pipeline"
                         VmPERFimg.to_filename(
                             os.path.join(key, "perf", f"{asl_file}_mPERF.nii")
                         )
                     if BOLDFlag:
-                        mBOLDimg = np.mean(BOLDimg4D, axis=3)
-                        VmBOLDimg = nib.Nifti1Image(mBOLDimg, affine, header)
+                        VmBOLDimg = nib.Nifti1Image(means["BOLD"], affine, header)
                         VmBOLDimg.header["descrip"] = b"asltbx_pipeline"
                         VmBOLDimg.to_filename(
                             os.path.join(key, "perf", f"{asl_file}_mBOLD.nii")
                         )
-    
-    
\ No newline at end of file
+
+    def _pair_controls(self, con, brain, perfno, data_descrip, SubtractionType, Timeshift):
+        """
+        Control signal matched to every label frame.
+
+        Parameters
+        ----------
+        con : np.ndarray
+            Control frames, shape (ncontrol, nvox).
+        brain : np.ndarray
+            Boolean (nvox,) brain mask; sinc subtraction is evaluated only here.
+        perfno : int
+            Number of label/control pairs.
+
+        Returns
+        -------
+        Vcon : np.ndarray
+            Matched control images, shape (perfno, nvox).
+        """
+        if SubtractionType == 0:
+            return con[:perfno]
+        if SubtractionType == 1:
+            Vcon = con[:perfno].copy()
+            if data_descrip["LabelControl"]:
+                Vcon[1:] = (Vcon[1:] + con[: perfno - 1]) / 2
+            else:
+                Vcon[: perfno - 1] = (Vcon[: perfno - 1] + con[1:perfno]) / 2
+            return Vcon
+
+        # One matrix product over all pairs with cached sinc weights
+        if data_descrip["LabelControl"]:
+            normloc = 3 - Timeshift
+        else:
+            normloc = 2 + Timeshift
+        W = _sinc_pair_weights(
+            perfno, con.shape[0], float(normloc), bool(data_descrip["LabelControl"])
+        )
+        Vcon = np.zeros((perfno, con.shape[1]))
+        Vcon[:, brain] = W.T @ con[:, brain]
+        return Vcon
+
+    def _pair_cbf(self, tperf, tcon, tbold, slicetime, eM0, thr, data_descrip, quant):
+        """
+        CBF for all pairs at the quantified voxels.
+
+        `tperf`, `tcon` and `tbold` are (perfno, nvx) arrays, `slicetime` is the
+        (nvx,) acquisition delay of each voxel's slice and `thr` the per-pair
+        mean signal used to drop near-zero voxels. The result reproduces the
+        per-pair loop, including the truncation to integers of its `tcbf`
+        buffer.
+        """
+        Delaytime = quant["Delaytime"]
+        BloodT1 = quant["BloodT1"]
+        labeff = quant["labeff"]
+        qTI = quant["qTI"]
+        lmbda = quant["lmbda"]
+        r1a = quant["r1a"]
+        shape = tperf.shape
+
+        tcbf = np.zeros(shape, dtype=np.intp)
+        if data_descrip["ArterialSpinLabelingType"] == "PASL":
+            effidx = abs(tbold) > 1e-3 * thr[:, None]
+            TI = Delaytime + slicetime
+            decay = np.exp(-TI / BloodT1)
+            efftperf = tperf[effidx]
+            if quant["QuantFlag"]:
+                den = (
+                    2
+                    * quant["M0b"]
+                    * decay
+                    * data_descrip["BolusCutOffDelayTime"]
+                    * 1000
+                    * labeff
+                    * qTI
+                )
+                tcbf[effidx] = (
+                    efftperf * 6000 * 1000 / np.broadcast_to(den, shape)[effidx]
+                )
+            else:
+                effM0 = np.broadcast_to(eM0, shape)[effidx]
+                tcbf[effidx] = (
+                    lmbda
+                    * efftperf
+                    * 6000
+                    * 1000
+                    / (
+                        2
+                        * effM0
+                        * np.broadcast_to(decay, shape)[effidx]
+                        * data_descrip["BolusCutOffDelayTime"]
+                        * 1000
+                        * labeff
+                        * qTI
+                    )
+                )
+
+        elif data_descrip["ArterialSpinLabelingType"] in ("CASL", "PCASL"):
+            effidx = abs(tcon) > 1e-3 * thr[:, None]
+            omega = Delaytime + slicetime
+            den = 2 * labeff * (
+                np.exp(-omega * r1a)
+                - np.exp(-1 * (data_descrip["LabelingDuration"] * 1000 + omega) * r1a)
+            )
+            efftperf = tperf[effidx]
+            if quant["QuantFlag"]:
+                efftcbf = efftperf / quant["M0b"]
+            else:
+                efftcbf = efftperf / np.broadcast_to(eM0, shape)[effidx]
+            tcbf[effidx] = (
+                6000 * 1000 * lmbda * efftcbf * r1a / np.broadcast_to(den, shape)[effidx]
+            )
+
+        return tcbf.astype(float)
+
+    def _pair_images(self, alldat, maskdat, rows, conidx, labidx, data_descrip, quant):
+        """
+        Matched control, perfusion and BOLD signals, each (perfno, len(rows)),
+        for the flat voxel indices `rows` of a (X, Y, Z, T) block.
+        """
+        perfno = len(labidx)
+        mask_flat = maskdat.ravel()
+        mask_bool = mask_flat.astype(bool)
+
+        def frames(idx):
+            return np.stack([np.take(alldat[:, :, :, i], rows) for i in idx])
+
+        Vlab = frames(labidx)
+        Vcon = self._pair_controls(
+            frames(conidx),
+            mask_bool[rows],
+            perfno,
+            data_descrip,
+            quant["SubtractionType"],
+            quant["Timeshift"],
+        )
+
+        perf = Vcon - Vlab
+        if quant["SubtrationOrder"] == 0:
+            perf = -1.0 * perf
+        if quant["MaskFlag"]:
+            # The loop multiplies the first pair by the stored mask values and
+            # the remaining pairs by the binarized mask.
+            perf[:1] *= mask_flat[rows]
+            perf[1:] *= mask_bool[rows]
+        bold = (Vcon + Vlab) / 2
+        return Vcon, perf, bold
+
+    def _perf_subtract_pairs(
+        self, alldat, maskdat, vxidx, conidx, labidx, M0, data_descrip, quant, thr=None, z0=0
+    ):
+        """
+        Vectorized counterpart of the per-pair loop in `asltbx_perf_subtract`.
+
+        Perfusion, BOLD and CBF are computed for all pairs at once as
+        (pairs x voxels) arrays. Slice timing and the kinetic-model
+        denominators are evaluated once per block. The block may be a slab of
+        slices starting at slice `z0`, in which case `thr` must hold the
+        per-pair mean signals of the whole series.
+
+        Returns
+        -------
+        BOLDimg4D, CBFimg4D, perfimg4D : np.ndarray or None
+            4D outputs; BOLD and perfusion are None when their flag is off.
+        cbf_m, perf_m : np.ndarray
+            CBF and perfusion at the brain-mask voxels, shape (perfno, nmask).
+        """
+        shape3 = alldat.shape[:3]
+        nvox = int(np.prod(shape3))
+        perfno = len(labidx)
+        mask_ind = np.flatnonzero(maskdat)
+        # Voxels to process: the whole block only if it is written out
+        if quant["BOLDFlag"] or quant["PerfFlag"] or not quant["MaskFlag"]:
+            rows = np.arange(nvox)
+        else:
+            rows = vxidx
+        vpos = np.searchsorted(rows, vxidx)
+
+        Vcon, perf, bold = self._pair_images(
+            alldat, maskdat, rows, conidx, labidx, data_descrip, quant
+        )
+
+        Slicetime = 0
+        if "SliceDuration" in data_descrip:
+            Slicetime = data_descrip["SliceDuration"] * 1000
+        slicetime = (vxidx % shape3[2] + z0).astype(float) * Slicetime
+
+        tperf = perf[:, vpos]
+        tcon = Vcon[:, vpos]
+        tbold = bold[:, vpos]
+        if thr is None:
+            tsig = tbold if data_descrip["ArterialSpinLabelingType"] == "PASL" else tcon
+            thr = np.array([np.mean(tsig[p]) for p in range(perfno)])
+        if quant["QuantFlag"]:
+            eM0 = None
+        elif quant["useM0"]:
+            eM0 = M0.flat[vxidx]
+        else:
+            eM0 = tcon
+        tcbf = self._pair_cbf(tperf, tcon, tbold, slicetime, eM0, thr, data_descrip, quant)
+
+        # Brain-mask voxels for the global signals
+        mpos = np.minimum(np.searchsorted(vxidx, mask_ind), max(len(vxidx) - 1, 0))
+        in_vx = vxidx[mpos] == mask_ind if len(vxidx) else np.zeros(len(mask_ind), bool)
+        cbf_m = np.zeros((perfno, len(mask_ind)))
+        cbf_m[:, in_vx] = tcbf[:, mpos[in_vx]]
+        perf_m = perf[:, np.searchsorted(rows, mask_ind)]
+
+        CBFimg4D = np.zeros(shape3 + (perfno,))
+        CBFimg4D.reshape(nvox, perfno)[vxidx] = tcbf.T
+        BOLDimg4D = None
+        perfimg4D = None
+        if quant["BOLDFlag"]:
+            BOLDimg4D = np.ascontiguousarray(bold.T).reshape(shape3 + (perfno,))
+        if quant["PerfFlag"]:
+            perfimg4D = np.ascontiguousarray(perf.T).reshape(shape3 + (perfno,))
+        return BOLDimg4D, CBFimg4D, perfimg4D, cbf_m, perf_m
+
+    def _global_sums(self, cbf_m, perf_m):
+        """
+        Per-pair sums and voxel counts behind the global signals
+        (Perf_outliercleaned, CBF_outliercleaned, Perf_whole, CBF_whole).
+        """
+        perfno = cbf_m.shape[0]
+        sums = np.zeros((perfno, 4))
+        counts = np.zeros((perfno, 4), dtype=int)
+        for p in range(perfno):
+            nanmask = np.isnan(cbf_m[p])
+            outliermask = (cbf_m[p] < -40) | (cbf_m[p] > 150)
+            sigmask = (~outliermask) & (~nanmask)
+            sums[p, 1] = np.sum(cbf_m[p][sigmask])
+            sums[p, 3] = np.sum(cbf_m[p][~nanmask])
+            sums[p, 0] = np.sum(perf_m[p][sigmask])
+            sums[p, 2] = np.sum(perf_m[p][~nanmask])
+            counts[p] = [np.sum(sigmask), np.sum(sigmask), np.sum(~nanmask), np.sum(~nanmask)]
+        return sums, counts
+
+    def _perf_subtract_stream(
+        self, Vall, maskdat, MaskFlag, conidx, labidx, M0, data_descrip, quant,
+        MemoryBudgetMB, outdir, asl_file,
+    ):
+        """
+        Slab-by-slab version of `_perf_subtract_pairs` for long 4D series.
+
+        The series is read in z-slabs from the nibabel `dataobj` proxy, so
+        only one slab is held in memory. Its size follows `MemoryBudgetMB`.
+        A first pass accumulates the per-pair mean signals used to threshold
+        near-zero voxels. A second pass quantifies each slab and writes the
+        CBF (and BOLD/perfusion, when enabled) 4D images to disk as it goes.
+
+        Returns
+        -------
+        gs : np.ndarray
+            Global signals per pair, shape (perfno, 4).
+        means : dict
+            Mean-over-pairs maps ("CBF", and "BOLD"/"PERF" when enabled).
+        """
+        X, Y, Z = Vall.shape[:3]
+        nframes = Vall.shape[3]
+        perfno = len(labidx)
+        # float64 working set per slice: input frames plus ~8 pair-sized arrays
+        slice_bytes = X * Y * 8 * (nframes + 8 * perfno)
+        nz = int(np.clip(MemoryBudgetMB * 2**20 // slice_bytes, 1, Z))
+        slabs = [(z0, min(z0 + nz, Z)) for z0 in range(0, Z, nz)]
+        logger.info(
+            "Streaming %s in %d slab(s) of up to %d slices (budget %s MB).",
+            asl_file, len(slabs), nz, MemoryBudgetMB,
+        )
+
+        def read_slab(z0, z1):
+            return np.nan_to_num(np.asarray(Vall.dataobj[:, :, z0:z1, :], dtype=np.float64))
+
+        def slab_vxidx(mask):
+            if MaskFlag:
+                return np.flatnonzero(mask)
+            return np.ravel_multi_index((np.where(mask > -1)), mask.shape)
+
+        # Pass 1: series-wide per-pair mean of the thresholding signal
+        sig_sum = np.zeros(perfno)
+        sig_cnt = 0
+        for z0, z1 in slabs:
+            mask = maskdat[:, :, z0:z1]
+            vxidx = slab_vxidx(mask)
+            Vcon, _, bold = self._pair_images(
+                read_slab(z0, z1), mask, vxidx, conidx, labidx, data_descrip, quant
+            )
+            tsig = bold if data_descrip["ArterialSpinLabelingType"] == "PASL" else Vcon
+            sig_sum += np.sum(tsig, axis=1)
+            sig_cnt += len(vxidx)
+        thr = sig_sum / sig_cnt
+
+        # Pass 2: quantify and write slab by slab
+        header = Vall.header.copy()
+        header.set_data_shape((X, Y, Z, perfno))
+        outputs = {"CBF": _NiftiSlabWriter(os.path.join(outdir, f"{asl_file}_CBF.nii"), header)}
+        if quant["BOLDFlag"]:
+            outputs["BOLD"] = _NiftiSlabWriter(os.path.join(outdir, f"{asl_file}_BOLD.nii"), header)
+        if quant["PerfFlag"]:
+            outputs["PERF"] = _NiftiSlabWriter(os.path.join(outdir, f"{asl_file}_PERF.nii"), header)
+        means = {name: np.zeros((X, Y, Z)) for name in outputs}
+        sums = np.zeros((perfno, 4))
+        counts = np.zeros((perfno, 4), dtype=int)
+        try:
+            for z0, z1 in slabs:
+                mask = maskdat[:, :, z0:z1]
+                BOLDimg4D, CBFimg4D, perfimg4D, cbf_m, perf_m = self._perf_subtract_pairs(
+                    read_slab(z0, z1),
+                    mask,
+                    slab_vxidx(mask),
+                    conidx,
+                    labidx,
+                    None if M0 is None else M0[:, :, z0:z1],
+                    data_descrip,
+                    quant,
+                    thr=thr,
+                    z0=z0,
+                )
+                slab_sums, slab_counts = self._global_sums(cbf_m, perf_m)
+                sums += slab_sums
+                counts += slab_counts
+                for name, img in (("CBF", CBFimg4D), ("BOLD", BOLDimg4D), ("PERF", perfimg4D)):
+                    if name in outputs:
+                        outputs[name].write_slab(img, z0)
+                        means[name][:, :, z0:z1] = np.mean(img, axis=3)
+        finally:
+            for writer in outputs.values():
+                writer.close()
+        return sums / counts, means
+
+
+class _NiftiSlabWriter:
+    """
+    Write a 4D NIfTI file z-slab by z-slab without holding the volume.
+
+    The header is written first; each slab is then stored frame by frame at
+    its offset in the (Fortran-ordered) data block. For integer data types
+    the scaling depends on the range of the whole series, so slabs are
+    spooled to a temporary float file and written with the input header's
+    dtype and the scl_slope/scl_inter nibabel computes for the full array,
+    as the in-memory path does.
+    """
+
+    def __init__(self, path: str, header):
+        self.header = header.copy()
+        self.shape = self.header.get_data_shape()
+        self.dtype = self.header.get_data_dtype()
+        self.scaled = not np.issubdtype(self.dtype, np.floating)
+        if not self.scaled:
+            self.header.set_slope_inter(1, 0)
+        self.header["descrip"] = b"asltbx_pipeline"
+
+        probe = io.BytesIO()
+        self.header.write_to(probe)
+        self.offset = max(int(self.header.get_data_offset()), probe.tell())
+        self.header.set_data_offset(self.offset)
+
+        self.fobj = open(path, "wb")
+        self.header.write_to(self.fobj)
+        self.fobj.write(b"\0" * (self.offset - self.fobj.tell()))
+        self.fobj.truncate(self.offset + int(np.prod(self.shape)) * self.dtype.itemsize)
+
+        self.spool = None
+        self.range = [np.inf, -np.inf, False]  # finite min, max, has NaN
+        if self.scaled:
+            self.spool_file = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+
+    def write_slab(self, data: np.ndarray, z0: int):
+        if self.scaled:
+            if self.spool is None:
+                self.spool = np.memmap(
+                    self.spool_file, dtype=data.dtype, mode="w+", shape=self.shape, order="F"
+                )
+            self.spool[:, :, z0:z0 + data.shape[2], :] = data
+            mn, mx, has_nan = finite_range(data, check_nan=True)
+            self.range = [min(self.range[0], mn), max(self.range[1], mx), self.range[2] or has_nan]
+            return
+        X, Y, Z = self.shape[:3]
+        itemsize = self.dtype.itemsize
+        for t in range(data.shape[3]):
+            self.fobj.seek(self.offset + ((t * Z + z0) * X * Y) * itemsize)
+            self.fobj.write(data[:, :, :, t].astype(self.dtype).tobytes(order="F"))
+
+    def _write_scaled(self):
+        # The scaling only depends on the finite range and on NaNs being present
+        mn, mx, has_nan = self.range
+        values = [v for v in (mn, mx) if np.isfinite(v)] + ([np.nan] if has_nan else [])
+        writer = make_array_writer(
+            np.array(values, dtype=self.spool.dtype), self.dtype,
+            self.header.has_data_slope, self.header.has_data_intercept,
+        )
+        slope, inter = get_slope_inter(writer)
+        self.header.set_slope_inter(slope, inter)
+        self.fobj.seek(0)
+        self.header.write_to(self.fobj)
+        self.fobj.seek(self.offset)
+        for t in range(self.shape[3]):
+            frame = make_array_writer(
+                np.asarray(self.spool[:, :, :, t]), self.dtype,
+                self.header.has_data_slope, self.header.has_data_intercept, calc_scale=False,
+            )
+            frame.slope = slope
+            if inter is not None:
+                frame.inter = inter
+            frame.to_fileobj(self.fobj, order="F")
+
+    def close(self):
+        try:
+            if self.spool is not None:
+                self._write_scaled()
+        finally:
+            self.fobj.close()
+            if self.scaled:
+                self.spool = None
+                self.spool_file.close()
@@ -1,24 +1,38 @@
 """
 Realign
 -------
-SPM-based realignment for ASL images.
+Realignment for ASL images, with SPM (default) or the native NumPy/SciPy engine.
 """
 
 import os
-from nipype.interfaces import spm
+import numpy as np
+import nibabel as nib
+from pyasl.utils.spm_batch import run_spm, spm_batch
+from pyasl.utils.utils import load_img, save_img
 import logging
 
 logger = logging.getLogger(__name__)
 
 class Realign:
     """
-    SPM-based realignment of ASL images using Nipype.
+    Realignment of ASL images.
 
     Realigns all ASL time series to correct for motion. See `run()` for usage.
     """
     def run(self, data_descrip: dict, config: dict):
         """
-        SPM-based realignment for ASL images.
+        Realignment for ASL images.
+
+        `backend: spm` (default) runs SPM Realign through Nipype;
+        `backend: native` runs the 6-DOF engine in
+        `pyasl.utils.rigid_registration` (no MATLAB) and writes the same
+        r*.nii, mean*.nii and rp_*.txt files. Native-only options:
+        sep (sampling distance in mm, default 4), n_jobs (threads across
+        volumes, default all cores) and asl_aware (default true: the second
+        pass registers control, label and M0 volumes to their own means).
+        The native backend only supports `jobtype: estwrite`: SPM's
+        "estimate" stores per-volume matrices in a .mat sidecar that the
+        Python steps do not read, so later steps would use unrealigned data.
 
         Args:
             data_descrip (dict): Data description dictionary.
@@ -27,20 +41,86 @@ class Realign:
         Returns:
             None
         """
-        logger.info("ASLtbx: Realign ASL data...")
-        for key, value in data_descrip["Images"].items():
-            key = key.replace("rawdata", "derivatives")
-            for asl_file in value["asl"]:
-                P = os.path.join(key, "perf", f"{asl_file}.nii")
-
-                realign = spm.Realign()
-                realign.inputs.in_files = P
-                realign.inputs.quality = config.get("quality", 0.9)
-                realign.inputs.fwhm = config.get("fwhm", 5)
-                realign.inputs.register_to_mean = config.get("register_to_mean", True)
-                realign.inputs.jobtype = config.get("jobtype", "estwrite")
-                realign.inputs.interp = config.get("interp", 1)
-                realign.inputs.wrap = config.get("wrap", [0, 0, 0])
-                realign.inputs.write_mask = config.get("write_mask", True)
-                realign.inputs.write_which = config.get("write_which", [2, 1])
-                realign.run()
\ No newline at end of file
+        backend = str(config.get("backend", "spm")).lower()
+        if backend not in ("spm", "native"):
+            raise ValueError(f"Realign backend must be 'spm' or 'native', got '{backend}'")
+        if backend == "native" and config.get("jobtype", "estwrite") != "estwrite":
+            raise ValueError(
+                f"Native Realign supports jobtype 'estwrite' only, got '{config.get('jobtype')}'"
+            )
+        logger.info("ASLtbx: Realign ASL data (%s)...", backend)
+        with spm_batch("Realign"):
+            for key, value in data_descrip["Images"].items():
+                key = key.replace("rawdata", "derivatives")
+                for asl_file in value["asl"]:
+                    P = os.path.join(key, "perf", f"{asl_file}.nii")
+                    if backend == "native":
+                        self._run_native(P, data_descrip, config)
+                        continue
+
+                    from nipype.interfaces import spm
+
+                    realign = spm.Realign()
+                    realign.inputs.in_files = P
+                    realign.inputs.quality = config.get("quality", 0.9)
+                    realign.inputs.fwhm = config.get("fwhm", 5)
+                    realign.inputs.register_to_mean = config.get("register_to_mean", True)
+                    realign.inputs.jobtype = config.get("jobtype", "estwrite")
+                    realign.inputs.interp = config.get("interp", 1)
+                    realign.inputs.wrap = config.get("wrap", [0, 0, 0])
+                    realign.inputs.write_mask = config.get("write_mask", True)
+                    realign.inputs.write_which = config.get("write_which", [2, 1])
+                    run_spm(realign, f"Realign {asl_file}")
+
+    def _run_native(self, P: str, data_descrip: dict, config: dict):
+        from pyasl.utils.rigid_registration import realign_series, reslice_series, write_rp
+
+        if any(config.get("wrap", [0, 0, 0])):
+            logger.warning("Native Realign ignores `wrap`.")
+
+        img, data = load_img(P, dtype=np.float32)
+        if data.ndim != 4 or data.shape[3] < 2:
+            logger.warning("%s is not a 4D series; nothing to realign.", P)
+            return
+        nvol = data.shape[3]
+        classes = None
+        if config.get("asl_aware", True):
+            context = data_descrip.get("ASLContext") or []
+            if len(context) == nvol:
+                classes = list(context)
+            else:
+                # no (matching) ASLContext: alternate the two volume types
+                classes = [i % 2 for i in range(nvol)]
+
+        est = realign_series(
+            data, img.affine,
+            quality=config.get("quality", 0.9),
+            fwhm=config.get("fwhm", 5),
+            sep=config.get("sep", 4),
+            register_to_mean=config.get("register_to_mean", True),
+            classes=classes,
+            n_jobs=config.get("n_jobs", -1),
+        )
+
+        perf_dir, fname = os.path.split(P)
+        stem = os.path.splitext(fname)[0]
+        write_rp(os.path.join(perf_dir, f"rp_{stem}.txt"), est["rp"])
+
+        resliced, mean = reslice_series(
+            data, img.affine, est["M"], est["ref_affine"],
+            order=config.get("write_interp", 4),
+            which=config.get("write_which", [2, 1]),
+            mask=config.get("write_mask", True),
+            n_jobs=config.get("n_jobs", -1),
+        )
+        if resliced is not None:
+            # header keeps the input data type; nibabel scales on write
+            out = nib.Nifti1Image(resliced, est["ref_affine"], img.header.copy())
+            out.header["descrip"] = "realigned"
+            save_img(out, os.path.join(perf_dir, f"r{stem}.nii"))
+        if mean is not None:
+            header = img.header.copy()
+            header.set_data_dtype(np.float32)
+            out = nib.Nifti1Image(mean.astype(np.float32), est["ref_affine"], header)
+            out.header["descrip"] = "mean image"
+            save_img(out, os.path.join(perf_dir, f"mean{stem}.nii"))
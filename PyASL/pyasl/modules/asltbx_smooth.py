@@ -1,11 +1,14 @@
 """
 Smooth module
 -------------
-SPM-based smoothing for ASL images.
+Smoothing for ASL images, with SPM (default) or native Gaussian filtering.
 """
 
 import os
-from nipype.interfaces import spm
+import nibabel as nib
+import numpy as np
+from pyasl.utils.spm_batch import run_spm, spm_batch
+from pyasl.utils.utils import load_img, save_img
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,7 +16,11 @@ logger = logging.getLogger(__name__)
 class Smooth:
     def run(self, data_descrip: dict, config: dict):
         """
-        SPM-based smoothing for ASL images.
+        Smoothing for ASL images.
+
+        `backend: spm` (default) runs SPM Smooth through Nipype;
+        `backend: native` smooths with `pyasl.utils.smoothing` (no MATLAB,
+        `n_jobs` threads across frames) and writes the same s*.nii files.
 
         Args:
             data_descrip (dict): Data description dictionary.
@@ -22,21 +29,42 @@ class Smooth:
         Returns:
             None
         """
-        logger.info("ASLtbx: Smooth ASL data...")
+        backend = str(config.get("backend", "spm")).lower()
+        if backend not in ("spm", "native"):
+            raise ValueError(f"Smooth backend must be 'spm' or 'native', got '{backend}'")
+        logger.info("ASLtbx: Smooth ASL data (%s)...", backend)
         fwhm = config.get("fwhm", [6, 6, 6])
 
-        for key, value in data_descrip["Images"].items():
-            key = key.replace("rawdata", "derivatives")
-            P = []
+        with spm_batch("Smooth"):
+            for key, value in data_descrip["Images"].items():
+                key = key.replace("rawdata", "derivatives")
+                P = []
+
+                if value["M0"]:
+                    P.append(os.path.join(key, "perf", f"r{value['M0']}.nii"))
+
+                for asl_file in value["asl"]:
+                    P.append(os.path.join(key, "perf", f"rmean{asl_file}.nii"))
+                    P.append(os.path.join(key, "perf", f"rr{asl_file}.nii"))
+
+                if backend == "native":
+                    for path in P:
+                        self._smooth_native(path, fwhm, config.get("n_jobs", -1))
+                    continue
+
+                from nipype.interfaces import spm
 
-            if value["M0"]:
-                P.append(os.path.join(key, "perf", f"r{value['M0']}.nii"))
+                smooth = spm.Smooth()
+                smooth.inputs.in_files = P
+                smooth.inputs.fwhm = fwhm
+                run_spm(smooth, f"Smooth {os.path.basename(key)}")
 
-            for asl_file in value["asl"]:
-                P.append(os.path.join(key, "perf", f"rmean{asl_file}.nii"))
-                P.append(os.path.join(key, "perf", f"rr{asl_file}.nii"))
+    def _smooth_native(self, P: str, fwhm, n_jobs):
+        from pyasl.utils.smoothing import smooth_series
 
-            smooth = spm.Smooth()
-            smooth.inputs.in_files = P
-            smooth.inputs.fwhm = fwhm
-            smooth.run()
\ No newline at end of file
+        img, data = load_img(P, dtype=np.float32)
+        smoothed = smooth_series(data, img.affine, fwhm, n_jobs=n_jobs)
+        # header keeps the input data type, as SPM does; nibabel scales on write
+        out = nib.Nifti1Image(smoothed, img.affine, img.header.copy())
+        folder, name = os.path.split(P)
+        save_img(out, os.path.join(folder, f"s{name}"))
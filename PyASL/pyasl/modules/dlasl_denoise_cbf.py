@@ -7,9 +7,8 @@ from __future__ import annotations
 import os, glob, logging
 import numpy as np
 import nibabel as nib
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
-from pyasl.utils.models import dilated_net_wide
 from pyasl.utils.utils import load_img
 from scipy.ndimage import affine_transform
 
@@ -57,6 +56,73 @@ def resample_64_64_24(img: nib.Nifti1Image) -> nib.Nifti1Image:
     return nib.Nifti1Image(resampled, new_affine, img.header)
 
 
+# Process-wide cache of loaded models, keyed on (model_selection, weights_dir)
+# and the backend options
+_MODEL_CACHE: Dict[tuple, Any] = {}
+
+
+def get_model(
+    model_selection: int,
+    weights_dir: str,
+    backend: str = "keras",
+    quantize: Optional[str] = None,
+    n_threads: Optional[int] = None,
+    onnx_dir: Optional[str] = None,
+    parity_check: bool = False,
+):
+    """
+    Load the denoising model once per process.
+
+    backend="keras" builds `dilated_net_wide(3)` with the selected weights.
+    backend="onnx" runs the model exported by `pyasl.utils.dlasl_onnx` with
+    ONNX Runtime (optionally float16/int8 weights, `n_threads` CPU threads);
+    the export happens on first use if the file is missing, which needs
+    TensorFlow. With `parity_check` the ONNX output is compared with Keras
+    once when the model is loaded.
+
+    Later calls with the same arguments return the already loaded model, so
+    the graph build and the weight load are paid once per process rather
+    than once per subject.
+    """
+    key = (int(model_selection), os.path.abspath(weights_dir), backend, quantize, n_threads, onnx_dir)
+    model = _MODEL_CACHE.get(key)
+    if model is not None:
+        return model
+
+    if backend == "onnx":
+        from pyasl.utils import dlasl_onnx
+
+        path = dlasl_onnx.onnx_path(model_selection, onnx_dir or weights_dir, quantize)
+        if not os.path.isfile(path):
+            path = dlasl_onnx.export_onnx(model_selection, weights_dir, onnx_dir, quantize)
+        model = dlasl_onnx.OnnxDenoiser(path, n_threads)
+        logger.info("Loaded ONNX model: %s", path)
+        if parity_check:
+            diff = dlasl_onnx.parity_check(model_selection, weights_dir, path)
+            if diff > 2.0 / 255:
+                logger.warning("ONNX model %s differs from Keras by up to %.3g.", path, diff)
+    elif backend == "keras":
+        from pyasl.utils.models import dilated_net_wide
+
+        fname = "model_068.hdf5" if key[0] == 0 else "model_099.hdf5"
+        weight_path = os.path.join(key[1], fname)
+        if not os.path.isfile(weight_path):
+            logger.error("Weights not found: %s", weight_path)
+            raise FileNotFoundError(f"Model weights not found: {weight_path}")
+        model = dilated_net_wide(3)
+        model.load_weights(weight_path)
+        logger.info("Loaded weights: %s", weight_path)
+    else:
+        raise ValueError(f"DLASL backend must be 'keras' or 'onnx', got '{backend}'")
+    _MODEL_CACHE[key] = model
+    return model
+
+
+def clear_model_cache() -> None:
+    """Drop all cached models."""
+    _MODEL_CACHE.clear()
+
+
 class DLASLDenoiseCBF:
     """
     Denoise CBF volumes using a dilated CNN.
@@ -64,7 +130,7 @@ class DLASLDenoiseCBF:
     Inputs (from data_description)
     ------------------------------
     We infer the subject/session `derivatives/.../perf` directory from the first
-    Images entry.
+    Images entry, or from every entry in batch mode.
 
     Params (YAML/kwargs)
     --------------------
@@ -81,23 +147,46 @@ class DLASLDenoiseCBF:
         Directory containing model weights; default `.../pyasl/models`.
     out_prefix : str, default "denoised_"
         Output file name prefix.
+    batch_mode : bool, default False
+        Denoise the CBF volumes of all Images entries instead of the first.
+        Slices of all volumes are pooled into inference batches.
+    batch_size : int, default 128
+        Slices per `model.predict` call. Volumes are collected until a batch
+        is full; predictions are then split back into per-volume outputs.
+
+    backend : str, default "keras"
+        "onnx" runs an ONNX export of the weights with ONNX Runtime on the
+        CPU (no TensorFlow needed once exported; see `pyasl.utils.dlasl_onnx`).
+    quantize : str, optional
+        ONNX backend: "float16" or "int8" weights.
+    n_threads : int, optional
+        ONNX backend: CPU threads for inference.
+    onnx_dir : str, optional
+        ONNX backend: directory of the exported models (default weights_dir).
+    parity_check : bool, default False
+        ONNX backend: compare with the Keras output once when loading.
+
+    The model is loaded once per process and reused (`get_model`).
 
     Outputs
     -------
-    Writes denoised NIfTI(s) into `<der_perf>` and returns {"dlasl_last_output": path}.
+    Writes denoised NIfTI(s) into `<der_perf>` and returns
+    {"dlasl_last_output": path, "dlasl_outputs": [paths]}.
     """
 
     # ---------- utilities ----------
-    def _load_model(self, model_selection: int, weights_dir: str):
-        model = dilated_net_wide(3)
-        fname = "model_068.hdf5" if model_selection == 0 else "model_099.hdf5"
-        weight_path = os.path.join(weights_dir, fname)
-        if not os.path.isfile(weight_path):
-            logger.error("Weights not found: %s", weight_path)
-            raise FileNotFoundError(f"Model weights not found: {weight_path}")
-        model.load_weights(weight_path)
-        logger.info("Loaded weights: %s", weight_path)
-        return model
+    def _load_model(self, model_selection: int, weights_dir: str, params: Dict[str, Any] = None):
+        params = params or {}
+        quantize = params.get("quantize")
+        return get_model(
+            model_selection,
+            weights_dir,
+            backend=str(params.get("backend", "keras")).lower(),
+            quantize=None if quantize in (None, "none") else quantize,
+            n_threads=params.get("n_threads"),
+            onnx_dir=params.get("onnx_dir"),
+            parity_check=bool(params.get("parity_check", False)),
+        )
 
     def _resolve_cbf_list(self, der_perf: str, params: Dict[str, Any]) -> List[str]:
         """
@@ -138,17 +227,8 @@ class DLASLDenoiseCBF:
             raise FileNotFoundError(f"No CBF files in {der_perf} matching any of {patterns}")
         return unique_hits
 
-    # ---------- main ----------
-    def run(self, data_descrip: Dict[str, Any], params: Dict[str, Any]):
-        """
-        Denoise CBF images.
-
-        Args:
-            data_descrip (dict): Data description dictionary.
-            params (dict): Parameters dictionary.
-        """
-        logger.info("DLASL: Denoise CBF images...")
-        base_dir, _ = _first_images_entry(data_descrip)
+    def _session_jobs(self, base_dir: str, params: Dict[str, Any]):
+        """Yield (input path, preprocessed slices (Z, 64, 64, 1), resampled image, mask, output path)."""
         der_perf = os.path.join(_deriv_dir(base_dir), "perf")
         if not os.path.isdir(der_perf):
             raise FileNotFoundError(f"perf directory not found: {der_perf}")
@@ -164,21 +244,8 @@ class DLASLDenoiseCBF:
         mask_r = (np.asarray(mask_img_r.dataobj) > 0).astype(np.uint8)
         logger.info("Loaded mask and resampled to 64x64x24.")
 
-        # inputs
-        cbf_paths = self._resolve_cbf_list(der_perf, params)
-
-        # model
-        weights_dir = params.get(
-            "weights_dir",
-            os.path.join(os.path.dirname(os.path.dirname(__file__)), "models"),
-        )
-        model = self._load_model(int(params.get("model_selection", 1)), weights_dir)
-
-        # denoise all candidates
-        last_out = None
         out_prefix = params.get("out_prefix", "denoised_")
-
-        for in_path in cbf_paths:
+        for in_path in self._resolve_cbf_list(der_perf, params):
             v, vol = load_img(in_path)
             if vol.ndim == 4:
                 vol = vol.mean(axis=3)
@@ -194,18 +261,68 @@ class DLASLDenoiseCBF:
             y = np.clip(x, 0, 150) / 255.0
             y_batch = y.transpose(2, 0, 1)[..., None]  # (Z, 64, 64, 1)
 
-            # inference
-            y_pred = model.predict(y_batch, verbose=0)  # (Z, 64, 64, 1)
-            x_hat = np.squeeze(y_pred).astype(np.float32)  # (Z, 64, 64) or (64, 64)
-            if x_hat.ndim == 2:
-                x_hat = x_hat[None, ...]
-            x_hat = x_hat.transpose(1, 2, 0) * 255.0  # (64, 64, 24)
-            x_hat = np.clip(x_hat, 0, 150)
-            x_hat *= mask_r
-
             out_path = os.path.join(der_perf, f"{out_prefix}{os.path.basename(in_path)}")
-            nib.Nifti1Image(x_hat, v_r.affine, v_r.header).to_filename(out_path)
-            logger.info("DLASLDenoiseCBF: %s -> %s", in_path, out_path)
-            last_out = out_path
+            yield in_path, y_batch, v_r, mask_r, out_path
+
+    # ---------- main ----------
+    def run(self, data_descrip: Dict[str, Any], params: Dict[str, Any]):
+        """
+        Denoise CBF images.
+
+        Args:
+            data_descrip (dict): Data description dictionary.
+            params (dict): Parameters dictionary.
+        """
+        logger.info("DLASL: Denoise CBF images...")
+        if params.get("batch_mode", False):
+            assert "Images" in data_descrip and data_descrip["Images"]
+            bases = list(data_descrip["Images"].keys())
+        else:
+            bases = [_first_images_entry(data_descrip)[0]]
+
+        # model
+        weights_dir = params.get(
+            "weights_dir",
+            os.path.join(os.path.dirname(os.path.dirname(__file__)), "models"),
+        )
+        model = self._load_model(int(params.get("model_selection", 1)), weights_dir, params)
+        batch_size = max(1, int(params.get("batch_size", 128)))
+
+        outputs: List[str] = []
+        pending: list = []
+
+        def flush():
+            # one inference call for all pending volumes, then split per volume
+            y_pred = model.predict(
+                np.concatenate([job[1] for job in pending]), batch_size=batch_size, verbose=0
+            )  # (sum Z, 64, 64, 1)
+            start = 0
+            for in_path, y_batch, v_r, mask_r, out_path in pending:
+                z = y_batch.shape[0]
+                x_hat = y_pred[start:start + z, ..., 0].astype(np.float32)  # (Z, 64, 64)
+                start += z
+                x_hat = x_hat.transpose(1, 2, 0) * 255.0  # (64, 64, 24)
+                x_hat = np.clip(x_hat, 0, 150)
+                x_hat *= mask_r
+
+                nib.Nifti1Image(x_hat, v_r.affine, v_r.header).to_filename(out_path)
+                logger.info("DLASLDenoiseCBF: %s -> %s", in_path, out_path)
+                outputs.append(out_path)
+            pending.clear()
+
+        n_slices = 0
+        for base_dir in bases:
+            for job in self._session_jobs(base_dir, params):
+                pending.append(job)
+                n_slices += job[1].shape[0]
+                if sum(j[1].shape[0] for j in pending) >= batch_size:
+                    flush()
+        if pending:
+            flush()
+        if len(bases) > 1:
+            logger.info(
+                "DLASLDenoiseCBF: %d volume(s) from %d session(s), %d slices.",
+                len(outputs), len(bases), n_slices,
+            )
 
-        return {"dlasl_last_output": last_out}
+        return {"dlasl_last_output": outputs[-1] if outputs else None, "dlasl_outputs": outputs}
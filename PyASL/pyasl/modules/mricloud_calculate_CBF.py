@@ -6,7 +6,7 @@ Calculate CBF (Cerebral Blood Flow) using MRICloud pipeline logic.
 import os
 import numpy as np
 import nibabel as nib
-from pyasl.utils.utils import load_img
+from pyasl.utils.utils import load_img, save_img
 import logging
 logger = logging.getLogger(__name__)
 
@@ -76,7 +76,7 @@ class MRICloudCalculateCBF:
                         )
 
                 # Avoid division by zero in M0 map
-                m0map[np.abs(m0map) < 1e-6] = np.mean(m0map[brnmsk_clcu])
+                m0map = np.where(np.abs(m0map) < 1e-6, np.mean(m0map[brnmsk_clcu]), m0map)
                 m0vol = m0map.astype(np.float32)
                 brvol = brnmsk_dspl.astype(np.float32)
 
@@ -97,9 +97,9 @@ class MRICloudCalculateCBF:
                 # Save absolute CBF map
                 acbf_img = nib.Nifti1Image(cbf_thr, V_diff.affine, header)
                 acbf_img.header["descrip"] = b"mricloud_pipeline"
-                acbf_img.to_filename(os.path.join(key, "perf", f"{asl_file}_aCBF_native.nii"))
+                save_img(acbf_img, os.path.join(key, "perf", f"{asl_file}_aCBF_native.nii"))
 
                 # Save relative CBF map
                 rcbf_img = nib.Nifti1Image(rcbf_thr, V_diff.affine, header)
                 rcbf_img.header["descrip"] = b"mricloud_pipeline"
-                rcbf_img.to_filename(os.path.join(key, "perf", f"{asl_file}_rCBF_native.nii"))
+                save_img(rcbf_img, os.path.join(key, "perf", f"{asl_file}_rCBF_native.nii"))
@@ -8,7 +8,7 @@ import os
 import numpy as np
 import nibabel as nib
 import logging
-from pyasl.utils.utils import load_img
+from pyasl.utils.utils import load_img, save_img
 from pyasl.utils.mricloud_helpers import img_coreg, mricloud_getBrainMask, mricloud_bgs_factor
 
 logger = logging.getLogger(__name__)
@@ -20,6 +20,7 @@ class MRICloudCalculateM0:
         Parameters can include:
         - t1_tissue: T1 relaxation time for tissue (default: 1165 ms)
         - bgs_eff: Background suppression efficiency (default: 0.93)
+        - coreg_backend: "spm" (default) or "native" M0 coregistration
 
         Args:
             data_descrip (dict): Data description dictionary.
@@ -60,7 +61,7 @@ class MRICloudCalculateM0:
                     m0map_img = nib.Nifti1Image(m0map, V_m0.affine, header)
                     m0siz = m0map.shape
                     m0path = os.path.join(key, "perf", "M0ave.nii")
-                    m0map_img.to_filename(m0path)
+                    save_img(m0map_img, m0path)
 
                 else:
                     P = os.path.join(key, "perf", f"{value['asl'][0]}.nii")
@@ -79,11 +80,11 @@ class MRICloudCalculateM0:
                     m0map_img = nib.Nifti1Image(m0map, V.affine, header)
                     m0siz = m0map.shape
                     m0path = os.path.join(key, "perf", "M0ave.nii")
-                    m0map_img.to_filename(m0path)
+                    save_img(m0map_img, m0path)
 
                 if np.array_equal(ctrlsiz, m0siz):
                     target = os.path.join(key, "perf", f"mean{asl_file}.nii")
-                    img_coreg(target, m0path)
+                    img_coreg(target, m0path, backend=params.get("coreg_backend", "spm"))
                     P_rm0 = os.path.join(key, "perf", "rM0ave.nii")
                     V_rm0, rm0vol = load_img(P_rm0)
                     brnmsk_dspl, brnmsk_clcu = mricloud_getBrainMask(imgtpm, P_rm0)
@@ -149,13 +150,13 @@ class MRICloudCalculateM0:
             header.set_data_dtype(np.float32)
             m0map_final_img = nib.Nifti1Image(m0map_final, V_ctrl.affine, header)
             m0map_final_img.header["descrip"] = b"mricloud_pipeline"
-            m0map_final_img.to_filename(os.path.join(key, "perf", "M0map.nii"))
+            save_img(m0map_final_img, os.path.join(key, "perf", "M0map.nii"))
 
             header.set_data_dtype(np.int16)
             brnmsk_dspl_img = nib.Nifti1Image(brnmsk_dspl, V_ctrl.affine, header)
             brnmsk_dspl_img.header["descrip"] = b"mricloud_pipeline"
-            brnmsk_dspl_img.to_filename(os.path.join(key, "perf", "brnmsk_dspl.nii"))
+            save_img(brnmsk_dspl_img, os.path.join(key, "perf", "brnmsk_dspl.nii"))
 
             brnmsk_clcu_img = nib.Nifti1Image(brnmsk_clcu, V_ctrl.affine, header)
             brnmsk_clcu_img.header["descrip"] = b"mricloud_pipeline"
-            brnmsk_clcu_img.to_filename(os.path.join(key, "perf", "brnmsk_clcu.nii"))
+            save_img(brnmsk_clcu_img, os.path.join(key, "perf", "brnmsk_clcu.nii"))
@@ -11,7 +11,7 @@ import os
 import numpy as np
 import nibabel as nib
 import logging
-from pyasl.utils.utils import load_img
+from pyasl.utils.utils import load_img, save_img
 
 logger = logging.getLogger(__name__)
 
@@ -66,6 +66,6 @@ class MRICloudCalculateDiffmap:
                 labl_img.header["descrip"] = "3D label image"
                 diff_img.header["descrip"] = "3D difference image"
 
-                ctrl_img.to_filename(os.path.join(key, "perf", f"r{asl_file}_ctrl.nii"))
-                labl_img.to_filename(os.path.join(key, "perf", f"r{asl_file}_labl.nii"))
-                diff_img.to_filename(os.path.join(key, "perf", f"r{asl_file}_diff.nii"))
+                save_img(ctrl_img, os.path.join(key, "perf", f"r{asl_file}_ctrl.nii"))
+                save_img(labl_img, os.path.join(key, "perf", f"r{asl_file}_labl.nii"))
+                save_img(diff_img, os.path.join(key, "perf", f"r{asl_file}_diff.nii"))
@@ -5,6 +5,7 @@ Coregister ASL data to the structural MPR image using MRICloud pipeline logic.
 """
 import os
 from pyasl.utils.mricloud_helpers import img_coreg, mricloud_skullstrip
+from pyasl.utils.spm_batch import spm_batch
 import logging
 logger = logging.getLogger(__name__)
 
@@ -32,42 +33,49 @@ class MRICloudCoregMPR:
     def run(self, data_descrip: dict, params: dict):
         """
         Coregister ASL data to the structural MPR image using MRICloud pipeline logic.
+
+        Parameters can include:
+        - coreg_backend: "spm" (default) or "native" NMI coregistration
         """
         logger.info("MRICloud: Coregister ASL data to structural image...")
 
-        for key, value in data_descrip["Images"].items():
-            key = key.replace("rawdata", "derivatives")
-
-            # Create skull-stripped MPR image
-            target = mricloud_skullstrip(
-                os.path.join(key, "anat", value["mpr_folder"]),
-                value["mpr_name"],
-            )
-
-            for asl_file in value["asl"]:
-                # Source depends on whether M0 is estimated
-                if data_descrip["M0Type"] != "Estimate":
-                    source = os.path.join(key, "perf", "rM0ave.nii")
-                else:
-                    source = os.path.join(key, "perf", f"mean{asl_file}.nii")
-
-                # Additional images to coregister
-                other_files = [
-                    os.path.join(key, "perf", f"{asl_file}_aCBF_native.nii"),
-                    os.path.join(key, "perf", f"{asl_file}_rCBF_native.nii"),
-                    os.path.join(key, "perf", "brnmsk_clcu.nii"),
-                ]
-
-                # Include ATT file if multidelay data
-                att_file = os.path.join(key, "perf", f"{asl_file}_ATT_native.nii")
-                if not data_descrip["SingleDelay"] and os.path.exists(att_file):
-                    other_files.append(att_file)
-
-                # Perform coregistration
-                img_coreg(target, source, other_files)
-
-                # Rename output files with _mpr suffix
-                self._rename_files(key, asl_file)
+        coregistered = []
+        with spm_batch("CoregMPR"):
+            for key, value in data_descrip["Images"].items():
+                key = key.replace("rawdata", "derivatives")
+
+                # Create skull-stripped MPR image
+                target = mricloud_skullstrip(
+                    os.path.join(key, "anat", value["mpr_folder"]),
+                    value["mpr_name"],
+                )
+
+                for asl_file in value["asl"]:
+                    # Source depends on whether M0 is estimated
+                    if data_descrip["M0Type"] != "Estimate":
+                        source = os.path.join(key, "perf", "rM0ave.nii")
+                    else:
+                        source = os.path.join(key, "perf", f"mean{asl_file}.nii")
+
+                    # Additional images to coregister
+                    other_files = [
+                        os.path.join(key, "perf", f"{asl_file}_aCBF_native.nii"),
+                        os.path.join(key, "perf", f"{asl_file}_rCBF_native.nii"),
+                        os.path.join(key, "perf", "brnmsk_clcu.nii"),
+                    ]
+
+                    # Include ATT file if multidelay data
+                    att_file = os.path.join(key, "perf", f"{asl_file}_ATT_native.nii")
+                    if not data_descrip["SingleDelay"] and os.path.exists(att_file):
+                        other_files.append(att_file)
+
+                    # Perform coregistration
+                    img_coreg(target, source, other_files, backend=params.get("coreg_backend", "spm"))
+                    coregistered.append((key, asl_file))
+
+        # Rename output files with _mpr suffix (after a batched SPM run)
+        for key, asl_file in coregistered:
+            self._rename_files(key, asl_file)
 
     def _rename_files(self, key: str, asl_file: str):
         """Rename coregistered files to include '_mpr' suffix."""
@@ -78,18 +86,24 @@ class MRICloudCoregMPR:
         dst = os.path.join(perf_path, f"{asl_file}_aCBF_mpr.nii")
         if os.path.exists(src):
             os.rename(src, dst)
+        else:
+            logger.warning("Coregistered image not found: %s", src)
 
         # Rename relative CBF
         src = os.path.join(perf_path, f"r{asl_file}_rCBF_native.nii")
         dst = os.path.join(perf_path, f"{asl_file}_rCBF_mpr.nii")
         if os.path.exists(src):
             os.rename(src, dst)
+        else:
+            logger.warning("Coregistered image not found: %s", src)
 
         # Rename brain mask
         src = os.path.join(perf_path, "rbrnmsk_clcu.nii")
         dst = os.path.join(perf_path, "brnmsk_clcu_mpr.nii")
         if os.path.exists(src):
             os.rename(src, dst)
+        else:
+            logger.warning("Coregistered image not found: %s", src)
 
         # Rename ATT map if it exists
         src = os.path.join(perf_path, f"r{asl_file}_ATT_native.nii")
@@ -9,8 +9,9 @@ import numpy as np
 import nibabel as nib
 import logging
 from scipy.optimize import curve_fit
-from pyasl.utils.utils import load_img
+from pyasl.utils.utils import load_img, save_img
 from pyasl.utils.mricloud_helpers import img_coreg, mricloud_getBrainMask, mricloud_func_recover
+from pyasl.utils.parallel import run_voxel_chunks
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +29,11 @@ class MRICloudMultidelayCalculateM0:
         """
         Calculate M0 for multidelay ASL data using MRICloud pipeline logic.
 
+        Parameters can include:
+        - n_jobs: number of worker processes for the M0 fit (default: 1; -1 uses all cores)
+        - chunk_size: voxels per worker task (default: 4096)
+        - coreg_backend: "spm" (default) or "native" M0 coregistration
+
         Args:
             data_descrip (dict): Data description dictionary.
             params (dict): Additional parameters.
@@ -47,7 +53,8 @@ class MRICloudMultidelayCalculateM0:
             fn_asl = os.path.join(key, "perf", f"{asl_file}.nii")
             V_asl, img_all = load_img(fn_asl)
             fn_ctrl = os.path.join(key, "perf", f"r{asl_file}_ctrl.nii")
-            V_ctrl = nib.load(fn_ctrl)
+            # Through load_img: the previous step may still be writing it via the derivative store
+            V_ctrl, _ = load_img(fn_ctrl)
 
             if data_descrip["M0Type"] != "Estimate":
                 # --- Case 1: Direct M0 provided or derived from ASLContext ---
@@ -64,7 +71,7 @@ class MRICloudMultidelayCalculateM0:
                     header["pixdim"] = list(header["pixdim"][:4]) + [1] * 4
                     m0map_img = nib.Nifti1Image(m0map, V_m0.affine, header)
                     m0path = os.path.join(key, "perf", "M0ave.nii")
-                    m0map_img.to_filename(m0path)
+                    save_img(m0map_img, m0path)
 
                 else:
                     P = os.path.join(key, "perf", f"{value['asl'][0]}.nii")
@@ -82,11 +89,11 @@ class MRICloudMultidelayCalculateM0:
                     header["pixdim"] = list(header["pixdim"][:4]) + [1] * 4
                     m0map_img = nib.Nifti1Image(m0map, V.affine, header)
                     m0path = os.path.join(key, "perf", "M0ave.nii")
-                    m0map_img.to_filename(m0path)
+                    save_img(m0map_img, m0path)
 
                 # Coregister M0 map to control image
                 target = fn_ctrl
-                img_coreg(target, m0path)
+                img_coreg(target, m0path, backend=params.get("coreg_backend", "spm"))
                 P_rm0 = os.path.join(key, "perf", "rM0ave.nii")
                 V_rm0, rm0vol = load_img(P_rm0)
 
@@ -115,51 +122,40 @@ class MRICloudMultidelayCalculateM0:
                 idx_msk = np.where(brnmsk_dspl)
                 m0_map = np.zeros_like(ctrl_last)
 
-                if data_descrip["ArterialSpinLabelingType"] == "PCASL":
-                    ff = lambda x, m0, t1: mricloud_func_recover(m0, t1, x)
+                asl_type = data_descrip["ArterialSpinLabelingType"]
+                if asl_type == "PCASL":
+                    flip_angle = None
+                    x_base = plds + data_descrip["LabelingDuration"] * 1000
                     beta_init = [m0_int, 1165]
                     lowb = [0, 0]
                     uppb = [10 * m0_int, 5000]
-
-                    for ivox in zip(*idx_msk):
-                        islc = ivox[2]
-                        if data_descrip["MRAcquisitionType"] == "3D":
-                            xdata = plds + data_descrip["LabelingDuration"] * 1000
-                        else:
-                            xdata = (
-                                plds
-                                + data_descrip["LabelingDuration"] * 1000
-                                + (islc - 1) * data_descrip["SliceDuration"] * 1000
-                            )
-                        ydata = ctrl_all[np.ravel_multi_index(ivox, brnmsk_dspl.shape), :]
-                        beta1, _ = curve_fit(
-                            ff, xdata, ydata, p0=beta_init, bounds=(lowb, uppb)
-                        )
-                        m0_map[ivox] = beta1[0]
-
-                elif data_descrip["ArterialSpinLabelingType"] == "PASL":
-                    ff = lambda x, m0, t1, m_init: mricloud_func_recover(
-                        m0, t1, x, data_descrip["Looklocker"], m_init
-                    )
+                elif asl_type == "PASL":
+                    flip_angle = data_descrip["Looklocker"]
+                    x_base = plds + data_descrip["BolusCutOffDelayTime"] * 1000
                     beta_init = [m0_int, 1165, 0]
                     lowb = [0, 0, -10 * m0_int]
                     uppb = [10 * m0_int, 5000, 5 * m0_int]
+                else:
+                    x_base = None
 
-                    for ivox in zip(*idx_msk):
-                        islc = ivox[2]
-                        if data_descrip["MRAcquisitionType"] == "3D":
-                            xdata = plds + data_descrip["BolusCutOffDelayTime"] * 1000
-                        else:
-                            xdata = (
-                                plds
-                                + data_descrip["BolusCutOffDelayTime"] * 1000
-                                + (islc - 1) * data_descrip["SliceDuration"] * 1000
-                            )
-                        ydata = ctrl_all[np.ravel_multi_index(ivox, brnmsk_dspl.shape), :]
-                        beta1, _ = curve_fit(
-                            ff, xdata, ydata, p0=beta_init, bounds=(lowb, uppb)
-                        )
-                        m0_map[ivox] = beta1[0]
+                if x_base is not None and len(idx_msk[0]) > 0:
+                    if data_descrip["MRAcquisitionType"] == "3D":
+                        slc_offset = np.zeros(len(idx_msk[0]))
+                    else:
+                        slc_offset = (idx_msk[2] - 1) * data_descrip["SliceDuration"] * 1000
+                    xdata = x_base[np.newaxis, :] + slc_offset[:, np.newaxis]
+                    ydata = ctrl_all[np.ravel_multi_index(idx_msk, brnmsk_dspl.shape), :]
+
+                    m0_map[idx_msk] = run_voxel_chunks(
+                        _fit_m0_chunk,
+                        {"xdata": xdata, "ydata": ydata},
+                        n_jobs=params.get("n_jobs", 1),
+                        chunk_size=params.get("chunk_size", 4096),
+                        flip_angle=flip_angle,
+                        beta_init=beta_init,
+                        lowb=lowb,
+                        uppb=uppb,
+                    )
 
                 m0map_final = m0_map * brnmsk_dspl.astype(float)
 
@@ -168,13 +164,28 @@ class MRICloudMultidelayCalculateM0:
             header.set_data_dtype(np.float32)
             m0map_final_img = nib.Nifti1Image(m0map_final, V_ctrl.affine, header)
             m0map_final_img.header["descrip"] = b"mricloud_pipeline"
-            m0map_final_img.to_filename(os.path.join(key, "perf", "M0map.nii"))
+            save_img(m0map_final_img, os.path.join(key, "perf", "M0map.nii"))
 
             header.set_data_dtype(np.int16)
             brnmsk_dspl_img = nib.Nifti1Image(brnmsk_dspl, V_ctrl.affine, header)
             brnmsk_dspl_img.header["descrip"] = b"mricloud_pipeline"
-            brnmsk_dspl_img.to_filename(os.path.join(key, "perf", "brnmsk_dspl.nii"))
+            save_img(brnmsk_dspl_img, os.path.join(key, "perf", "brnmsk_dspl.nii"))
 
             brnmsk_clcu_img = nib.Nifti1Image(brnmsk_clcu, V_ctrl.affine, header)
             brnmsk_clcu_img.header["descrip"] = b"mricloud_pipeline"
-            brnmsk_clcu_img.to_filename(os.path.join(key, "perf", "brnmsk_clcu.nii"))
+            save_img(brnmsk_clcu_img, os.path.join(key, "perf", "brnmsk_clcu.nii"))
+
+
+def _fit_m0_chunk(xdata, ydata, flip_angle, beta_init, lowb, uppb):
+    """Fit the T1 recovery model for one chunk of voxels and return M0."""
+    if flip_angle is None:
+        ff = lambda x, m0, t1: mricloud_func_recover(m0, t1, x)
+    else:
+        ff = lambda x, m0, t1, m_init: mricloud_func_recover(
+            m0, t1, x, flip_angle, m_init
+        )
+    m0 = np.zeros(len(ydata))
+    for iv in range(len(ydata)):
+        beta1, _ = curve_fit(ff, xdata[iv], ydata[iv], p0=beta_init, bounds=(lowb, uppb))
+        m0[iv] = beta1[0]
+    return m0
@@ -8,7 +8,7 @@ import os
 import nibabel as nib
 import numpy as np
 import logging
-from pyasl.utils.utils import load_img
+from pyasl.utils.utils import load_img, save_img
 
 logger = logging.getLogger(__name__)
 
@@ -57,4 +57,4 @@ class MRICloudRescale:
         rescaled_img.header["scl_slope"] = 1
         rescaled_img.header["scl_inter"] = 0
         rescaled_img.header["descrip"] = "4D rescaled images"
-        rescaled_img.to_filename(target_path)
+        save_img(rescaled_img, target_path)
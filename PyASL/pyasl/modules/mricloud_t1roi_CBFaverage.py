@@ -8,11 +8,13 @@ import os
 import re
 import numpy as np
 import nibabel as nib
-from pyasl.utils.utils import load_img
+from pyasl.utils.utils import load_img, save_img
 from pyasl.utils.mricloud_helpers import (
     mricloud_read_roi_lookup_table,
     mricloud_read_roi_lists_info,
 )
+from pyasl.utils.label_stats import label_index, label_stats, group_lut, group_stats
+from pyasl.utils.results_store import ResultsStore, resolve_db_path, session_ids
 import logging
 logger = logging.getLogger(__name__)
 
@@ -25,6 +27,13 @@ class MRICloudT1ROICBFAverage:
     def run(self, data_descrip: dict, params: dict):
         """
         Calculate ROI average CBF values using the structural T1 segmentation.
+
+        Parameters
+        ----------
+        params : dict
+            - results_db: SQLite results database to append the ROI values to
+              (optional; relative to the derivatives folder, see
+              pyasl.utils.results_store)
         """
         logger.info("MRICloud: Calculate ROI average CBF...")
 
@@ -66,6 +75,33 @@ class MRICloudT1ROICBFAverage:
             ]
             roimaskfile = files[0]
             V0, mskv = load_img(os.path.join(key, "anat", value["mpr_folder"], roimaskfile))
+            labels = label_index(mskv, label_num)
+
+            # Hierarchical segmentations (Type1-L2, L3, L5): label -> segment lookup
+            levels = []
+            for tt in range(len(roi_lists_info) - 1):
+                roi_tbl = roi_lookup_tbl[tt]
+                roi_lst = roi_lists_info[tt]["list"]
+                seg_num = roi_lists_info[tt]["count"]
+                lut = group_lut(
+                    [row[roi_tbl] if len(row) > roi_tbl else None for row in roi_lookup_all],
+                    roi_lst[:seg_num],
+                )
+                levels.append((lut, roi_lst, seg_num))
+
+                # Save segmentation mask
+                segmask_img = nib.Nifti1Image(lut[labels].astype(np.int32), V0.affine, V0.header)
+                segmask_img.header["descrip"] = b"mricloud_pipeline"
+                segmask_img.header.set_data_dtype(np.int32)
+                save_img(
+                    segmask_img,
+                    os.path.join(
+                        key,
+                        "anat",
+                        value["mpr_folder"],
+                        f"{value['mpr_name']}_{seg_num}_segments.nii",
+                    )
+                )
 
             # Process each ASL file
             for asl_file in value["asl"]:
@@ -73,62 +109,44 @@ class MRICloudT1ROICBFAverage:
                 V2, rcbf = load_img(os.path.join(key, "perf", f"{asl_file}_rCBF_mpr.nii"))
                 V3, msk1 = load_img(os.path.join(key, "perf", "brnmsk_clcu_mpr.nii"))
 
+                # One pass over the volume for all labels; segments are reduced from it
+                stats = label_stats(labels, [acbf, rcbf], label_num, mask=msk1 > 0.5)
+
+                # (number of ROIs, ROI names, stats) per level, then all labels
+                tables = [
+                    (seg_num, roi_lst[:seg_num], group_stats(stats, lut, seg_num))
+                    for lut, roi_lst, seg_num in levels
+                ]
+                tables.append((label_num, [row[1] for row in roi_lists_info[2]["list"]], stats))
+
                 fresult = os.path.join(key, "perf", f"{asl_file}_CBF_T1segmented_ROIs.txt")
                 with open(fresult, "w") as fid:
                     coltitle = "ROI analysis by {} major tissue types\n"
                     colnames = (
                         "Index\tMask_name\tRegional_CBF(ml/100g/min)\tRegional_relative_CBF\tNumber_of_voxels\n"
                     )
-
-                    # Process hierarchical ROI levels (Type1-L2, L3, L5)
-                    for tt in range(len(roi_lists_info) - 1):
-                        roi_tbl = roi_lookup_tbl[tt]
-                        roi_lst = roi_lists_info[tt]["list"]
-                        seg_num = roi_lists_info[tt]["count"]
-                        segmask = np.zeros_like(mskv)
-
-                        for ii in range(seg_num):
-                            for kk in range(label_num):
-                                if len(roi_lookup_all[kk]) <= roi_tbl:
-                                    continue
-                                if roi_lst[ii] == roi_lookup_all[kk][roi_tbl]:
-                                    segmask[mskv == (kk + 1)] = ii + 1
-
-                        # Save segmentation mask
-                        segmask_img = nib.Nifti1Image(segmask, V0.affine, V0.header)
-                        segmask_img.header["descrip"] = b"mricloud_pipeline"
-                        segmask_img.header.set_data_dtype(np.int32)
-                        segmask_img.to_filename(
-                            os.path.join(
-                                key,
-                                "anat",
-                                value["mpr_folder"],
-                                f"{value['mpr_name']}_{seg_num}_segments.nii",
-                            )
-                        )
-
+                    for tt, (seg_num, names, seg) in enumerate(tables):
                         fid.write(coltitle.format(seg_num))
                         fid.write(colnames)
                         for ii in range(seg_num):
-                            idxvox_seg = np.squeeze(segmask == (ii + 1)) & (msk1 > 0.5)
-                            seg_acbf = np.mean(acbf[idxvox_seg])
-                            seg_rcbf = np.mean(rcbf[idxvox_seg])
-                            seg_nvox = np.sum(idxvox_seg)
-                            seg_name = roi_lst[ii]
-                            fid.write(
-                                f"{ii+1}\t{seg_name}\t{seg_acbf:.2f}\t{seg_rcbf:.2f}\t{seg_nvox}\n"
-                            )
-                        fid.write("\n\n")
-
-                    # Process all ROIs (full list)
-                    fid.write(coltitle.format(label_num))
-                    fid.write(colnames)
-                    for ii in range(label_num):
-                        idxvox_seg = np.squeeze(mskv == (ii + 1)) & (msk1 > 0.5)
-                        seg_acbf = np.mean(acbf[idxvox_seg])
-                        seg_rcbf = np.mean(rcbf[idxvox_seg])
-                        seg_nvox = np.sum(idxvox_seg)
-                        seg_name = roi_lists_info[2]["list"][ii][1]
-                        fid.write(
-                            f"{ii+1}\t{seg_name}\t{seg_acbf:.2f}\t{seg_rcbf:.2f}\t{seg_nvox}\n"
-                        )
+                            self._write_row(fid, ii, names[ii], seg)
+                        if tt < len(levels):
+                            fid.write("\n\n")
+
+                if params.get("results_db"):
+                    self._store_results(params["results_db"], key, asl_file, tables)
+
+    @staticmethod
+    def _write_row(fid, ii: int, seg_name: str, stats: dict) -> None:
+        seg_acbf, seg_rcbf = stats["mean"][:, ii + 1]
+        seg_nvox = stats["count"][ii + 1]
+        fid.write(f"{ii+1}\t{seg_name}\t{seg_acbf:.2f}\t{seg_rcbf:.2f}\t{seg_nvox}\n")
+
+    @staticmethod
+    def _store_results(db: str, key: str, asl_file: str, tables: list) -> None:
+        subject, session = session_ids(key)
+        with ResultsStore(resolve_db_path(db, key)) as store:
+            store.set_roi_stats(subject, session, asl_file, [
+                (seg_num, names[:seg_num], seg["mean"][0, 1:], seg["mean"][1, 1:], seg["count"][1:])
+                for seg_num, names, seg in tables
+            ])
@@ -6,6 +6,7 @@ Run Oxford ASL pipeline.
 import os, subprocess
 from typing import List, Tuple, Optional
 import logging
+from pyasl.utils.parallel import external_job_slot
 logger = logging.getLogger(__name__)
 
 def _first_images_entry(dd):
@@ -284,7 +285,8 @@ class OxfordASLRun:
         e["TMPDIR"] = tmpdir
 
         print("[oxford_asl]", " ".join(cmd))
-        subprocess.run(cmd, check=True, env=e)
+        with external_job_slot():
+            subprocess.run(cmd, check=True, env=e)
 
     def run(self, data_descrip: dict, params: dict):
         """
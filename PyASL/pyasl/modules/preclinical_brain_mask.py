@@ -6,7 +6,7 @@ Create in-brain mask using mricloud_inbrain if available.
 
 import numpy as np, os
 from pyasl.utils.plotting import get_plot_array, plot_save_fig
-from scipy.ndimage import binary_erosion, binary_dilation, binary_fill_holes, label
+from pyasl.utils.mricloud_helpers import mricloud_inbrain
 import logging
 logger = logging.getLogger(__name__)
 
@@ -34,45 +34,8 @@ class BrainMask():
         The resulting mask is stored in ctx["BrainMask"].
     """
     def mricloud_inbrain(self, imgvol: np.ndarray, thre: float, ero_lyr: int, dlt_lyr: int):
-        lowb = 0.25
-        highb = 0.75
+        return mricloud_inbrain(imgvol, thre, ero_lyr, dlt_lyr)
 
-        Nx, Ny, Nz = imgvol.shape
-        tmpmat = imgvol[
-            round(Nx * lowb) : round(Nx * highb),
-            round(Ny * lowb) : round(Ny * highb),
-            round(Nz * lowb) : round(Nz * highb),
-        ]
-        tmpvox = tmpmat[tmpmat > 0]
-        thre0 = np.mean(tmpvox) * thre
-
-        mask1 = np.zeros_like(imgvol)
-        mask1[imgvol > thre0] = 1
-
-        mask2 = np.zeros_like(mask1)
-        se = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]])
-        for ii in range(Nz):
-            slice0 = mask1[:, :, ii]
-            slice1 = slice0
-            for ie in range(ero_lyr):
-                slice1 = binary_erosion(slice1, structure=se)
-
-            labeled_array, num_features = label(slice1, structure=se)
-            sizes = np.bincount(labeled_array.ravel())
-            sizes[0] = 0
-            max_label = sizes.argmax()
-            slice2 = np.zeros_like(slice1)
-            slice2[labeled_array == max_label] = 1
-
-            slice2 = binary_fill_holes(slice2)
-            for id in range(dlt_lyr):
-                slice2 = binary_dilation(slice2, structure=se)
-
-            mask2[:, :, ii] = slice2
-
-        brainmask = mask2.astype(np.uint8)
-        return brainmask
-    
     def run(self, ctx, **p):
         savedir = ctx.get_required("savedir")
         ctr = ctx.get_required("ImageCtr")
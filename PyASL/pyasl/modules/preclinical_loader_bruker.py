@@ -18,7 +18,10 @@ class BrukerLoader():
       expno: (int) exp number; if omitted, choose the latest automatically
       savedir: optional output dir; default Results_<rootname>/<expno>
       procno: default 1
-    writes: Image (X,Y,Z,NR,1), Para, savedir, meta
+      dtype: image dtype after slope/offset scaling (default float32)
+      target: "Image" (default) or "AbsData" (frames flattened to (X,Y,N),
+              as read by AbsCBF_T1Fit)
+    writes: Image (X,Y,Z,NR,1) or AbsData (X,Y,N), Para, savedir, meta
     """
     def run(self, ctx, **p):
         logger.info("Loading BRUKER 2dseq pCASL dataset ...")
@@ -30,7 +33,8 @@ class BrukerLoader():
             if not nums:
                 raise ValueError("No numeric expno found under root")
             expno = nums[-1]
-        img, NX, NY, NI, NR, ch = read_2dseq_v3(root, int(expno), procno)
+        dtype = np.dtype(p.get("dtype", "float32"))
+        img, NX, NY, NI, NR, ch = read_2dseq_v3(root, int(expno), procno, dtype=dtype)
         filename = os.path.join(root, str(expno))
         Para = W_ImgParaAbs(filename); Para["expno"] = expno
 
@@ -45,8 +49,14 @@ class BrukerLoader():
                 savedir = f"{base}_{k}"; k+=1
         os.makedirs(savedir, exist_ok=True)
 
+        target = p.get("target", "Image")
+        if target == "AbsData":
+            img = img.reshape(img.shape[0], img.shape[1], -1)
+        elif target != "Image":
+            raise ValueError("target must be 'AbsData' or 'Image'")
+
         ctx.update({
-            "Image": img,
+            target: img,
             "Para": Para,
             "savedir": savedir,
             "meta": {"NX": NX, "NY": NY, "NI": NI, "NR": NR, "channels": ch},
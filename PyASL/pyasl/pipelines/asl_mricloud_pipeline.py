@@ -18,8 +18,26 @@ config_path : str
 Behavior
 --------
 - Loads a data description from `root`.
-- Iterates `steps` in order and calls each module's `.run(data_descrip, params)`.
+- Iterates `steps` in order and calls each module's `.run(data_descrip, params)`;
+  relative paths in step params are taken from `root`.
 - Writes module results below `root/derivatives` (module-dependent).
+- With a top-level `parallel: {n_jobs: N, max_external_jobs: M}` block,
+  sessions run concurrently in N processes with at most M SPM jobs at a
+  time; failed sessions are reported once all sessions have finished.
+  Steps run with `n_jobs: 1` inside session workers.
+- Derivatives passed between steps (difference maps, M0 map, brain masks,
+  native CBF maps) are kept in memory and written asynchronously; set
+  `derivative_store: {enabled: false}` to use plain file I/O, or tune the
+  in-memory budget with `max_memory_mb` (default 1024).
+- `image_cache_mb: N` keeps up to N MB of decoded input images (masks, M0
+  maps) in memory so repeated `load_img` calls skip the decode.
+- SPM NewSegment results used for brain masks (c1-c3 maps and the derived
+  masks) are cached under `derivatives/.pyasl_cache/segment`, keyed on the
+  image and TPM contents and the segmentation settings, so repeated or
+  resumed runs skip the segmentation. Disable with `segment_cache: false`.
+- `spm: {batch: true}` runs the SPM jobs of a step (Realign, CoregMPR) for
+  all sessions in one MATLAB session instead of one MATLAB start per
+  session; the measured start-up time saved is logged.
 
 Logging
 -------
@@ -32,18 +50,17 @@ from __future__ import annotations
 import os
 import yaml
 import logging
-
-from pyasl.modules.mricloud_rescale import MRICloudRescale
-from pyasl.modules.asltbx_realign import Realign
-from pyasl.modules.mricloud_calculate_diffmap import MRICloudCalculateDiffmap
-from pyasl.modules.mricloud_calculate_M0 import MRICloudCalculateM0
-from pyasl.modules.mricloud_calculate_CBF import MRICloudCalculateCBF
-from pyasl.modules.mricloud_multidelay_calculate_M0 import MRICloudMultidelayCalculateM0
-from pyasl.modules.mricloud_multidelay_calculate_CBFATT import MRICloudMultidelayCalculateCBFATT
-from pyasl.modules.mricloud_read_mpr import MRICloudReadMPR
-from pyasl.modules.mricloud_coreg_mpr import MRICloudCoregMPR
-from pyasl.modules.mricloud_t1roi_CBFaverage import MRICloudT1ROICBFAverage
-from pyasl.utils.utils import read_data_description
+from pathlib import Path
+from contextlib import nullcontext
+from functools import partial
+
+from pyasl.utils.utils import read_data_description, set_image_cache, log_image_cache_stats
+from pyasl.utils.lazy import LazyStepMap
+from pyasl.utils.parallel import resolve_n_jobs, run_sessions, session_params
+from pyasl.utils.paths import resolve_paths
+from pyasl.utils.derivative_store import DerivativeStore, flush_active_store
+from pyasl.utils.mricloud_helpers import set_segment_cache, segment_cache_stats
+from pyasl.utils.spm_batch import set_spm_batch, log_spm_batch_stats
 
 logger = logging.getLogger(__name__)
 
@@ -54,18 +71,44 @@ def load_config(path: str) -> dict:
         return yaml.safe_load(f)
 
 
-MRI_CLOUD_MODULE_MAP = {
-    "MRICloudRescale": MRICloudRescale(),
-    "Realign": Realign(),  # reuse SPM Realign module
-    "MRICloudCalculateDiffmap": MRICloudCalculateDiffmap(),
-    "MRICloudCalculateM0": MRICloudCalculateM0(),
-    "MRICloudCalculateCBF": MRICloudCalculateCBF(),
-    "MRICloudMultidelayCalculateM0": MRICloudMultidelayCalculateM0(),
-    "MRICloudMultidelayCalculateCBFATT": MRICloudMultidelayCalculateCBFATT(),
-    "MRICloudReadMPR": MRICloudReadMPR(),
-    "MRICloudCoregMPR": MRICloudCoregMPR(),
-    "MRICloudT1ROICBFAverage": MRICloudT1ROICBFAverage(),
-}
+MRI_CLOUD_MODULE_MAP = LazyStepMap({
+    "MRICloudRescale": ("pyasl.modules.mricloud_rescale", "MRICloudRescale"),
+    "Realign": ("pyasl.modules.asltbx_realign", "Realign"),  # reuse SPM Realign module
+    "MRICloudCalculateDiffmap": ("pyasl.modules.mricloud_calculate_diffmap", "MRICloudCalculateDiffmap"),
+    "MRICloudCalculateM0": ("pyasl.modules.mricloud_calculate_M0", "MRICloudCalculateM0"),
+    "MRICloudCalculateCBF": ("pyasl.modules.mricloud_calculate_CBF", "MRICloudCalculateCBF"),
+    "MRICloudMultidelayCalculateM0": ("pyasl.modules.mricloud_multidelay_calculate_M0", "MRICloudMultidelayCalculateM0"),
+    "MRICloudMultidelayCalculateCBFATT": ("pyasl.modules.mricloud_multidelay_calculate_CBFATT", "MRICloudMultidelayCalculateCBFATT"),
+    "MRICloudReadMPR": ("pyasl.modules.mricloud_read_mpr", "MRICloudReadMPR"),
+    "MRICloudCoregMPR": ("pyasl.modules.mricloud_coreg_mpr", "MRICloudCoregMPR"),
+    "MRICloudT1ROICBFAverage": ("pyasl.modules.mricloud_t1roi_CBFaverage", "MRICloudT1ROICBFAverage"),
+})
+
+
+def _run_steps(data_descrip: dict, steps: list, store: dict = None) -> None:
+    """Run the configured steps in order on `data_descrip`."""
+    store = store or {}
+    if store.get("enabled", True):
+        io_ctx = DerivativeStore(max_memory_mb=store.get("max_memory_mb", 1024))
+    else:
+        io_ctx = nullcontext()
+
+    with io_ctx:
+        for step in steps:
+            name = step.get("name")
+            params = step.get("params", {}) or {}
+            logger.info(">>> Running step: %s", name)
+            logger.debug("Step params: %s", params)
+
+            mod = MRI_CLOUD_MODULE_MAP.get(name)
+            if mod is None:
+                logger.error("Unknown step: %s", name)
+                raise ValueError(f"Unknown step: {name}")
+
+            mod.run(data_descrip, params)
+            # Steps may read earlier outputs straight from disk (nib.load,
+            # os.path.exists), so finish pending writes between steps
+            flush_active_store()
 
 
 def run_mricloud_pipeline(root: str, config_path: str) -> None:
@@ -86,20 +129,40 @@ def run_mricloud_pipeline(root: str, config_path: str) -> None:
     if not steps:
         logger.error("Config has no `steps`.")
         raise ValueError("Config must include a top-level `steps` list.")
-
-    for step in steps:
-        name = step.get("name")
-        params = step.get("params", {}) or {}
-        logger.info(">>> Running step: %s", name)
-        logger.debug("Step params: %s", params)
-
-        mod = MRI_CLOUD_MODULE_MAP.get(name)
-        if mod is None:
-            logger.error("Unknown step: %s", name)
-            raise ValueError(f"Unknown step: {name}")
-
-        mod.run(data_descrip, params)
+    # Relative paths in step params are taken from the dataset root
+    base = Path(root).resolve()
+    steps = [{**step, "params": resolve_paths(step.get("params") or {}, base)} for step in steps]
+
+    store = config.get("derivative_store")
+    store = {"enabled": store} if isinstance(store, bool) else (store or {})
+
+    if config.get("image_cache_mb") is not None:
+        set_image_cache(config["image_cache_mb"])
+    set_segment_cache(config.get("segment_cache", True))
+    set_spm_batch((config.get("spm") or {}).get("batch", False))
+
+    parallel = config.get("parallel") or {}
+    n_jobs = parallel.get("n_jobs", 1)
+    if resolve_n_jobs(n_jobs) > 1 and len(data_descrip.get("Images", {})) > 1:
+        unknown = [step.get("name") for step in steps if step.get("name") not in MRI_CLOUD_MODULE_MAP]
+        if unknown:
+            raise ValueError(f"Unknown step: {unknown[0]}")
+        failures = run_sessions(
+            partial(_run_steps, steps=[{**step, "params": session_params(step["params"])} for step in steps], store=store),
+            data_descrip,
+            n_jobs=n_jobs,
+            max_external_jobs=parallel.get("max_external_jobs"),
+        )
+        if failures:
+            raise RuntimeError(f"{len(failures)} session(s) failed: {', '.join(failures)}")
+    else:
+        _run_steps(data_descrip, steps, store)
 
     outdir = os.path.join(root, "derivatives")
+    log_image_cache_stats()
+    seg = segment_cache_stats()
+    if seg["hits"] or seg["misses"]:
+        logger.info("Segmentation cache: %d hits, %d misses.", seg["hits"], seg["misses"])
+    log_spm_batch_stats()
     logger.info("MRICloud modular pipeline completed.")
     logger.info("See results under %s", outdir)
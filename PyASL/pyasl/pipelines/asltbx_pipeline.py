@@ -14,6 +14,19 @@ root : str
 config_path : str
     Path to YAML configuration file.
 
+An optional top-level `parallel: {n_jobs: N, max_external_jobs: M}` block
+runs sessions concurrently in N processes with at most M SPM jobs at a
+time; failed sessions are reported once all sessions have finished. Steps
+run with `n_jobs: 1` inside session workers. Relative paths in step params
+are taken from `root`.
+
+A top-level `image_cache_mb: N` keeps up to N MB of decoded input images in
+memory so repeated `load_img` calls skip the decode.
+
+With `spm: {batch: true}` the SPM jobs of a step (Realign, Coregister,
+Smooth) for all sessions run in one MATLAB session instead of one MATLAB
+start per session; the measured start-up time saved is logged.
+
 Logging
 -------
 INFO:  pipeline start/end, per-step start.
@@ -25,14 +38,14 @@ from __future__ import annotations
 import os
 import yaml
 import logging
+from pathlib import Path
+from functools import partial
 
-from pyasl.modules.asltbx_reset_orientation import ResetOrientation
-from pyasl.modules.asltbx_realign import Realign
-from pyasl.modules.asltbx_coregister import Coregister
-from pyasl.modules.asltbx_smooth import Smooth
-from pyasl.modules.asltbx_create_mask import CreateMask
-from pyasl.modules.asltbx_perfusion_quantify import PerfusionQuantify
-from pyasl.utils.utils import read_data_description
+from pyasl.utils.utils import read_data_description, set_image_cache, log_image_cache_stats
+from pyasl.utils.lazy import LazyStepMap
+from pyasl.utils.parallel import resolve_n_jobs, run_sessions, session_params
+from pyasl.utils.paths import resolve_paths
+from pyasl.utils.spm_batch import set_spm_batch, log_spm_batch_stats
 
 logger = logging.getLogger(__name__)
 
@@ -43,14 +56,30 @@ def load_config(path: str) -> dict:
         return yaml.safe_load(f)
 
 
-MODULE_MAP = {
-    "ResetOrientation": ResetOrientation(),
-    "Realign": Realign(),
-    "Coregister": Coregister(),
-    "Smooth": Smooth(),
-    "CreateMask": CreateMask(),
-    "PerfusionQuantify": PerfusionQuantify(),
-}
+MODULE_MAP = LazyStepMap({
+    "ResetOrientation": ("pyasl.modules.asltbx_reset_orientation", "ResetOrientation"),
+    "Realign": ("pyasl.modules.asltbx_realign", "Realign"),
+    "Coregister": ("pyasl.modules.asltbx_coregister", "Coregister"),
+    "Smooth": ("pyasl.modules.asltbx_smooth", "Smooth"),
+    "CreateMask": ("pyasl.modules.asltbx_create_mask", "CreateMask"),
+    "PerfusionQuantify": ("pyasl.modules.asltbx_perfusion_quantify", "PerfusionQuantify"),
+})
+
+
+def _run_steps(data_descrip: dict, steps: list) -> None:
+    """Run the configured steps in order on `data_descrip`."""
+    for step in steps:
+        name = step.get("name")
+        params = step.get("params", {}) or {}
+        logger.info(">>> Running step: %s", name)
+        logger.debug("Step params: %s", params)
+
+        mod = MODULE_MAP.get(name)
+        if mod is None:
+            logger.error("Unknown step: %s", name)
+            raise ValueError(f"Unknown step: {name}")
+
+        mod.run(data_descrip, params)
 
 
 def run_pipeline(root: str, config_path: str) -> None:
@@ -71,20 +100,33 @@ def run_pipeline(root: str, config_path: str) -> None:
     if not steps:
         logger.error("Config has no `steps`.")
         raise ValueError("Config must include a top-level `steps` list.")
-
-    for step in steps:
-        name = step.get("name")
-        params = step.get("params", {}) or {}
-        logger.info(">>> Running step: %s", name)
-        logger.debug("Step params: %s", params)
-
-        mod = MODULE_MAP.get(name)
-        if mod is None:
-            logger.error("Unknown step: %s", name)
-            raise ValueError(f"Unknown step: {name}")
-
-        mod.run(data_descrip, params)
+    # Relative paths in step params are taken from the dataset root
+    base = Path(root).resolve()
+    steps = [{**step, "params": resolve_paths(step.get("params") or {}, base)} for step in steps]
+
+    if config.get("image_cache_mb") is not None:
+        set_image_cache(config["image_cache_mb"])
+    set_spm_batch((config.get("spm") or {}).get("batch", False))
+
+    parallel = config.get("parallel") or {}
+    n_jobs = parallel.get("n_jobs", 1)
+    if resolve_n_jobs(n_jobs) > 1 and len(data_descrip.get("Images", {})) > 1:
+        unknown = [step.get("name") for step in steps if step.get("name") not in MODULE_MAP]
+        if unknown:
+            raise ValueError(f"Unknown step: {unknown[0]}")
+        failures = run_sessions(
+            partial(_run_steps, steps=[{**step, "params": session_params(step["params"])} for step in steps]),
+            data_descrip,
+            n_jobs=n_jobs,
+            max_external_jobs=parallel.get("max_external_jobs"),
+        )
+        if failures:
+            raise RuntimeError(f"{len(failures)} session(s) failed: {', '.join(failures)}")
+    else:
+        _run_steps(data_descrip, steps)
 
     outdir = os.path.join(root, "asltbx", "derivatives")
+    log_image_cache_stats()
+    log_spm_batch_stats()
     logger.info("ASL Toolbox pipeline completed.")
     logger.info("See results under %s", outdir)
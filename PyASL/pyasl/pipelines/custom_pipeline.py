@@ -12,10 +12,16 @@ Implements a flexible YAML-driven pipeline for ASL data processing.
 from __future__ import annotations
 import importlib
 import logging
+from functools import partial
 from pathlib import Path
 from typing import Any, Dict, Optional
 import yaml
 
+from pyasl.utils.parallel import resolve_n_jobs, run_sessions, session_params
+from pyasl.utils.paths import resolve_paths
+from pyasl.utils.step_cache import StepCache
+from pyasl.utils.spm_batch import set_spm_batch, log_spm_batch_stats
+
 logger = logging.getLogger(__name__)
 
 
@@ -57,46 +63,6 @@ def _normkey(s: str) -> str:
     return "".join(ch for ch in s.lower() if ch.isalnum())
 
 
-# Keys that likely refer to paths (used by _resolve_paths)
-_PATHY_KEYS = {
-    "path", "paths", "in", "infile", "infiles", "outfile", "out", "dir",
-    "savedir", "basedir", "root", "mask", "anat", "asl", "m0", "log", "logdir"
-}
-
-
-def _looks_like_path(s: str) -> bool:
-    """Heuristically decide if a string looks like a file path."""
-    return any(t in s for t in ("/", "\\", ".nii", ".nii.gz", ".img", ".hdr"))
-
-
-def _resolve_one(s: str, base: Path) -> str:
-    """Resolve a single path against a base directory."""
-    if "{root}" in s or "${root}" in s:
-        s = s.replace("${root}", "{root}").format(root=str(base))
-    p = Path(s)
-    return str(p if p.is_absolute() else (base / p).resolve())
-
-
-def _resolve_paths(obj: Any, base: Path, parent: Optional[str] = None) -> Any:
-    """
-    Recursively resolve paths in a dict/list/str.
-
-    Any value whose key is in `_PATHY_KEYS` or looks like a path
-    will be converted to an absolute path.
-    """
-    if isinstance(obj, dict):
-        return {k: _resolve_paths(v, base, k) for k, v in obj.items()}
-    if isinstance(obj, list):
-        return [_resolve_paths(v, base, parent) for v in obj]
-    if isinstance(obj, str):
-        if (parent and parent in _PATHY_KEYS) or _looks_like_path(obj):
-            try:
-                return _resolve_one(obj, base)
-            except Exception:
-                return obj
-    return obj
-
-
 def _inject_from_meta(obj: Any, ctx: Context, parent: Optional[str] = None) -> Any:
     """
     Replace 'from_meta' tokens in a structure with values from Context.
@@ -186,12 +152,22 @@ def _read_data_description_safe(root: Path):
         return {}
 
 
+def _run_dict_steps(data_desc: dict, steps: list, verbose: bool = True) -> None:
+    """Run resolved dict-style steps `(name, params)` on one data description."""
+    for i, (name, params) in enumerate(steps, 1):
+        inst, shown, _, _ = _resolve_impl(name)
+        if verbose:
+            logger.info(">>> [%d/%d] %s", i, len(steps), shown)
+        inst.run(data_desc, params)
+
+
 def run_custom_pipeline(
     data_dir: str,
     config_path: str,
     *,
     ctx: Optional[Context] = None,
     verbose: bool = True,
+    force: bool = False,
 ) -> Context:
     """
     Execute a custom ASL processing pipeline defined in a YAML file.
@@ -207,6 +183,8 @@ def run_custom_pipeline(
         Existing context to pass through steps (default: new).
     verbose : bool, default=True
         If True, print progress messages.
+    force : bool, default=False
+        Re-run every step even if the step cache holds a valid result.
 
     Returns
     -------
@@ -223,6 +201,19 @@ def run_custom_pipeline(
     Each YAML step must specify:
       - `module` / `name` / `class` : class name or FQCN
       - `params` : optional keyword arguments.
+
+    A top-level `parallel: {n_jobs, max_external_jobs}` block runs the
+    sessions of `data_description.json` concurrently. This needs every step
+    to be dict-style; pipelines with context (kwargs) steps run serially.
+
+    A top-level `cache: {max_size_mb}` block (or `cache: true`) enables the
+    step cache in `derivatives/.pyasl_cache` (serial runs only). A step whose
+    name, params, input files and upstream results are unchanged is skipped
+    and its derivatives, context entries and data-description edits are
+    restored from the cache.
+
+    A top-level `spm: {batch: true}` block runs the SPM jobs of a dict-style
+    step for all sessions in one MATLAB session.
     """
     conf = _load_yaml(config_path)
     steps = conf.get("steps") or []
@@ -242,6 +233,44 @@ def run_custom_pipeline(
 
     # Optional: load a data description for modules needing metadata
     data_desc = _read_data_description_safe(root)
+    set_spm_batch((conf.get("spm") or {}).get("batch", False))
+
+    parallel = conf.get("parallel") or {}
+    n_jobs = parallel.get("n_jobs", 1)
+    if resolve_n_jobs(n_jobs) > 1 and len(data_desc.get("Images", {})) > 1:
+        resolved = []
+        for i, step in enumerate(steps, 1):
+            name = step.get("module") or step.get("name") or step.get("class")
+            if not name:
+                raise ValueError(f"Step #{i} missing 'module'/'name'/'class'")
+            _, _, style, _ = _resolve_impl(name)
+            if style != "dict":
+                resolved = None
+                break
+            params = _inject_from_meta(resolve_paths(step.get("params", {}) or {}, root), C)
+            if isinstance(params, dict):
+                params = session_params({k: v for k, v in params.items() if k != "root"})
+            resolved.append((name, params))
+
+        if resolved is None:
+            logger.warning("Pipeline has context (kwargs) steps; running sessions serially.")
+        else:
+            if conf.get("cache"):
+                logger.warning("The step cache is not used for parallel session runs.")
+            failures = run_sessions(
+                partial(_run_dict_steps, steps=resolved, verbose=verbose),
+                data_desc,
+                n_jobs=n_jobs,
+                max_external_jobs=parallel.get("max_external_jobs"),
+            )
+            if failures:
+                raise RuntimeError(f"{len(failures)} session(s) failed: {', '.join(failures)}")
+            if verbose:
+                logger.info("CUSTOM pipeline completed.")
+            return C
+
+    cache = StepCache.from_config(root, conf.get("cache"), force=force)
+    digest = cache.initial_digest(data_desc) if cache else None
 
     # Iterate over pipeline steps
     for i, step in enumerate(steps, 1):
@@ -252,7 +281,7 @@ def run_custom_pipeline(
         raw_params = step.get("params", {}) or {}
 
         # 1) Expand relative paths
-        params = _resolve_paths(raw_params, root)
+        params = resolve_paths(raw_params, root)
         # 2) Replace "from_meta" tokens with context values
         params = _inject_from_meta(params, C)
 
@@ -266,6 +295,16 @@ def run_custom_pipeline(
             logger.info(">>> [%d/%d] %s", i, len(steps), shown)
         logger.debug("Step params: %s", params)
 
+        if cache is not None:
+            key = cache.step_key(name, style, params, digest)
+            entry = cache.lookup(key)
+            if entry is not None:
+                digest = cache.restore(key, entry, C, data_desc)
+                if verbose:
+                    logger.info("    %s unchanged; restored from cache.", shown)
+                continue
+            token = cache.begin_step(C, data_desc)
+
         # Call step with appropriate interface style
         if style == "kwargs":
             inst.run(C, **params)
@@ -277,6 +316,10 @@ def run_custom_pipeline(
         else:
             raise RuntimeError(f"Unknown call style: {style}")
 
+        if cache is not None:
+            digest = cache.end_step(key, name, token, C, data_desc)
+
+    log_spm_batch_stats()
     if verbose:
         logger.info("CUSTOM pipeline completed.")
     return C
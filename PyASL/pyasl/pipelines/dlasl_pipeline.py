@@ -17,7 +17,8 @@ config_path : str
 Notes
 -----
 Each step is invoked as `module.run(data_descrip, params)`.
-`params["root"]` is injected when absent for convenience.
+`params["root"]` is injected when absent for convenience; other relative
+paths (`weights_dir`, `mask_path`, ...) are taken from `root`.
 
 Logging
 -------
@@ -30,10 +31,11 @@ from __future__ import annotations
 import os
 import yaml
 import logging
+from pathlib import Path
 
 from pyasl.utils.utils import read_data_description
-from pyasl.modules.dlasl_build_mask import DLASLBuildMask
-from pyasl.modules.dlasl_denoise_cbf import DLASLDenoiseCBF
+from pyasl.utils.lazy import LazyStepMap
+from pyasl.utils.paths import resolve_paths
 
 logger = logging.getLogger(__name__)
 
@@ -44,10 +46,10 @@ def load_config(path: str) -> dict:
         return yaml.safe_load(f)
 
 
-DLASL_MODULE_MAP = {
-    "DLASLBuildMask": DLASLBuildMask(),
-    "DLASLDenoiseCBF": DLASLDenoiseCBF(),
-}
+DLASL_MODULE_MAP = LazyStepMap({
+    "DLASLBuildMask": ("pyasl.modules.dlasl_build_mask", "DLASLBuildMask"),
+    "DLASLDenoiseCBF": ("pyasl.modules.dlasl_denoise_cbf", "DLASLDenoiseCBF"),
+})
 
 
 def run_dlasl_pipeline(root: str, config_path: str) -> None:
@@ -69,9 +71,10 @@ def run_dlasl_pipeline(root: str, config_path: str) -> None:
         logger.error("Config has no `steps`.")
         raise ValueError("Config must include a top-level `steps` list.")
 
+    base = Path(root).resolve()
     for step in steps:
         name = step.get("name")
-        params = step.get("params", {}) or {}
+        params = resolve_paths(step.get("params", {}) or {}, base)
         params.setdefault("root", root)
 
         logger.info(">>> Running step: %s", name)
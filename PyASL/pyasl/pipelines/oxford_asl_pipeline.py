@@ -27,8 +27,7 @@ import logging
 from typing import Dict, Optional
 
 from pyasl.utils.utils import read_data_description
-from pyasl.modules.oxford_asl_split_m0 import OxfordASLSplitM0
-from pyasl.modules.oxford_asl_run import OxfordASLRun
+from pyasl.utils.lazy import LazyStepMap
 
 logger = logging.getLogger(__name__)
 
@@ -39,10 +38,10 @@ def load_config(path: str) -> dict:
         return yaml.safe_load(f)
 
 
-OXFORD_ASL_MODULE_MAP = {
-    "OxfordASLSplitM0": OxfordASLSplitM0(),
-    "OxfordASLRun": OxfordASLRun(),
-}
+OXFORD_ASL_MODULE_MAP = LazyStepMap({
+    "OxfordASLSplitM0": ("pyasl.modules.oxford_asl_split_m0", "OxfordASLSplitM0"),
+    "OxfordASLRun": ("pyasl.modules.oxford_asl_run", "OxfordASLRun"),
+})
 
 
 def _default_env() -> Dict[str, str]:
@@ -0,0 +1,210 @@
+"""
+Preclinical batch runner.
+
+Runs the `pcasl` or `mti` pipeline of a YAML config on every matching scan of
+a Bruker study, or of a whole tree of studies. Scans are found through the
+study index (`pyasl.utils.bruker_index`), which is refreshed incrementally
+before each batch, and processed in parallel worker processes.
+
+For every scan the config's loader step (BrukerLoader/NIfTILoader, inserted
+if missing) is replaced by a BrukerLoader pointing at the scan's
+expno/procno; results go to `<study>/results/<expno>` (`<expno>_p<procno>`
+for procno > 1). All other steps run as configured.
+
+Example
+-------
+from pyasl.pipelines.preclinical_batch import run_preclinical_batch
+run_preclinical_batch("/data/bruker", "pyasl/configs/testpcasl.yaml")
+
+CLI
+---
+python -m pyasl.pipelines.preclinical_batch --root /data/bruker \
+    --config pyasl/configs/testpcasl.yaml --n-jobs 4
+
+YAML (optional block, alongside `type` and `steps`)
+---------------------------------------------------
+batch:
+  scan_types: [pCASL]     # default: [pCASL] for pcasl, [MTI, FAIR] for mti
+  protocol: "pCASL_EPI"   # optional case-insensitive protocol substring
+  n_jobs: -1              # worker processes (None/0/-1: all cores)
+  index: null             # index file (default: <root>/.pyasl_bruker_index.sqlite)
+"""
+
+from __future__ import annotations
+
+import copy
+import importlib
+import logging
+import os
+import traceback
+from typing import Any, Dict, List, Optional, Sequence
+
+import yaml
+
+from pyasl.utils.bruker_index import StudyIndex
+from pyasl.utils.parallel import resolve_n_jobs, run_tasks
+
+logger = logging.getLogger(__name__)
+
+_RUNNERS = {
+    "pcasl": ("pyasl.pipelines.preclinical_pcasl_pipeline", "run_preclinical_pcasl_pipeline"),
+    "mti": ("pyasl.pipelines.preclinical_mti_pipeline", "run_preclinical_mti_pipeline"),
+}
+
+_DEFAULT_SCAN_TYPES = {"pcasl": ["pCASL"], "mti": ["MTI", "FAIR"]}
+
+_LOADERS = ("BrukerLoader", "NIfTILoader")
+
+
+def _load_config(path: str) -> dict:
+    """Load YAML configuration from `path`."""
+    with open(path, "r") as f:
+        return yaml.safe_load(f)
+
+
+def _scan_steps(steps: list, ptype: str, scan: dict, serial: bool) -> list:
+    """Copy of `steps` with the loader pointed at `scan`."""
+    steps = copy.deepcopy(steps)
+    savedir = os.path.join(scan["study"], "results", str(scan["expno"]))
+    if scan["procno"] != 1:
+        savedir += f"_p{scan['procno']}"
+    params = {"target": "AbsData"} if ptype == "mti" else {}
+
+    pos = next(
+        (i for i, s in enumerate(steps) if (s.get("name") or s.get("module")) in _LOADERS), None
+    )
+    if pos is None:
+        steps.insert(0, {})
+        pos = 0
+    elif (steps[pos].get("name") or steps[pos].get("module")) == "BrukerLoader":
+        params.update(
+            (k, v) for k, v in (steps[pos].get("params") or {}).items()
+            if k not in ("root", "expno", "procno", "prono", "savedir")
+        )
+    params.update(
+        root=scan["study"], expno=scan["expno"], procno=scan["procno"], savedir=savedir
+    )
+    steps[pos] = {"module": "BrukerLoader", "params": params}
+
+    if not serial:
+        # one process per scan: keep voxel-parallel steps in-process
+        for step in steps:
+            if "n_jobs" in (step.get("params") or {}):
+                step["params"]["n_jobs"] = 1
+    return steps
+
+
+def _run_scan(task: dict) -> None:
+    """Run the pipeline on one scan (module level so it can be pickled)."""
+    mod_name, func_name = _RUNNERS[task["type"]]
+    runner = getattr(importlib.import_module(mod_name), func_name)
+    runner(task["study"], task["config_path"], steps=task["steps"], verbose=False)
+
+
+def run_preclinical_batch(
+    root: str,
+    config_path: str,
+    scan_types: Optional[Sequence[str]] = None,
+    protocol: Optional[str] = None,
+    n_jobs: Optional[int] = None,
+    index_path: Optional[str] = None,
+) -> Dict[str, str]:
+    """
+    Run a pcasl/mti config on every matching scan below `root`.
+
+    Arguments left as None fall back to the config's `batch` block, then to
+    the defaults documented above.
+
+    Returns
+    -------
+    dict[str, str]
+        Failed scans ("<study>/<expno>/<procno>") mapped to their tracebacks.
+    """
+    config_path = os.path.abspath(config_path)
+    conf = _load_config(config_path)
+    ptype = str(conf.get("type", "")).strip().lower()
+    if ptype not in _RUNNERS:
+        raise ValueError(f"Batch runs support types {sorted(_RUNNERS)}, got '{ptype}'")
+    steps = conf.get("steps", [])
+    if not steps:
+        logger.error("Config has no `steps`.")
+        raise ValueError("YAML must have a top-level `steps` list")
+
+    batch = conf.get("batch") or {}
+    scan_types = scan_types or batch.get("scan_types") or _DEFAULT_SCAN_TYPES[ptype]
+    protocol = protocol if protocol is not None else batch.get("protocol")
+    n_jobs = n_jobs if n_jobs is not None else batch.get("n_jobs", -1)
+    index_path = index_path or batch.get("index")
+
+    root = os.path.abspath(root)
+    with StudyIndex.open(root, index_path) as index:
+        index.refresh(root)
+        scans = index.scans(scan_type=scan_types, protocol=protocol)
+    if not scans:
+        logger.warning("No %s scans found under %s.", "/".join(scan_types), root)
+        return {}
+
+    serial = resolve_n_jobs(n_jobs) == 1 or len(scans) == 1
+    tasks: Dict[str, Any] = {
+        f"{os.path.basename(s['study'])}/{s['expno']}/{s['procno']}": {
+            "type": ptype,
+            "study": s["study"],
+            "config_path": config_path,
+            "steps": _scan_steps(steps, ptype, s, serial),
+        }
+        for s in scans
+    }
+    logger.info("Batch %s: %d scan(s) of type %s.", ptype, len(tasks), "/".join(scan_types))
+
+    if serial:
+        failures = {}
+        for key, task in tasks.items():
+            logger.info("Running scan %s ...", key)
+            try:
+                _run_scan(task)
+            except Exception:
+                failures[key] = traceback.format_exc()
+                logger.error("Scan %s failed:\n%s", key, failures[key])
+    else:
+        failures = run_tasks(_run_scan, tasks, n_jobs=n_jobs, label="scan")
+
+    logger.info("Batch %s completed: %d ok, %d failed.", ptype, len(tasks) - len(failures), len(failures))
+    return failures
+
+
+def list_scans(root: str, index_path: Optional[str] = None) -> List[dict]:
+    """Refresh the index of `root` and return all indexed scans."""
+    root = os.path.abspath(root)
+    with StudyIndex.open(root, index_path) as index:
+        index.refresh(root)
+        return index.scans()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Run a preclinical pipeline over a Bruker study tree")
+    parser.add_argument("--root", required=True, help="Bruker study or directory of studies")
+    parser.add_argument("--config", help="pcasl/mti YAML config")
+    parser.add_argument("--scan-type", action="append", help="Scan type to process (repeatable)")
+    parser.add_argument("--protocol", help="Protocol name substring")
+    parser.add_argument("--n-jobs", type=int, help="Worker processes (-1: all cores)")
+    parser.add_argument("--index", help="Index file path")
+    parser.add_argument("--list", action="store_true", help="Only refresh and print the index")
+    args = parser.parse_args()
+
+    if args.list:
+        for s in list_scans(args.root, args.index):
+            print(
+                f"{s['study']}\t{s['expno']}\t{s['procno']}\t{s['scan_type']}\t"
+                f"{s['protocol']}\t{'x'.join(map(str, s['matrix']))}\tNR={s['nr']}\tPLD={s['pld']}"
+            )
+        sys.exit(0)
+    if not args.config:
+        parser.error("--config is required unless --list is given")
+    failed = run_preclinical_batch(
+        args.root, args.config, args.scan_type, args.protocol, args.n_jobs, args.index
+    )
+    sys.exit(1 if failed else 0)
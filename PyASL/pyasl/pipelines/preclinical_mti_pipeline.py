@@ -27,9 +27,11 @@ from __future__ import annotations
 import importlib
 import logging
 import yaml
-from typing import Dict, Any, Optional
+from typing import Any, Mapping, Optional
 from pathlib import Path
 
+from pyasl.utils.lazy import LazyStepMap
+
 logger = logging.getLogger(__name__)
 
 # ----------------------------- Context -----------------------------
@@ -43,18 +45,16 @@ class Context(dict):
 
 # ------------------------------ Steps ------------------------------
 
-from pyasl.modules.preclinical_loader_nifti import NIfTILoader
-from pyasl.modules.preclinical_abs_t1fit import AbsCBF_T1Fit
-from pyasl.modules.save_outputs import SaveOutputs
 # Optional future steps:
 # from pyasl.modules.brain_mask import BrainMask
 # from pyasl.modules.motion_check import MotionCheck
 
-MODULE_MAP_MTI: Dict[str, Any] = {
-    "NIfTILoader": NIfTILoader(),
-    "AbsCBF_T1Fit": AbsCBF_T1Fit(),
-    "SaveOutputs": SaveOutputs(),
-}
+MODULE_MAP_MTI: Mapping[str, Any] = LazyStepMap({
+    "BrukerLoader": ("pyasl.modules.preclinical_loader_bruker", "BrukerLoader"),
+    "NIfTILoader": ("pyasl.modules.preclinical_loader_nifti", "NIfTILoader"),
+    "AbsCBF_T1Fit": ("pyasl.modules.preclinical_abs_t1fit", "AbsCBF_T1Fit"),
+    "SaveOutputs": ("pyasl.modules.save_outputs", "SaveOutputs"),
+})
 
 # --------------------------- Utilities -----------------------------
 
@@ -113,8 +113,9 @@ def run_preclinical_mti_pipeline(
     data_dir: str,
     config_path: str,
     ctx: Optional[Context] = None,
-    module_map: Optional[Dict[str, Any]] = None,
+    module_map: Optional[Mapping[str, Any]] = None,
     verbose: bool = True,
+    steps: Optional[list] = None,
 ) -> Context:
     """
     Execute the MTI-PASL pipeline with unified entry (data_dir, config_path).
@@ -127,14 +128,18 @@ def run_preclinical_mti_pipeline(
         Path to YAML config with a top-level `steps` list.
     ctx : Optional[Context]
         Shared context; if None a new one is created. `ctx['root']` will be set.
-    module_map : Optional[Dict[str, Any]]
+    module_map : Optional[Mapping[str, Any]]
         Override mapping from short names to module instances.
     verbose : bool
         If True, log per-step progress at INFO level.
+    steps : Optional[list]
+        Step list to run instead of the config's `steps` (used by the batch
+        runner to point the loader at one scan).
     """
     module_map = MODULE_MAP_MTI if module_map is None else module_map
     conf = _load_config(config_path)
-    steps = conf.get("steps", [])
+    if steps is None:
+        steps = conf.get("steps", [])
     if not steps:
         logger.error("Config has no `steps`.")
         raise ValueError("YAML must include a top-level `steps` list.")
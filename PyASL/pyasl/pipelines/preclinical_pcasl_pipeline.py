@@ -42,9 +42,11 @@ from __future__ import annotations
 import importlib
 import logging
 import yaml
-from typing import Dict, Any, Optional
+from typing import Any, Mapping, Optional
 from pathlib import Path
 
+from pyasl.utils.lazy import LazyStepMap
+
 logger = logging.getLogger(__name__)
 
 # ----------------------------- Context -----------------------------
@@ -58,33 +60,21 @@ class Context(dict):
 
 # ------------------------------ Steps ------------------------------
 
-from pyasl.modules.preclinical_loader_bruker import BrukerLoader
-from pyasl.modules.preclinical_loader_nifti import NIfTILoader
-from pyasl.modules.preclinical_steady_state_trim import SteadyStateTrim
-from pyasl.modules.preclinical_control_label_split import ControlLabelSplit
-from pyasl.modules.preclinical_motion_check import MotionCheck
-from pyasl.modules.preclinical_diff_image import DiffImage
-from pyasl.modules.preclinical_compute_m0 import ComputeM0
-from pyasl.modules.preclinical_slice_pld_adjust import SlicePLDAdjust
-from pyasl.modules.preclinical_cbf_relative import CBFRelative
-from pyasl.modules.preclinical_brain_mask import BrainMask
-from pyasl.modules.preclinical_abs_t1fit import AbsCBF_T1Fit
-from pyasl.modules.save_outputs import SaveOutputs
-
-MODULE_MAP: Dict[str, Any] = {
-    "BrukerLoader": BrukerLoader(),
-    "NIfTILoader": NIfTILoader(),
-    "SteadyStateTrim": SteadyStateTrim(),
-    "ControlLabelSplit": ControlLabelSplit(),
-    "MotionCheck": MotionCheck(),
-    "DiffImage": DiffImage(),
-    "ComputeM0": ComputeM0(),
-    "SlicePLDAdjust": SlicePLDAdjust(),
-    "CBFRelative": CBFRelative(),
-    "BrainMask": BrainMask(),
-    "AbsCBF_T1Fit": AbsCBF_T1Fit(),
-    "SaveOutputs": SaveOutputs(),
-}
+
+MODULE_MAP: Mapping[str, Any] = LazyStepMap({
+    "BrukerLoader": ("pyasl.modules.preclinical_loader_bruker", "BrukerLoader"),
+    "NIfTILoader": ("pyasl.modules.preclinical_loader_nifti", "NIfTILoader"),
+    "SteadyStateTrim": ("pyasl.modules.preclinical_steady_state_trim", "SteadyStateTrim"),
+    "ControlLabelSplit": ("pyasl.modules.preclinical_control_label_split", "ControlLabelSplit"),
+    "MotionCheck": ("pyasl.modules.preclinical_motion_check", "MotionCheck"),
+    "DiffImage": ("pyasl.modules.preclinical_diff_image", "DiffImage"),
+    "ComputeM0": ("pyasl.modules.preclinical_compute_m0", "ComputeM0"),
+    "SlicePLDAdjust": ("pyasl.modules.preclinical_slice_pld_adjust", "SlicePLDAdjust"),
+    "CBFRelative": ("pyasl.modules.preclinical_cbf_relative", "CBFRelative"),
+    "BrainMask": ("pyasl.modules.preclinical_brain_mask", "BrainMask"),
+    "AbsCBF_T1Fit": ("pyasl.modules.preclinical_abs_t1fit", "AbsCBF_T1Fit"),
+    "SaveOutputs": ("pyasl.modules.save_outputs", "SaveOutputs"),
+})
 
 # --------------------------- Utilities -----------------------------
 
@@ -153,15 +143,18 @@ def run_preclinical_pcasl_pipeline(
     data_dir: str,
     config_path: str,
     ctx: Optional[Context] = None,
-    module_map: Optional[Dict[str, Any]] = None,
+    module_map: Optional[Mapping[str, Any]] = None,
     verbose: bool = True,
+    steps: Optional[list] = None,
 ) -> Context:
     """
     Execute the preclinical PCASL pipeline with unified entry (data_dir, config_path).
+    `steps`, if given, replaces the config's step list (see preclinical_batch).
     """
     module_map = MODULE_MAP if module_map is None else module_map
     conf = _load_config(config_path)
-    steps = conf.get("steps", [])
+    if steps is None:
+        steps = conf.get("steps", [])
     if not steps:
         logger.error("Config has no `steps`.")
         raise ValueError("YAML must have a top-level `steps` list")
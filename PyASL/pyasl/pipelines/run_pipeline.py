@@ -41,6 +41,7 @@ YAML example
 from __future__ import annotations
 
 import importlib
+import inspect
 import logging
 import sys
 from pathlib import Path
@@ -133,12 +134,13 @@ def _resolve_runner(pipeline_type: str) -> Callable[[str, str], object]:
     )
 
 
-def run_pipeline(input_dir: str, config_path: str) -> object:
+def run_pipeline(input_dir: str, config_path: str, force: bool = False) -> object:
     """
     Main entry point.
 
     Read the YAML `type`, resolve its runner, and forward
-    (input_dir, config_path) to the target pipeline.
+    (input_dir, config_path) to the target pipeline. `force` bypasses the
+    step cache of runners that support one.
     """
     input_p = Path(input_dir)
     cfg_p = Path(config_path)
@@ -158,6 +160,10 @@ def run_pipeline(input_dir: str, config_path: str) -> object:
 
     # Forward arguments as-is
     logger.info(f"Dispatching to runner with input='{input_p}', config='{cfg_p}'")
+    if force:
+        if "force" in inspect.signature(runner).parameters:
+            return runner(str(input_p), str(cfg_p), force=True)
+        logger.warning(f"Pipeline type '{ptype}' has no step cache; ignoring --force.")
     return runner(str(input_p), str(cfg_p))
 
 
@@ -167,6 +173,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Unified ASL pipeline runner")
     parser.add_argument("--input", required=True, help="Input data directory")
     parser.add_argument("--config", required=True, help="YAML config path")
+    parser.add_argument(
+        "--force", action="store_true", help="Re-run all steps, ignoring cached results"
+    )
     args = parser.parse_args()
 
-    _ = run_pipeline(args.input, args.config)
+    _ = run_pipeline(args.input, args.config, force=args.force)
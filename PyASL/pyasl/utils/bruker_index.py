@@ -0,0 +1,261 @@
+"""
+Bruker study index.
+
+Walks a Bruker study directory (or a tree of studies) and records one row
+per reconstructed scan (expno/procno with a 2dseq and reco) in an SQLite
+database: protocol, scan type, matrix size, NR, PLD and a few timing fields
+taken from `W_ImgParaAbs`. A refresh only re-reads scans whose parameter
+files, 2dseq or reco changed since the last refresh (by mtime), and drops
+scans that disappeared.
+
+    with StudyIndex.open("/data/bruker") as index:
+        index.refresh("/data/bruker")
+        for scan in index.scans(scan_type="pCASL"):
+            print(scan["study"], scan["expno"], scan["matrix"], scan["pld"])
+
+Scan types are guessed from the method, protocol and scan names:
+"MTI", "FAIR", "pCASL", otherwise "other".
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from pyasl.utils.bruker_io import read_jcamp_entries
+from pyasl.utils.imgpara_abs import W_ImgParaAbs
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = ".pyasl_bruker_index.sqlite"
+
+# Checked in order: MTI-PASL protocols are FAIR variants, pCASL also matches "casl"
+_SCAN_TYPES = (
+    ("MTI", ("mti",)),
+    ("FAIR", ("fair",)),
+    ("pCASL", ("pcasl", "casl")),
+)
+
+_PARAM_FILES = ("acqp", "method", "visu_pars")
+# Per-processing files, under pdata/<procno>
+_PROC_FILES = ("2dseq", "reco")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    study      TEXT NOT NULL,
+    expno      INTEGER NOT NULL,
+    procno     INTEGER NOT NULL,
+    path       TEXT NOT NULL,
+    mtime_ns   INTEGER NOT NULL,
+    scan_type  TEXT NOT NULL,
+    protocol   TEXT,
+    scan_name  TEXT,
+    method     TEXT,
+    matrix     TEXT,
+    slices     INTEGER,
+    nr         INTEGER,
+    pld        REAL,
+    label_dur  REAL,
+    tr         REAL,
+    PRIMARY KEY (study, expno, procno)
+);
+CREATE INDEX IF NOT EXISTS scans_type ON scans (scan_type);
+"""
+
+_COLUMNS = (
+    "study", "expno", "procno", "path", "mtime_ns", "scan_type", "protocol",
+    "scan_name", "method", "matrix", "slices", "nr", "pld", "label_dur", "tr",
+)
+
+
+def classify_scan(*names: str) -> str:
+    """
+    Scan type ("MTI", "FAIR", "pCASL" or "other") from method/protocol names.
+
+    Names are tried in order and the first one that matches decides, so pass
+    the most specific name (the method) first.
+    """
+    for name in names:
+        text = (name or "").lower()
+        for scan_type, tokens in _SCAN_TYPES:
+            if any(tok in text for tok in tokens):
+                return scan_type
+    return "other"
+
+
+def _method_name(expno_dir: str) -> str:
+    """`##$Method` of an expno, e.g. "User:MTI_FAIR" from "<User:MTI_FAIR>"."""
+    for name, head, _ in read_jcamp_entries(os.path.join(expno_dir, "method")):
+        if name == "Method":
+            return head.strip().strip("<>")
+    return ""
+
+
+def _numeric_dirs(path: str) -> List[int]:
+    try:
+        return sorted(
+            int(d.name) for d in os.scandir(path) if d.name.isdigit() and d.is_dir()
+        )
+    except FileNotFoundError:
+        return []
+
+
+def is_study(path: str) -> bool:
+    """True if `path` holds at least one expno directory with an acqp file."""
+    return any(
+        os.path.isfile(os.path.join(path, str(e), "acqp")) for e in _numeric_dirs(path)
+    )
+
+
+def find_studies(root: str) -> List[str]:
+    """Absolute paths of all studies at or below `root` (studies are not descended into)."""
+    root = os.path.abspath(root)
+    studies = []
+    for dirpath, dirnames, _ in os.walk(root):
+        if is_study(dirpath):
+            studies.append(dirpath)
+            dirnames[:] = []
+        else:
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+    return studies
+
+
+def _scan_signatures(study: str) -> Iterator[Tuple[int, int, int]]:
+    """Yield (expno, procno, mtime_ns) for every reconstructed scan of a study."""
+    for expno in _numeric_dirs(study):
+        expno_dir = os.path.join(study, str(expno))
+        try:
+            base = max(os.stat(os.path.join(expno_dir, f)).st_mtime_ns for f in _PARAM_FILES)
+        except FileNotFoundError:
+            continue
+        for procno in _numeric_dirs(os.path.join(expno_dir, "pdata")):
+            proc_dir = os.path.join(expno_dir, "pdata", str(procno))
+            try:
+                # reco holds the word type, size and scaling 2dseq is decoded with
+                proc = max(os.stat(os.path.join(proc_dir, f)).st_mtime_ns for f in _PROC_FILES)
+            except FileNotFoundError:
+                continue
+            yield expno, procno, max(base, proc)
+
+
+def _scan_row(study: str, expno: int, procno: int, mtime_ns: int) -> tuple:
+    expno_dir = os.path.join(study, str(expno))
+    para = W_ImgParaAbs(expno_dir)
+    method = _method_name(expno_dir)
+    pld = para["aslPLD"] or para["PostLabelTime"]
+    return (
+        study, expno, procno, expno_dir, mtime_ns,
+        classify_scan(method, para["Protocol"], para["Scan"]),
+        para["Protocol"].strip("<>"), para["Scan"], method,
+        json.dumps(para["size"] or para["AcqSize"]),
+        para["slicenum"], para["NR"], pld, para["aslLD"] or para["asllabel"], para["tr"],
+    )
+
+
+class StudyIndex:
+    """SQLite index of the scans of one or more Bruker studies."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(_SCHEMA)
+
+    @classmethod
+    def open(cls, root: str, db_path: Optional[str] = None) -> "StudyIndex":
+        """Open the index stored in `db_path` (default: `root`/.pyasl_bruker_index.sqlite)."""
+        return cls(db_path or os.path.join(root, INDEX_NAME))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def refresh(self, root: str) -> Dict[str, int]:
+        """
+        Bring the index up to date for every study at or below `root`.
+
+        Returns counts of added, updated, removed and unchanged scans.
+        """
+        counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        for study in find_studies(root):
+            known = {
+                (expno, procno): mtime
+                for expno, procno, mtime in self.conn.execute(
+                    "SELECT expno, procno, mtime_ns FROM scans WHERE study = ?", (study,)
+                )
+            }
+            rows = []
+            for expno, procno, mtime_ns in _scan_signatures(study):
+                old = known.pop((expno, procno), None)
+                if old == mtime_ns:
+                    counts["unchanged"] += 1
+                    continue
+                try:
+                    rows.append(_scan_row(study, expno, procno, mtime_ns))
+                except Exception as err:
+                    logger.warning("Skipping %s/%d/pdata/%d: %s", study, expno, procno, err)
+                    if old is not None:
+                        known[(expno, procno)] = old  # drop the stale row
+                    continue
+                counts["added" if old is None else "updated"] += 1
+
+            with self.conn:
+                self.conn.executemany(
+                    f"INSERT OR REPLACE INTO scans ({', '.join(_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(_COLUMNS))})",
+                    rows,
+                )
+                self.conn.executemany(
+                    "DELETE FROM scans WHERE study = ? AND expno = ? AND procno = ?",
+                    [(study, e, p) for e, p in known],
+                )
+            counts["removed"] += len(known)
+
+        logger.info(
+            "Bruker index %s: %d added, %d updated, %d removed, %d unchanged.",
+            self.db_path, counts["added"], counts["updated"], counts["removed"], counts["unchanged"],
+        )
+        return counts
+
+    def scans(
+        self,
+        scan_type: Optional[Sequence[str] | str] = None,
+        protocol: Optional[str] = None,
+        study: Optional[str] = None,
+    ) -> List[dict]:
+        """
+        Indexed scans, ordered by study, expno and procno.
+
+        `scan_type` is one type or a list of types, `protocol` a
+        case-insensitive substring of the protocol name and `study` a study
+        path.
+        """
+        where, args = [], []
+        if scan_type is not None:
+            types = [scan_type] if isinstance(scan_type, str) else list(scan_type)
+            where.append(f"scan_type IN ({', '.join('?' * len(types))})")
+            args.extend(types)
+        if protocol:
+            where.append("instr(lower(protocol), ?) > 0")
+            args.append(protocol.lower())
+        if study:
+            where.append("study = ?")
+            args.append(os.path.abspath(study))
+        sql = f"SELECT {', '.join(_COLUMNS)} FROM scans"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY study, expno, procno"
+
+        out = []
+        for row in self.conn.execute(sql, args):
+            scan = dict(zip(_COLUMNS, row))
+            scan["matrix"] = json.loads(scan["matrix"]) if scan["matrix"] else []
+            out.append(scan)
+        return out
@@ -1,69 +1,151 @@
-import os, struct, re
+import os, re
 import numpy as np
 
-def read_nmr_par(filename: str):
-    # Reads BRUKER parameter files to a dictionary
+_NUM_START = frozenset("-0123456789")
+
+# (path, mtime_ns, size) -> parsed entries, shared by all readers
+_JCAMP_CACHE = {}
+_JCAMP_CACHE_MAX = 8192
+# id(entries) -> (entries, converted dict) for read_nmr_par
+_NMR_PAR_CACHE = {}
+
+
+def read_jcamp_entries(filename: str):
+    """
+    Tokenize a JCAMP-DX parameter file in one pass (cached per file version).
+
+    Returns a tuple of ``(name, head, lines)`` entries in file order, where
+    `head` is the text after ``=`` on the ``##$NAME=`` line and `lines` are
+    the continuation lines that follow it. ``$$`` stamp lines are collected
+    under the name ``"$$"``.
+    """
     try:
-        with open(filename, "r") as file:
-            lines = file.readlines()
+        st = os.stat(filename)
     except FileNotFoundError:
         raise FileNotFoundError(f"Could not open file: {filename}")
+    key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+    entries = _JCAMP_CACHE.get(key)
+    if entries is not None:
+        return entries
+
+    with open(filename, "r") as file:
+        text = file.read()
+
+    chunks = ("\n" + text).split("\n##")
+    entries = []
+    stamps = [line[2:] for line in chunks[0].splitlines() if line.startswith("$$")]
+    # One chunk per "##" record: header line followed by its continuation lines
+    for chunk in chunks[1:]:
+        header, _, rest = chunk.partition("\n")
+        name, sep, head = header.lstrip("$").partition("=")
+        lines = ()
+        if rest:
+            lines = tuple(line for line in rest.split("\n") if line and line[0] not in "$#")
+            if "$$" in rest:
+                stamps.extend(line[2:] for line in rest.splitlines() if line.startswith("$$"))
+        if sep:
+            entries.append((name, head.rstrip("\r"), lines))
+        elif lines and entries:
+            # "##" line without "=": its continuation lines belong to the previous record
+            prev = entries[-1]
+            entries[-1] = (prev[0], prev[1], prev[2] + lines)
+
+    entries = tuple(entries)
+    if stamps:
+        entries += (("$$", "", tuple(stamps)),)
+    if len(_JCAMP_CACHE) >= _JCAMP_CACHE_MAX:
+        _JCAMP_CACHE.clear()
+    _JCAMP_CACHE[key] = entries
+    return entries
+
+
+def _convert(value):
+    """Numeric strings -> float, whitespace-separated numbers -> list of floats."""
+    if not isinstance(value, str) or not value or value[0] not in _NUM_START:
+        return value
+    try:
+        nums = [float(x) for x in value.split()]
+    except ValueError:
+        return value
+    return nums[0] if len(nums) == 1 else nums
+
+
+def _split_dims(head: str):
+    """Return the value text after a numeric "( n )" header, or None."""
+    h = head[1:] if head.startswith(" (") else head
+    if h.startswith("("):
+        close = h.find(")")
+        if close > 1 and h[1:close].replace(" ", "").replace(".", "").isdigit():
+            return h[close + 1:]
+    return None
 
-    regex_patterns = [
-        (r"^##\$*(.+)=\ ?\([\ \d\.]+\)(.+)", "ParVecVal"),
-        (r"^##\$*(.+)=\ ?\([\ \d\.]+\)$", "ParVec"),
-        (r"^##\$*(.+)=\ ?(.+)", "ParVal"),
-        (r"^([^\$#].*)", "Val"),
-        (r"^\$\$(.*)", "Stamp"),
-        (r"^##\$*(.+)=$", "EmptyPar"),
-        (r"^(.+)", "Anything"),
-    ]
-
-    type_of_row = []
-    for line in lines:
-        for pattern, type_name in regex_patterns:
-            match = re.match(pattern, line)
-            if match:
-                type_of_row.append((type_name, match.groups()))
-                break
+
+def _parse_nmr_par(filename: str) -> dict:
+    entries = read_jcamp_entries(filename)
+    cached = _NMR_PAR_CACHE.get(id(entries))
+    if cached is not None and cached[0] is entries:
+        return cached[1]
 
     p = {}
-    last_parameter_name = None
-    for type_name, tokens in type_of_row:
-        if type_name == "ParVal":
-            last_parameter_name = tokens[0]
-            p[last_parameter_name] = tokens[1]
-        elif type_name == "ParVec" or type_name == "EmptyPar":
-            last_parameter_name = tokens[0]
-            p[last_parameter_name] = []
-        elif type_name == "ParVecVal":
-            last_parameter_name = tokens[0]
-            p[last_parameter_name] = tokens[1]
-        elif type_name == "Val":
-            if last_parameter_name:
-                if p[last_parameter_name] == []:
-                    p[last_parameter_name] = tokens[0]
-                else:
-                    p[last_parameter_name] += " " + tokens[0]
-        elif type_name == "Stamp":
-            if "Stamp" not in p:
-                p["Stamp"] = tokens[0]
-            else:
-                p["Stamp"] += " ## " + tokens[0]
-
-    # Convert strings to values
-    for field in p:
-        if isinstance(p[field], str):
-            if re.match(r"^-?\d+(\.\d+)?$", p[field]):
-                p[field] = float(p[field])
-            elif re.match(r"^(-?\d+(\.\d+)?\s+)+-?\d+(\.\d+)?$", p[field]):
-                p[field] = list(map(float, p[field].split()))
+    for name, head, lines in entries:
+        if name == "$$":
+            p["Stamp"] = " ## ".join(lines)
+            continue
+        value = _split_dims(head)
+        if value is None:
+            value = head[1:] if head.startswith(" ") else head
+        value = value or []
+        for line in lines:
+            value = line if value == [] else value + " " + line
+        p[name] = _convert(value)
+
+    if len(_NMR_PAR_CACHE) >= _JCAMP_CACHE_MAX:
+        _NMR_PAR_CACHE.clear()
+    _NMR_PAR_CACHE[id(entries)] = (entries, p)
     return p
 
-def read_2dseq_v3(fname: str, expno: int, procno: int):
+
+def read_nmr_par(filename: str):
+    """
+    Read a BRUKER parameter file into a dict (numbers converted to floats).
+
+    The file is parsed once per version; each call returns its own copy.
+    """
+    return {k: (v.copy() if isinstance(v, list) else v) for k, v in _parse_nmr_par(filename).items()}
+
+# RECO_wordtype -> numpy type code (byte order is added from RECO_byte_order)
+_WORDTYPES = {
+    "_8BIT_UNSGN_INT": "u1",
+    "_8BIT_SGN_INT": "i1",
+    "_16BIT_SGN_INT": "i2",
+    "_16BIT_UNSGN_INT": "u2",
+    "_32BIT_SGN_INT": "i4",
+    "_32BIT_UNSGN_INT": "u4",
+    "_32BIT_FLOAT": "f4",
+    "_64BIT_FLOAT": "f8",
+}
+
+def _2dseq_dtype(reco_par: dict) -> np.dtype:
+    wordtype = str(reco_par["RECO_wordtype"]).strip()
+    if wordtype not in _WORDTYPES:
+        raise ValueError(f"Unsupported RECO_wordtype: {wordtype}")
+    byteorder = ">" if str(reco_par["RECO_byte_order"]).strip() == "bigEndian" else "<"
+    return np.dtype(byteorder + _WORDTYPES[wordtype])
+
+def read_2dseq_v3(fname: str, expno: int, procno: int, dtype=np.float32):
+    """
+    Read a Bruker 2dseq image as an (Ncolumns, Nrows, slices, NR, frames) array.
+
+    The file is memory-mapped with the endian-aware dtype from RECO_wordtype /
+    RECO_byte_order and converted once to `dtype` (slope and offset applied
+    in place). The reshape to (frames, NR, slices, Nrows, Ncolumns) and
+    the transpose to the returned axis order are views, so no further copies
+    are made. Frame groups beyond NR (e.g. echoes or reco channels) end up
+    on the last axis; its size is derived from the file size.
+    """
     method_file = os.path.join(fname, str(expno), "method")
     acqp_file = os.path.join(fname, str(expno), "acqp")
-    reco_file = os.path.join(fname, str(expno), "pdata", "1", "reco")
+    reco_file = os.path.join(fname, str(expno), "pdata", str(procno), "reco")
     img_name = os.path.join(fname, str(expno), "pdata", str(procno), "2dseq")
 
     method_par = read_nmr_par(method_file)
@@ -74,48 +156,33 @@ def read_2dseq_v3(fname: str, expno: int, procno: int):
     NR = int(acqp_par["NR"])
     NSLICES = int(acqp_par["NSLICES"])
 
-    RECOSIZE = reco_par["RECO_size"]
+    RECOSIZE = np.atleast_1d(reco_par["RECO_size"])
     Nrows = int(RECOSIZE[0])
     Ncolumns = int(RECOSIZE[1])
     if len(RECOSIZE) > 2:
         NSLICES = int(RECOSIZE[2])  # for 3D sequence
 
-    WORDTYPE = reco_par["RECO_wordtype"]
-    BIT = f"int{WORDTYPE[1:3]}"
-    BYTEORDER = ">" if reco_par["RECO_byte_order"] == "bigEndian" else "<"
-    RECOMAPMODE = reco_par["RECO_map_mode"]
-    RECOMAPOFFSET = reco_par["RECO_map_offset"][0]
-    RECOMAPSLOPE = reco_par["RECO_map_slope"][0]
-    RecoNumInputChan = 1
-
-    type_mapping = {
-        "int16": "h",
-        "uint16": "H",
-        "int32": "i",
-        "uint32": "I",
-        "float32": "f",
-        "float64": "d",
-    }
+    RECOMAPOFFSET = float(np.atleast_1d(reco_par["RECO_map_offset"])[0])
+    RECOMAPSLOPE = float(np.atleast_1d(reco_par["RECO_map_slope"])[0])
+    RecoNumInputChan = int(reco_par.get("RecoNumInputChan", 1))
 
-    try:
-        with open(img_name, "rb") as bruker_recon:
-            sizeD3 = NSLICES
-            sizeD4 = NR
-            sizeD5 = 1
-            img = np.zeros([Nrows, Ncolumns, sizeD3, sizeD4, sizeD5], dtype=np.dtype(f"{BIT}"))
-            for ii in range(sizeD5):
-                for jj in range(sizeD4):
-                    for kk in range(sizeD3):
-                        num_elements = Nrows * Ncolumns
-                        BIT_sign = type_mapping[BIT]
-                        struct_format = f"{BYTEORDER}{num_elements}{BIT_sign}"
-                        data_size = struct.calcsize(struct_format)
-                        data = bruker_recon.read(data_size)
-                        unpacked_data = struct.unpack(struct_format, data)
-                        img[:, :, kk, jj, ii] = np.array(unpacked_data).reshape(Nrows, Ncolumns)
-    except FileNotFoundError:
+    if not os.path.exists(img_name):
         raise FileNotFoundError("Could not open 2dseq file")
+    raw = np.memmap(img_name, dtype=_2dseq_dtype(reco_par), mode="r")
+
+    sizeD3 = NSLICES
+    sizeD4 = NR
+    frame = Nrows * Ncolumns * sizeD3 * sizeD4
+    if raw.size == 0 or raw.size % frame:
+        raise ValueError(
+            f"2dseq size ({raw.size} values) is not a multiple of "
+            f"{Nrows}x{Ncolumns}x{sizeD3}x{sizeD4}"
+        )
+    sizeD5 = raw.size // frame
 
-    img = img / RECOMAPSLOPE + RECOMAPOFFSET
-    img = np.transpose(img, (1, 0, 2, 3, 4))
-    return img, Ncolumns, Nrows, NI, NR, RecoNumInputChan
\ No newline at end of file
+    img = raw.astype(dtype)
+    del raw
+    img /= RECOMAPSLOPE
+    img += RECOMAPOFFSET
+    img = img.reshape(sizeD5, sizeD4, sizeD3, Nrows, Ncolumns).transpose(4, 3, 2, 1, 0)
+    return img, Ncolumns, Nrows, NI, NR, RecoNumInputChan
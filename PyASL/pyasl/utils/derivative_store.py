@@ -0,0 +1,233 @@
+"""
+In-process store for derivatives passed between pipeline steps.
+
+Steps save their NIfTI outputs with `save_img`. While a store is active,
+the volume is kept in memory exactly as it would read back from disk
+(the header dtype cast and scaling are applied to the array with
+nibabel's own array writer, so they match), and the file is encoded and
+written on a background thread. `load_img` serves later reads of the same
+path from memory, so the usual write → read → decode round trip is skipped.
+
+External tools (SPM, FSL) only see the filesystem. `flush_active_store`
+waits for pending writes and is called on entry to `external_job_slot()`,
+which wraps every external job.
+
+    with DerivativeStore(max_memory_mb=1024):
+        for step in steps:
+            step.run(data_descrip, params)
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import nibabel as nib
+import numpy as np
+from nibabel.arraywriters import ArrayWriter, get_slope_inter, make_array_writer
+from nibabel.volumeutils import apply_read_scaling
+
+logger = logging.getLogger(__name__)
+
+# Store used by save_img/load_img in this process (None: plain file I/O)
+_ACTIVE: Optional["DerivativeStore"] = None
+
+
+def active_store() -> Optional["DerivativeStore"]:
+    return _ACTIVE
+
+
+def flush_active_store() -> None:
+    """Block until all pending derivative writes are on disk."""
+    if _ACTIVE is not None:
+        _ACTIVE.flush()
+
+
+class DerivativeStore:
+    """
+    Memory-bounded cache of recently saved volumes with asynchronous writes.
+
+    Parameters
+    ----------
+    max_memory_mb : float
+        Budget for the in-memory arrays; least recently used volumes are
+        dropped beyond it (their files are still written).
+    max_writers : int
+        Number of background writer threads.
+    """
+
+    def __init__(self, max_memory_mb: float = 1024, max_writers: int = 2):
+        self.max_bytes = int(float(max_memory_mb) * 2**20)
+        self._pool = ThreadPoolExecutor(max_workers=max_writers, thread_name_prefix="pyasl-write")
+        self._lock = threading.Lock()
+        # path -> (data, affine, header, file signature or None while pending)
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._pending: List[Future] = []
+        self._writes: Dict[str, Future] = {}
+        self._nbytes = 0
+        self._prev: Optional[DerivativeStore] = None
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self) -> "DerivativeStore":
+        global _ACTIVE
+        self._prev, _ACTIVE = _ACTIVE, self
+        return self
+
+    def __exit__(self, *exc) -> None:
+        global _ACTIVE
+        try:
+            self.close()
+        finally:
+            _ACTIVE = self._prev
+        logger.debug("Derivative store: %d hits, %d misses.", self.hits, self.misses)
+
+    # ------------------------------------------------------------------ API
+
+    def put(self, img: nib.Nifti1Image, path: str) -> None:
+        """Keep `img` in memory as it would be read back, and write it asynchronously."""
+        path = os.path.abspath(path)
+        out, data = _on_disk(img)
+        data = np.nan_to_num(data, copy=False)
+        data.flags.writeable = False
+
+        entry = [data, img.affine.copy(), img.header.copy(), None]
+        with self._lock:
+            self._drop(path)
+            self._entries[path] = entry
+            self._nbytes += data.nbytes
+            self._evict()
+        fut = self._pool.submit(self._write, path, out, entry)
+        self._pending.append(fut)
+        self._writes[path] = fut
+
+    def get(self, path: str) -> Optional[Tuple[nib.Nifti1Image, np.ndarray]]:
+        """Return ``(img, data)`` for a stored path, or None."""
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[3] is not None and entry[3] != _signature(path):
+                # Replaced on disk since we wrote it (e.g. by an external tool)
+                self._drop(path)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(path)
+                self.hits += 1
+        if entry is None:
+            # Evicted before its write finished: make the file readable first
+            fut = self._writes.get(path)
+            if fut is not None:
+                fut.result()
+            self.misses += 1
+            return None
+        data, affine, header, _ = entry
+        return nib.Nifti1Image(data, affine, header), data.copy()
+
+    def flush(self) -> None:
+        """Wait for all pending writes; re-raises the first write error."""
+        pending, self._pending = self._pending, []
+        for fut in pending:
+            fut.result()
+        self._writes.clear()
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+            with self._lock:
+                self._entries.clear()
+                self._nbytes = 0
+
+    # ------------------------------------------------------------------ internals
+
+    def _write(self, path: str, img: nib.Nifti1Image, entry: list) -> None:
+        tmp = f"{path}.{id(entry):x}.part"
+        with open(tmp, "wb") as f:
+            f.write(img.to_bytes())
+        os.replace(tmp, path)
+        with self._lock:
+            if self._entries.get(path) is entry:
+                entry[3] = _signature(path)
+
+    def _drop(self, path: str) -> None:
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._nbytes -= entry[0].nbytes
+
+    def _evict(self) -> None:
+        while self._nbytes > self.max_bytes and len(self._entries) > 1:
+            path, _ = next(iter(self._entries.items()))
+            self._drop(path)
+
+
+class _ArrayFile:
+    """Write-only file object filling a preallocated array."""
+
+    def __init__(self, arr: np.ndarray):
+        self._view = memoryview(arr.reshape(-1, order="A")).cast("B")
+        self._pos = 0
+
+    def write(self, b) -> int:
+        n = len(b)
+        self._view[self._pos:self._pos + n] = b
+        self._pos += n
+        return n
+
+    def writelines(self, lines) -> None:
+        for b in lines:
+            self.write(b)
+
+
+def _on_disk(img: nib.Nifti1Image) -> Tuple[nib.Nifti1Image, np.ndarray]:
+    """
+    The data of `img` as `to_filename` would store it, and as `get_fdata`
+    would read it back, without encoding or decoding a file.
+
+    Returns an image holding the stored (cast, scaled) array with its final
+    slope/intercept, which encodes to the same file as `img`, and the
+    float64 read-back data.
+    """
+    out_dtype = img.get_data_dtype()
+    if not isinstance(out_dtype, np.dtype):
+        # dtype alias ("compat"/"smallest"): resolved by nibabel on write
+        out = nib.Nifti1Image.from_bytes(img.to_bytes())
+        return out, out.get_fdata()
+
+    hdr = img.header
+    data = np.asanyarray(img.dataobj)
+    # Same writer choice as AnalyzeImage.to_file_map
+    slope = hdr["scl_slope"].item() if hdr.has_data_slope else np.nan
+    inter = hdr["scl_inter"].item() if hdr.has_data_intercept else np.nan
+    if np.all(np.isnan((slope, inter))):
+        writer = make_array_writer(data, out_dtype, hdr.has_data_slope, hdr.has_data_intercept)
+    else:
+        writer = ArrayWriter(data, out_dtype, check_scaling=False)
+    stored = np.empty(data.shape, dtype=out_dtype, order="F")
+    writer.to_fileobj(_ArrayFile(stored), order="F")
+
+    out = nib.Nifti1Image(stored, img.affine, hdr)
+    if np.all(np.isnan((slope, inter))):
+        out.header.set_slope_inter(*get_slope_inter(writer))
+    else:
+        out.header["scl_slope"], out.header["scl_inter"] = slope, inter
+
+    # Read scaling as ArrayProxy applies it (header values are float32)
+    slope, inter = out.header.get_slope_inter()
+    if slope is None:
+        data = stored.astype(np.float64)
+    else:
+        data = apply_read_scaling(stored, np.float64(slope), np.float64(inter)).astype(np.float64, copy=False)
+    return out, data
+
+
+def _signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
@@ -0,0 +1,141 @@
+"""
+ONNX inference backend for the DLASL dilated network.
+
+The trained Keras weights (`model_068.hdf5` / `model_099.hdf5`) are exported
+once to ONNX, optionally with float16 or int8 weights, and then run with
+ONNX Runtime on the CPU. Exporting needs TensorFlow and tf2onnx; inference
+only needs `onnxruntime`, so slim CPU workers can denoise from an exported
+file without TensorFlow installed.
+
+    path = export_onnx(1, weights_dir, quantize="int8")   # once, with TensorFlow
+    model = OnnxDenoiser(path, n_threads=4)
+    y = model.predict(x)                                  # x: (N, H, W, 1) float32
+
+Exported files are named after the weights (`model_099.onnx`,
+`model_099.fp16.onnx`, `model_099.int8.onnx`) and stored in `onnx_dir`
+(default: next to the weights).
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_QUANTIZE_SUFFIX = {None: "", "none": "", "float16": ".fp16", "int8": ".int8"}
+
+
+def weights_name(model_selection: int) -> str:
+    """Keras weight file of a DLASL model selection (0 -> model_068, else model_099)."""
+    return "model_068.hdf5" if int(model_selection) == 0 else "model_099.hdf5"
+
+
+def onnx_path(model_selection: int, onnx_dir: str, quantize: Optional[str] = None) -> str:
+    """Path of the exported ONNX model for a selection and quantization."""
+    if quantize not in _QUANTIZE_SUFFIX:
+        raise ValueError(f"quantize must be one of none/float16/int8, got '{quantize}'")
+    stem = os.path.splitext(weights_name(model_selection))[0]
+    return os.path.join(onnx_dir, f"{stem}{_QUANTIZE_SUFFIX[quantize]}.onnx")
+
+
+def _keras_model(model_selection: int, weights_dir: str):
+    from pyasl.modules.dlasl_denoise_cbf import get_model
+
+    return get_model(model_selection, weights_dir, backend="keras")
+
+
+def export_onnx(
+    model_selection: int,
+    weights_dir: str,
+    onnx_dir: Optional[str] = None,
+    quantize: Optional[str] = None,
+    overwrite: bool = False,
+) -> str:
+    """
+    Export the Keras model with the selected weights to ONNX.
+
+    The float32 graph is converted with tf2onnx (dynamic batch and image
+    size); `quantize="float16"` converts the weights to float16 (inputs and
+    outputs stay float32) and `quantize="int8"` applies dynamic int8 weight
+    quantization with ONNX Runtime. Existing files are reused unless
+    `overwrite`. Returns the path of the requested model.
+    """
+    onnx_dir = onnx_dir or weights_dir
+    out = onnx_path(model_selection, onnx_dir, quantize)
+    if os.path.isfile(out) and not overwrite:
+        return out
+    os.makedirs(onnx_dir, exist_ok=True)
+
+    base = onnx_path(model_selection, onnx_dir)
+    if overwrite or not os.path.isfile(base):
+        try:
+            import tensorflow as tf
+            import tf2onnx
+        except ImportError as err:
+            raise ImportError("Exporting to ONNX requires tensorflow and tf2onnx") from err
+        model = _keras_model(model_selection, weights_dir)
+        spec = (tf.TensorSpec((None, None, None, 1), tf.float32, name="input"),)
+        tf2onnx.convert.from_keras(model, input_signature=spec, opset=13, output_path=base)
+        logger.info("Exported %s to %s", weights_name(model_selection), base)
+
+    if quantize == "float16":
+        import onnx
+        from onnxconverter_common import float16
+
+        onnx.save(float16.convert_float_to_float16(onnx.load(base), keep_io_types=True), out)
+    elif quantize == "int8":
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(base, out, weight_type=QuantType.QInt8, op_types_to_quantize=["Conv"])
+    if out != base:
+        logger.info("Wrote %s-quantized model %s", quantize, out)
+    return out
+
+
+class OnnxDenoiser:
+    """ONNX Runtime session with the `predict` interface of the Keras model."""
+
+    def __init__(self, path: str, n_threads: Optional[int] = None):
+        import onnxruntime as ort
+
+        opts = ort.SessionOptions()
+        if n_threads:
+            opts.intra_op_num_threads = int(n_threads)
+            opts.inter_op_num_threads = 1
+        self.path = path
+        self.session = ort.InferenceSession(path, opts, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, x: np.ndarray, batch_size: int = 32, verbose: int = 0) -> np.ndarray:
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        out = [
+            self.session.run(None, {self.input_name: x[i:i + batch_size]})[0]
+            for i in range(0, len(x), batch_size)
+        ]
+        return np.concatenate(out) if out else np.zeros_like(x)
+
+
+def parity_check(
+    model_selection: int,
+    weights_dir: str,
+    path: str,
+    n_slices: int = 8,
+    seed: int = 0,
+) -> float:
+    """
+    Max absolute difference between the Keras and ONNX outputs.
+
+    Runs both models on `n_slices` random 64x64 slices scaled like the
+    denoising input ([0, 150] / 255) and logs the result.
+    """
+    rng = np.random.default_rng(seed)
+    x = (rng.uniform(0, 150, size=(n_slices, 64, 64, 1)) / 255.0).astype(np.float32)
+    ref = _keras_model(model_selection, weights_dir).predict(x, verbose=0)
+    got = OnnxDenoiser(path).predict(x)
+    diff = float(np.max(np.abs(ref - got)))
+    logger.info("ONNX parity %s: max |keras - onnx| = %.3g (output scale 1/255)", os.path.basename(path), diff)
+    return diff
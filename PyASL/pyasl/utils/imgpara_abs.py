@@ -1,5 +1,32 @@
 import os
 
+from pyasl.utils.bruker_io import read_jcamp_entries
+
+
+_ACQP_KEYS = frozenset((
+    "ACQ_scan_name", "ACQ_protocol_name", "ACQ_fov", "ACQ_slice_offset",
+    "ACQ_slice_thick", "ACQ_repetition_time", "ACQ_echo_time", "ACQ_size", "NR",
+))
+_METHOD_KEYS = frozenset((
+    "TotalEchoTime", "NEcho", "PVM_ScanTimeStr", "PostLabelTime", "Slab_Margin",
+    "NSegments", "FlowRange", "PVM_NRepetitions", "PCASL_LabelTime",
+    "PCASL_PostLabelTime", "PCASL_PLD", "PCASL_Dur",
+))
+_VISU_KEYS = frozenset(("VisuCoreSize", "VisuCoreUnits"))
+
+
+def _entries(file_path: str, keys: frozenset):
+    """Yield (name, head, first continuation line, is-vector) for the wanted parameters."""
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"{file_path} not found")
+    for name, head, lines in read_jcamp_entries(file_path):
+        if name not in keys:
+            continue
+        head = head.strip()
+        first = lines[0].strip() if lines else ""
+        yield name, head, first, head.startswith("(")
+
+
 def W_ImgParaAbs(path: str):
     Slice = {
         "path": path,
@@ -26,97 +53,62 @@ def W_ImgParaAbs(path: str):
         "aslLD": 0,
     }
 
-    acqp_path = os.path.join(path, "acqp")
-    if os.path.exists(acqp_path):
-        with open(acqp_path, "r") as filepath:
-            line = filepath.readline()
-            while line:
-                temp = line.strip()
-                if temp.startswith("##$ACQ_scan_name=("):
-                    temp = filepath.readline().strip().split()[0]
-                    Slice["Scan"] = temp[1:]
-                elif temp.startswith("##$ACQ_protocol_name=("):
-                    temp = filepath.readline().strip()
-                    Slice["Protocol"] = temp
-                elif temp.startswith("##$ACQ_fov=("):
-                    Cont = int(temp.split()[1])
-                    temp = filepath.readline().strip().split()
-                    Slice["ROI"] = [float(temp[i]) for i in range(Cont)]
-                elif temp.startswith("##$ACQ_slice_offset=("):
-                    Slice["slicenum"] = int(temp.split()[1])
-                elif temp.startswith("##$ACQ_slice_thick="):
-                    Slice["thickness"] = float(temp[19:])
-                elif temp.startswith("##$ACQ_repetition_time=("):
-                    temp = filepath.readline().strip()
-                    Slice["tr"] = round(float(temp), 2)
-                elif temp.startswith("##$ACQ_echo_time=("):
-                    temp = filepath.readline().strip()
-                    Slice["te"] = round(float(temp), 2)
-                elif temp.startswith("##$ACQ_size=("):
-                    Cont = int(temp.split()[1])
-                    temp = filepath.readline().strip().split()
-                    Slice["AcqSize"] = [int(temp[i]) for i in range(Cont)]
-                elif temp.startswith("##$NR="):
-                    Slice["NR"] = int(temp[6:])
-                line = filepath.readline()
-    else:
-        raise FileNotFoundError(f"{acqp_path} not found")
+    # Files are tokenized once and cached by bruker_io (shared with read_nmr_par)
+    for name, head, temp, vec in _entries(os.path.join(path, "acqp"), _ACQP_KEYS):
+        if name == "ACQ_scan_name" and vec:
+            Slice["Scan"] = temp.split()[0][1:]
+        elif name == "ACQ_protocol_name" and vec:
+            Slice["Protocol"] = temp
+        elif name == "ACQ_fov" and vec:
+            Cont = int(head.split()[1])
+            Slice["ROI"] = [float(x) for x in temp.split()[:Cont]]
+        elif name == "ACQ_slice_offset" and vec:
+            Slice["slicenum"] = int(head.split()[1])
+        elif name == "ACQ_slice_thick":
+            Slice["thickness"] = float(head)
+        elif name == "ACQ_repetition_time" and vec:
+            Slice["tr"] = round(float(temp), 2)
+        elif name == "ACQ_echo_time" and vec:
+            Slice["te"] = round(float(temp), 2)
+        elif name == "ACQ_size" and vec:
+            Cont = int(head.split()[1])
+            Slice["AcqSize"] = [int(x) for x in temp.split()[:Cont]]
+        elif name == "NR":
+            Slice["NR"] = int(head)
 
-    method_path = os.path.join(path, "method")
-    if os.path.exists(method_path):
-        with open(method_path, "r") as filepath:
-            line = filepath.readline()
-            while line:
-                temp = line.strip()
-                if temp.startswith("##$TotalEchoTime=("):
-                    Cont = int(temp.split()[1])
-                    temp = filepath.readline().strip().split()
-                    Slice["eTE"] = [float(temp[i]) for i in range(Cont)]
-                elif temp.startswith("##$NEcho=("):
-                    Cont = int(temp.split()[1])
-                    temp = filepath.readline().strip().split()
-                    Slice["EchoNum"] = [int(temp[i]) for i in range(Cont)]
-                elif temp.startswith("##$PVM_ScanTimeStr=("):
-                    temp = filepath.readline().strip()
-                    Slice["ScanTime"] = temp[1:-1]
-                elif temp.startswith("##$PostLabelTime="):
-                    Slice["PostLabelTime"] = float(temp[17:])
-                elif temp.startswith("##$Slab_Margin="):
-                    Slice["SlabMargin"] = float(temp[15:])
-                elif temp.startswith("##$NSegments"):
-                    Slice["Segment"] = int(temp[13:])
-                elif temp.startswith("##$FlowRange="):
-                    Slice["VENC"] = float(temp[13:])
-                elif temp.startswith("##$PVM_NRepetitions="):
-                    Slice["rep"] = int(temp[20:])
-                elif temp.startswith("##$PCASL_LabelTime="):
-                    Slice["asllabel"] = float(temp[19:])
-                elif temp.startswith("##$PCASL_PostLabelTime="):
-                    Slice["aslPLD"] = float(temp[23:])
-                elif temp.startswith("##$PCASL_PLD="):
-                    Slice["aslPLD"] = float(temp[13:])
-                elif temp.startswith("##$PCASL_Dur="):
-                    Slice["aslLD"] = float(temp[13:])
-                line = filepath.readline()
-    else:
-        raise FileNotFoundError(f"{method_path} not found")
+    for name, head, temp, vec in _entries(os.path.join(path, "method"), _METHOD_KEYS):
+        if name == "TotalEchoTime" and vec:
+            Cont = int(head.split()[1])
+            Slice["eTE"] = [float(x) for x in temp.split()[:Cont]]
+        elif name == "NEcho" and vec:
+            Cont = int(head.split()[1])
+            Slice["EchoNum"] = [int(x) for x in temp.split()[:Cont]]
+        elif name == "PVM_ScanTimeStr" and vec:
+            Slice["ScanTime"] = temp[1:-1]
+        elif name == "PostLabelTime":
+            Slice["PostLabelTime"] = float(head)
+        elif name == "Slab_Margin":
+            Slice["SlabMargin"] = float(head)
+        elif name == "NSegments":
+            Slice["Segment"] = int(head)
+        elif name == "FlowRange":
+            Slice["VENC"] = float(head)
+        elif name == "PVM_NRepetitions":
+            Slice["rep"] = int(head)
+        elif name == "PCASL_LabelTime":
+            Slice["asllabel"] = float(head)
+        elif name in ("PCASL_PostLabelTime", "PCASL_PLD"):
+            Slice["aslPLD"] = float(head)
+        elif name == "PCASL_Dur":
+            Slice["aslLD"] = float(head)
 
-    visu_path = os.path.join(path, "visu_pars")
-    if os.path.exists(visu_path):
-        with open(visu_path, "r") as filepath:
-            line = filepath.readline()
-            while line:
-                temp = line.strip()
-                if temp.startswith("##$VisuCoreSize=("):
-                    Cont = int(temp.split()[1])
-                    temp = filepath.readline().strip().split()
-                    Slice["size"] = [int(temp[i]) for i in range(Cont)]
-                elif temp.startswith("##$VisuCoreUnits=("):
-                    Cont = int(temp.split()[1][:-1])
-                    temp = filepath.readline().strip().split()
-                    Slice["Unit"] = [temp[i] for i in range(Cont)]
-                line = filepath.readline()
-    else:
-        raise FileNotFoundError(f"{visu_path} not found")
+    for name, head, temp, vec in _entries(os.path.join(path, "visu_pars"), _VISU_KEYS):
+        if name == "VisuCoreSize" and vec:
+            Cont = int(head.split()[1])
+            Slice["size"] = [int(x) for x in temp.split()[:Cont]]
+        elif name == "VisuCoreUnits" and vec:
+            # "( 2, 65 )": number of units before the comma
+            Cont = int(head.split()[1][:-1])
+            Slice["Unit"] = temp.split()[:Cont]
 
-    return Slice
\ No newline at end of file
+    return Slice
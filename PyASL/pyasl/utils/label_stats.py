@@ -0,0 +1,110 @@
+"""
+Label statistics.
+
+Per-label voxel counts, sums and means of one or more images over an
+integer label map, computed with a single `np.bincount` pass per image
+instead of one full-volume boolean mask per label. Coarser label
+hierarchies (e.g. MRICloud Type1-L2/L3/L5 segments) are handled with a
+lookup array label -> group: label maps are relabelled with one fancy
+index, and group statistics are reduced from the per-label sums without
+touching the volume again.
+
+    labels = label_index(mskv, label_num)
+    lut = group_lut([row[4] if len(row) > 4 else None for row in lookup], names)
+    stats = label_stats(labels, [acbf, rcbf], label_num, mask=brnmsk > 0.5)
+    seg = group_stats(stats, lut, len(names))
+    seg["mean"][0][1:]    # mean acbf of groups 1..n
+
+Index 0 is the background (unlabelled voxels, or voxels outside `mask`).
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+
+def label_index(data: np.ndarray, n_labels: int) -> np.ndarray:
+    """
+    Integer label map from label image data; voxels that are not an integer
+    label in 1..`n_labels` (including NaN) map to 0.
+    """
+    data = np.asarray(data)
+    if np.issubdtype(data.dtype, np.integer):
+        labels = data.astype(np.intp, copy=False)
+        valid = (labels >= 1) & (labels <= n_labels)
+    else:
+        with np.errstate(invalid="ignore"):
+            valid = (data >= 1) & (data <= n_labels) & (data == np.floor(data))
+        labels = np.where(valid, data, 0).astype(np.intp)
+    return np.where(valid, labels, 0)
+
+
+def group_lut(label_keys: Sequence, group_names: Sequence) -> np.ndarray:
+    """
+    Lookup array (length len(label_keys) + 1) mapping label k (1-based) to
+    the 1-based index of `group_names` equal to `label_keys[k - 1]`, 0 if
+    none. If a name occurs more than once the last occurrence wins.
+    """
+    index = {name: ii + 1 for ii, name in enumerate(group_names)}
+    lut = np.zeros(len(label_keys) + 1, dtype=np.intp)
+    for kk, name in enumerate(label_keys):
+        if name is not None:
+            lut[kk + 1] = index.get(name, 0)
+    return lut
+
+
+def _finish(count: np.ndarray, sums: np.ndarray) -> Dict[str, np.ndarray]:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / count
+    return {"count": count, "sum": sums, "mean": mean}
+
+
+def label_stats(
+    labels: np.ndarray,
+    values: Sequence[np.ndarray],
+    n_labels: int,
+    mask: Optional[np.ndarray] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Counts, sums and means of `values` per label.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Integer label map (see `label_index`), same shape as every value
+        image (singleton dimensions are squeezed).
+    values : sequence of np.ndarray
+        Images to reduce.
+    n_labels : int
+        Highest label.
+    mask : np.ndarray, optional
+        Only voxels where `mask` is true are counted.
+
+    Returns
+    -------
+    dict
+        "count" (n_labels + 1,), "sum" and "mean" (len(values), n_labels + 1).
+        Means of empty labels are NaN; a NaN voxel makes its label's sum and
+        mean NaN.
+    """
+    labels = np.squeeze(labels)
+    if mask is not None:
+        labels = np.where(np.squeeze(mask), labels, 0)
+    flat = labels.ravel()
+    count = np.bincount(flat, minlength=n_labels + 1)
+    sums = np.empty((len(values), n_labels + 1))
+    for i, v in enumerate(values):
+        v = np.squeeze(v)
+        if v.shape != labels.shape:
+            raise ValueError(f"Label map {labels.shape} and image {v.shape} differ in shape")
+        sums[i] = np.bincount(flat, weights=v.ravel(), minlength=n_labels + 1)
+    return _finish(count, sums)
+
+
+def group_stats(stats: Dict[str, np.ndarray], lut: np.ndarray, n_groups: int) -> Dict[str, np.ndarray]:
+    """Reduce per-label `label_stats` output to groups through a `group_lut`."""
+    count = np.bincount(lut, weights=stats["count"], minlength=n_groups + 1).astype(np.int64)
+    sums = np.stack([np.bincount(lut, weights=s, minlength=n_groups + 1) for s in stats["sum"]])
+    return _finish(count, sums)
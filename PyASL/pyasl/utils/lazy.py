@@ -0,0 +1,50 @@
+"""
+Lazy step registry.
+
+Pipeline runners map step names to module instances. Importing every step
+module up front pulls in nipype, TensorFlow, matplotlib and friends even
+for runs that use none of them, so the maps are `LazyStepMap`s of
+(module path, class name) specs: a step's module is imported and the class
+instantiated the first time the step is looked up, then reused.
+
+    MODULE_MAP = LazyStepMap({
+        "Realign": ("pyasl.modules.asltbx_realign", "Realign"),
+    })
+    MODULE_MAP.get("Realign").run(data_descrip, params)
+
+Membership tests, `keys()`, `len()` and iteration never import anything.
+"""
+
+from __future__ import annotations
+
+import importlib
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Tuple
+
+
+class LazyStepMap(Mapping):
+    """Read-only mapping of step name -> module instance, created on first access."""
+
+    def __init__(self, specs: Dict[str, Tuple[str, str]]):
+        self._specs = dict(specs)
+        self._instances: Dict[str, Any] = {}
+
+    def __getitem__(self, name: str) -> Any:
+        inst = self._instances.get(name)
+        if inst is None:
+            mod_name, cls_name = self._specs[name]
+            inst = getattr(importlib.import_module(mod_name), cls_name)()
+            self._instances[name] = inst
+        return inst
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._specs
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._specs)
+
+    def __len__(self) -> int:
+        return len(self._specs)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({sorted(self._specs)})"
@@ -1,13 +1,45 @@
 import os
 import glob
+import json
+import re
+import shutil
+import hashlib
+import logging
 import numpy as np
 import nibabel as nib
 from scipy.ndimage import binary_fill_holes, binary_erosion, binary_dilation, label
-from skimage.morphology import ball
-from nipype.interfaces import spm
-from pyasl.utils.utils import load_img
+from pyasl.utils.utils import load_img, save_img
+from pyasl.utils.label_stats import label_index
+from pyasl.utils.parallel import external_job_slot
+from pyasl.utils.spm_batch import run_spm
+from pyasl.utils.derivative_store import flush_active_store
+
+logger = logging.getLogger(__name__)
+
+def img_coreg(target: str, source: str, other=[], backend: str = "spm"):
+    """
+    Coregister `source` (and `other`) to `target` with an NMI cost, writing
+    r-prefixed images resliced onto the target grid. `backend` is "spm"
+    (SPM Coregister through Nipype) or "native"
+    (`pyasl.utils.rigid_registration.coregister_files`, same settings).
+    """
+    if backend == "native":
+        from pyasl.utils.rigid_registration import coregister_files
+
+        coregister_files(
+            target, source, other,
+            sep=[4, 2],
+            tol=[0.02] * 3 + [0.001] * 3,
+            fwhm=[7, 7],
+            write_interp=1,
+            prefix="r",
+        )
+        return
+    if backend != "spm":
+        raise ValueError(f"Coregistration backend must be 'spm' or 'native', got '{backend}'")
+
+    from nipype.interfaces import spm
 
-def img_coreg(target: str, source: str, other=[]):
     coreg = spm.Coregister()
     coreg.inputs.target = target
     coreg.inputs.source = source
@@ -21,9 +53,44 @@ def img_coreg(target: str, source: str, other=[]):
     coreg.inputs.out_prefix = "r"
     if other:
         coreg.inputs.apply_to_files = other
-    coreg.run()
-
-def mricloud_inbrain(imgvol: np.ndarray, thre: float, ero_lyr: int, dlt_lyr: int):
+    run_spm(coreg, f"Coregister {os.path.basename(source)}")
+
+# In-plane 4-connectivity, no connectivity across slices
+_INPLANE_SE = np.zeros((3, 3, 3), dtype=bool)
+_INPLANE_SE[:, :, 1] = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
+
+def _largest_inplane_component(mask: np.ndarray):
+    """Keep the largest in-plane component of every slice (ties: first in raster order)."""
+    labels, n = label(mask, structure=_INPLANE_SE)
+    Nz = mask.shape[2]
+    sizes = np.bincount(labels.ravel(), minlength=n + 1)
+    slice_of = np.zeros(n + 1, dtype=np.intp)
+    slice_of[labels] = np.arange(Nz)
+    lab = np.arange(1, n + 1)
+    # Per slice: largest size first, then lowest label (= first found, like argmax)
+    order = np.lexsort((lab, -sizes[1:], slice_of[1:]))
+    first = np.ones(n, dtype=bool)
+    first[1:] = slice_of[1:][order[1:]] != slice_of[1:][order[:-1]]
+    keep = np.zeros(n + 1, dtype=bool)
+    keep[lab[order[first]]] = True
+    out = keep[labels]
+    # A slice without components keeps label 0 (the background), as argmax
+    # over all-zero sizes did in the slice-by-slice version
+    empty = np.ones(Nz, dtype=bool)
+    empty[slice_of[1:]] = False
+    out[:, :, empty] = True
+    return out
+
+def mricloud_inbrain_masks(imgvol: np.ndarray, thre: float, settings):
+    """
+    `mricloud_inbrain` for several (ero_lyr, dlt_lyr) settings at once.
+
+    The threshold is computed once, erosion/component selection/hole filling
+    once per erosion depth, and dilations are applied incrementally in
+    increasing order. Every morphology step runs on the whole volume with an
+    in-plane structuring element, so slices stay independent. Returns one
+    uint8 mask per setting, in the order given.
+    """
     lowb, highb = 0.25, 0.75
     Nx, Ny, Nz = imgvol.shape
     tmpmat = imgvol[
@@ -33,25 +100,98 @@ def mricloud_inbrain(imgvol: np.ndarray, thre: float, ero_lyr: int, dlt_lyr: int
     ]
     tmpvox = tmpmat[tmpmat > 0]
     thre0 = np.mean(tmpvox) * thre
-    mask1 = np.zeros_like(imgvol)
-    mask1[imgvol > thre0] = 1
-    mask2 = np.zeros_like(mask1)
-    se = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]])
-    for ii in range(Nz):
-        slice1 = mask1[:, :, ii]
-        for _ in range(ero_lyr):
-            slice1 = binary_erosion(slice1, structure=se)
-        labeled_array, _ = label(slice1, structure=se)
-        sizes = np.bincount(labeled_array.ravel())
-        sizes[0] = 0
-        max_label = sizes.argmax()
-        slice2 = np.zeros_like(slice1)
-        slice2[labeled_array == max_label] = 1
-        slice2 = binary_fill_holes(slice2)
-        for _ in range(dlt_lyr):
-            slice2 = binary_dilation(slice2, structure=se)
-        mask2[:, :, ii] = slice2
-    return mask2.astype(np.uint8)
+    mask1 = imgvol > thre0
+
+    masks = {}
+    for ero_lyr in sorted({e for e, _ in settings}):
+        core = binary_erosion(mask1, structure=_INPLANE_SE, iterations=ero_lyr) if ero_lyr > 0 else mask1
+        core = binary_fill_holes(_largest_inplane_component(core), structure=_INPLANE_SE)
+        done = 0
+        for dlt_lyr in sorted({d for e, d in settings if e == ero_lyr}):
+            if dlt_lyr > done:
+                core = binary_dilation(core, structure=_INPLANE_SE, iterations=dlt_lyr - done)
+                done = dlt_lyr
+            masks[ero_lyr, dlt_lyr] = core.astype(np.uint8)
+    return [masks[e, d] for e, d in settings]
+
+def mricloud_inbrain(imgvol: np.ndarray, thre: float, ero_lyr: int, dlt_lyr: int):
+    return mricloud_inbrain_masks(imgvol, thre, [(ero_lyr, dlt_lyr)])[0]
+
+# SPM NewSegment settings: (tpm index, n gaussians, native (c*), warped) per tissue
+_SEGMENT_TISSUES = [
+    (1, 1, (True, False), (False, False)),
+    (2, 1, (True, False), (False, False)),
+    (3, 2, (True, False), (False, False)),
+    (4, 3, (False, False), (False, False)),
+    (5, 4, (False, False), (False, False)),
+    (6, 2, (False, False), (False, False)),
+]
+_SEGMENT_INPUTS = {
+    "channel_info": (0.001, 60, (False, False)),
+    "warping_regularization": [0, 0.001, 0.5, 0.05, 0.2],
+    "affine_regularization": "mni",
+    "sampling_distance": 3,
+    "write_deformation_fields": [False, False],
+}
+# Bump when the derived masks change, to invalidate cached entries
+_SEGMENT_CACHE_VERSION = 2
+_SEGMENT_CACHE = {"enabled": True, "hits": 0, "misses": 0}
+_FILE_HASHES = {}
+
+def set_segment_cache(enabled: bool):
+    """Enable or disable the persistent NewSegment result cache."""
+    _SEGMENT_CACHE["enabled"] = bool(enabled)
+
+def segment_cache_stats():
+    """Hit/miss counters of the NewSegment result cache (including session workers)."""
+    return {"hits": _SEGMENT_CACHE["hits"], "misses": _SEGMENT_CACHE["misses"]}
+
+def _file_sha256(path: str) -> str:
+    """Content hash of a file, memoized on (path, size, mtime)."""
+    st = os.stat(path)
+    memo = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if memo not in _FILE_HASHES:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _FILE_HASHES[memo] = h.hexdigest()
+    return _FILE_HASHES[memo]
+
+def _segment_cache_dir(imgtpm: str, imgfile: str) -> str:
+    """Cache entry for segmenting `imgfile` with `imgtpm` and the settings above."""
+    key = hashlib.sha256(json.dumps([
+        _SEGMENT_CACHE_VERSION,
+        _file_sha256(imgfile),
+        _file_sha256(imgtpm),
+        _SEGMENT_TISSUES,
+        _SEGMENT_INPUTS,
+    ]).encode()).hexdigest()
+    # Shared by all sessions below the same derivatives/ folder
+    parts = os.path.abspath(imgfile).split(os.sep)
+    if "derivatives" in parts:
+        i = len(parts) - 1 - parts[::-1].index("derivatives")
+        base = os.sep.join(parts[: i + 1])
+    else:
+        base = os.path.dirname(os.path.abspath(imgfile))
+    return os.path.join(base, ".pyasl_cache", "segment", key)
+
+def _segment_cache_store(entry: str, tissue_files: list, brnmsk_dspl, brnmsk_clcu):
+    # Tissue maps are stored as c1.nii, c2.nii, ... (the key is content-only,
+    # so a hit may be restored next to an image with another name)
+    tmp = f"{entry}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(tmp, exist_ok=True)
+        for n, p in enumerate(tissue_files, start=1):
+            shutil.copy2(p, os.path.join(tmp, f"c{n}.nii"))
+        np.savez_compressed(
+            os.path.join(tmp, "masks.npz"), brnmsk_dspl=brnmsk_dspl, brnmsk_clcu=brnmsk_clcu
+        )
+        os.rename(tmp, entry)
+    except OSError as err:
+        # Another session stored the same entry first, or the disk is read-only
+        logger.debug("Segmentation cache entry %s not stored: %s", entry, err)
+        shutil.rmtree(tmp, ignore_errors=True)
 
 def mricloud_getBrainMask(imgtpm: str, imgfile: str):
     imgpath, filename = os.path.split(imgfile)
@@ -63,25 +203,37 @@ def mricloud_getBrainMask(imgtpm: str, imgfile: str):
 
     brnmsk_realign = np.ones(matsiz) > 0.5
     if not flag_small_fov:
+        entry = None
+        if _SEGMENT_CACHE["enabled"]:
+            flush_active_store()  # hash the image as SPM would read it
+            entry = _segment_cache_dir(imgtpm, imgfile)
+            if os.path.isfile(os.path.join(entry, "masks.npz")):
+                _SEGMENT_CACHE["hits"] += 1
+                logger.info("Segmentation cache hit for %s; skipping NewSegment.", filename)
+                for name in sorted(os.listdir(entry)):
+                    if name != "masks.npz":
+                        # c<n>.nii -> c<n><filename>, as NewSegment names them
+                        prefix = os.path.splitext(name)[0]
+                        shutil.copy2(os.path.join(entry, name), os.path.join(imgpath, prefix + filename))
+                with np.load(os.path.join(entry, "masks.npz")) as z:
+                    return z["brnmsk_dspl"], z["brnmsk_clcu"]
+            _SEGMENT_CACHE["misses"] += 1
+
+        from nipype.interfaces import spm
+
         segment = spm.NewSegment()
         segment.inputs.channel_files = imgfile
-        segment.inputs.channel_info = (0.001, 60, (False, False))
         segment.inputs.tissues = [
-            ((imgtpm, 1), 1, (True, False), (False, False)),
-            ((imgtpm, 2), 1, (True, False), (False, False)),
-            ((imgtpm, 3), 2, (True, False), (False, False)),
-            ((imgtpm, 4), 3, (False, False), (False, False)),
-            ((imgtpm, 5), 4, (False, False), (False, False)),
-            ((imgtpm, 6), 2, (False, False), (False, False)),
+            ((imgtpm, idx), ngaus, native, warped) for idx, ngaus, native, warped in _SEGMENT_TISSUES
         ]
-        segment.inputs.warping_regularization = [0, 0.001, 0.5, 0.05, 0.2]
-        segment.inputs.affine_regularization = "mni"
-        segment.inputs.sampling_distance = 3
-        segment.inputs.write_deformation_fields = [False, False]
+        for name, value in _SEGMENT_INPUTS.items():
+            setattr(segment.inputs, name, value)
 
-        segment.run()
+        with external_job_slot():
+            segment.run()
 
-        P = glob.glob(os.path.join(imgpath, f"c*{filename}"))
+        # c1-c3 in tissue order (glob order is arbitrary)
+        P = sorted(glob.glob(os.path.join(imgpath, f"c[123]{filename}")))
         V = [nib.load(p) for p in P[:3]]
         mvol = np.stack([v.get_fdata() for v in V], axis=-1)
         mask = np.sum(mvol, axis=-1)
@@ -90,14 +242,17 @@ def mricloud_getBrainMask(imgtpm: str, imgfile: str):
         for ss in range(mask.shape[2]):
             mask[:, :, ss] = binary_fill_holes(mask[:, :, ss])
 
+        from skimage.morphology import ball
+
         se = ball(1)
         mask1 = binary_erosion(mask, se)
         brnmsk_clcu = mask1 & brnmsk_realign
         brnmsk_dspl = mask & brnmsk_realign
+        if entry is not None:
+            _segment_cache_store(entry, P[:3], brnmsk_dspl, brnmsk_clcu)
     else:
         thre = 0.5
-        mask1 = mricloud_inbrain(imgvol, thre, 2, 1)
-        mask2 = mricloud_inbrain(imgvol, thre, 2, 2)
+        mask1, mask2 = mricloud_inbrain_masks(imgvol, thre, [(2, 1), (2, 2)])
         brnmsk_clcu = mask1 & brnmsk_realign
         brnmsk_dspl = mask2 & brnmsk_realign
 
@@ -158,15 +313,14 @@ def mricloud_skullstrip(path_mpr: str, name_mpr: str):
     files = [f for f in os.listdir(path_mpr) if re.match(regex, f)]
     roimaskfile = files[0]
     maskvol, allmask = load_img(os.path.join(path_mpr, roimaskfile))
-    brainmask = np.zeros_like(allmask)
-    for ii in range(label_num):
-        if len(roi_lookup_all[ii]) > 4:
-            brainmask[allmask == (ii + 1)] = 1
+    # labels with a Type1-L2 entry (column 4) are brain
+    in_brain = np.array([False] + [len(row) > 4 for row in roi_lookup_all])
+    brainmask = in_brain[label_index(allmask, label_num)].astype(allmask.dtype)
     mpr_brain_data = mpr * brainmask
     mpr_brain_img = nib.Nifti1Image(mpr_brain_data, mVol.affine, mVol.header)
     mpr_brain_img.header["descrip"] = b"mricloud_pipeline"
     mpr_brain_file = os.path.join(path_mpr, f"{name_mpr}_brain.nii")
-    mpr_brain_img.to_filename(mpr_brain_file)
+    save_img(mpr_brain_img, mpr_brain_file)
     return mpr_brain_file
 
 def mricloud_func_gkm_pcasl_multidelay(
@@ -241,6 +395,83 @@ def mricloud_func_gkm_pasl_looklocker(
 
     return mm
 
+def mricloud_gkm_pcasl_multidelay_jac(
+    beta: np.ndarray, casl_dur: float, plds: np.ndarray, paras: dict
+):
+    # Batched form of mricloud_func_gkm_pcasl_multidelay with its analytic
+    # Jacobian. beta: (n, 2) [cbf, att], plds: (n, m). Returns mm (n, m) and
+    # jac (n, m, 2). Samples are evaluated in place, which equals the
+    # concatenated scalar model for ascending PLDs.
+    t1_blood = paras["t1_blood"]
+    part_coef = paras["part_coef"]
+    labl_eff = paras["labl_eff"]
+
+    cbf = beta[:, 0:1]
+    att = beta[:, 1:2]
+    kk = 2 * labl_eff * t1_blood / part_coef / 6000
+
+    e_att = np.exp(-att / t1_blood)
+    e_end = np.exp(-(casl_dur + plds) / t1_blood)
+    in_w2 = ((plds + casl_dur) >= att) & (plds < att)
+    in_w3 = plds >= att
+
+    shape = np.where(in_w3, np.exp(-plds / t1_blood) - e_end, 0.0)
+    shape = np.where(in_w2, e_att - e_end, shape)
+
+    mm = kk * cbf * shape
+    jac = np.empty(mm.shape + (2,))
+    jac[..., 0] = kk * shape
+    jac[..., 1] = np.where(in_w2, -kk * cbf * e_att / t1_blood, 0.0)
+
+    return mm, jac
+
+def mricloud_gkm_pasl_looklocker_jac(
+    beta: np.ndarray,
+    pasl_dur: float,
+    tis: np.ndarray,
+    flip_angle: float,
+    paras: dict,
+):
+    # Batched form of mricloud_func_gkm_pasl_looklocker with its analytic
+    # Jacobian. beta: (n, 2) [cbf, att], tis: (n, m). Slice timing only
+    # shifts each row, so the Look-Locker interval is taken from the first.
+    t1_blood = paras["t1_blood"]
+    part_coef = paras["part_coef"]
+    labl_eff = paras["labl_eff"]
+
+    cbf = beta[:, 0:1]
+    att = beta[:, 1:2]
+    t_tail = att + pasl_dur
+
+    flip_angle = flip_angle / 180 * np.pi
+    tis_tmp = np.unique(tis[0])
+    ti_intvl = np.mean(tis_tmp[1:] - tis_tmp[:-1])
+
+    r1_blood = 1 / t1_blood
+    r1_appeff = r1_blood - np.log(np.cos(flip_angle)) / ti_intvl
+    delta_r = r1_blood - r1_appeff
+
+    const = 2 * labl_eff / part_coef / 6000 / delta_r * np.sin(flip_angle)
+
+    in_w2 = (tis >= att) & (tis < t_tail)
+    in_w3 = tis >= t_tail
+
+    e_dr = np.exp(delta_r * (tis - att))
+    decay2 = np.exp(-tis * r1_blood)
+    decay3 = np.exp(-t_tail * r1_blood) * np.exp(-r1_appeff * (tis - t_tail))
+
+    shape = np.where(in_w3, -(1 - e_dr) * decay3, 0.0)
+    shape = np.where(in_w2, -(1 - e_dr) * decay2, shape)
+    dshape = np.where(in_w3, -delta_r * decay3 * (2 * e_dr - 1), 0.0)
+    dshape = np.where(in_w2, -delta_r * e_dr * decay2, dshape)
+
+    mm = const * cbf * shape
+    jac = np.empty(mm.shape + (2,))
+    jac[..., 0] = const * shape
+    jac[..., 1] = const * cbf * dshape
+
+    return mm, jac
+
 def mricloud_read_roi_lists_info(roi_stats_file: str, roitypes: list):
     with open(roi_stats_file, "r") as file:
         alllines = file.readlines()
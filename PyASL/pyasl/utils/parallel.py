@@ -0,0 +1,372 @@
+"""
+Parallel execution helpers.
+
+Voxel-chunk executor
+--------------------
+Masked voxels are split into contiguous chunks and handed to a worker
+function, either in-process (``n_jobs=1``) or through a
+``ProcessPoolExecutor``. Input arrays are placed once in
+``multiprocessing.shared_memory`` and every worker process maps them at
+start-up, so a task only carries its (start, stop) range instead of a
+pickled copy of the data. Chunk results are concatenated in order.
+
+    def _fit_chunk(ydata, xdata, p0):      # module-level, picklable
+        ...
+        return params                      # (n_chunk, k)
+
+    params = run_voxel_chunks(
+        _fit_chunk, {"ydata": Y, "xdata": X}, n_jobs=8, chunk_size=4096, p0=p0
+    )
+
+Session scheduler
+-----------------
+`run_sessions` runs a per-session function for every entry of
+``data_descrip["Images"]`` in a process pool, each on its own copy of the
+data description. Failures are collected per session instead of aborting
+the cohort. SPM/FSL calls wrapped in `external_job_slot()` are limited to
+``max_external_jobs`` at a time across all workers. Workers start with the
+parent's image/segmentation cache and SPM batching settings, and their
+counters are added to the parent's, so the runners' statistics cover all
+sessions. `run_tasks` is the same scheduler for arbitrary named work items.
+"""
+
+from __future__ import annotations
+
+import copy
+import importlib
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from pyasl.utils.derivative_store import flush_active_store
+
+logger = logging.getLogger(__name__)
+
+# Arrays mapped by the current worker process (name -> ndarray view)
+_WORKER_ARRAYS: Dict[str, np.ndarray] = {}
+_WORKER_SHM: List[shared_memory.SharedMemory] = []
+
+
+def resolve_n_jobs(n_jobs: Optional[int]) -> int:
+    """Map a user `n_jobs` value to a worker count (None/0/-1 -> all cores)."""
+    ncpu = os.cpu_count() or 1
+    if n_jobs is None or int(n_jobs) == 0:
+        return ncpu
+    n_jobs = int(n_jobs)
+    if n_jobs < 0:
+        return max(1, ncpu + 1 + n_jobs)
+    return n_jobs
+
+
+def _init_worker(specs: Dict[str, Tuple[str, Tuple[int, ...], str]]) -> None:
+    """Pool initializer: attach the shared input arrays once per process."""
+    _WORKER_ARRAYS.clear()
+    for key, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _WORKER_SHM.append(shm)
+        arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        arr.flags.writeable = False
+        _WORKER_ARRAYS[key] = arr
+
+
+def _run_chunk(worker: Callable, start: int, stop: int, kwargs: Dict[str, Any]):
+    """Task body executed in a pool process."""
+    views = {key: arr[start:stop] for key, arr in _WORKER_ARRAYS.items()}
+    return worker(**views, **kwargs)
+
+
+def _concat(results: list):
+    """Stack chunk results; tuples are concatenated element-wise."""
+    if isinstance(results[0], tuple):
+        return tuple(np.concatenate(parts, axis=0) for parts in zip(*results))
+    return np.concatenate(results, axis=0)
+
+
+def run_voxel_chunks(
+    worker: Callable,
+    arrays: Dict[str, np.ndarray],
+    n_jobs: Optional[int] = 1,
+    chunk_size: int = 4096,
+    **kwargs: Any,
+):
+    """
+    Apply `worker` to consecutive voxel chunks and reassemble the results.
+
+    Parameters
+    ----------
+    worker : callable
+        Module-level function ``worker(**chunk_arrays, **kwargs)`` returning an
+        array (or a tuple of arrays) whose first axis is the chunk's voxels.
+    arrays : dict[str, np.ndarray]
+        Per-voxel inputs, all with the voxel axis first and the same length.
+    n_jobs : int, optional
+        Number of worker processes; 1 runs in-process, None/0/-1 use all cores.
+    chunk_size : int
+        Number of voxels per task.
+    **kwargs
+        Small, picklable constants forwarded to every call.
+
+    Returns
+    -------
+    np.ndarray or tuple of np.ndarray
+        Chunk outputs concatenated along the voxel axis.
+    """
+    if not arrays:
+        raise ValueError("run_voxel_chunks requires at least one input array.")
+    lengths = {len(a) for a in arrays.values()}
+    if len(lengths) != 1:
+        raise ValueError("All chunked arrays must have the same first dimension.")
+    n_vox = lengths.pop()
+    chunk_size = max(1, int(chunk_size))
+    bounds = [(s, min(s + chunk_size, n_vox)) for s in range(0, n_vox, chunk_size)]
+    if not bounds:
+        bounds = [(0, 0)]
+
+    n_workers = min(resolve_n_jobs(n_jobs), len(bounds))
+    if n_workers <= 1:
+        results = [
+            worker(**{k: a[s:e] for k, a in arrays.items()}, **kwargs) for s, e in bounds
+        ]
+        return _concat(results)
+
+    logger.info(
+        "Fitting %d voxels in %d chunks on %d worker processes.",
+        n_vox, len(bounds), n_workers,
+    )
+    blocks: List[shared_memory.SharedMemory] = []
+    try:
+        specs = {}
+        for key, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+            blocks.append(shm)
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            specs[key] = (shm.name, arr.shape, arr.dtype.str)
+
+        with ProcessPoolExecutor(
+            max_workers=n_workers, initializer=_init_worker, initargs=(specs,)
+        ) as pool:
+            futures = [pool.submit(_run_chunk, worker, s, e, kwargs) for s, e in bounds]
+            results = [f.result() for f in futures]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return _concat(results)
+
+
+# Semaphore limiting concurrent external (SPM/FSL) jobs in session workers
+_EXTERNAL_SLOTS = None
+
+# Process-wide state of other modules that session workers take over from
+# the parent (settings) and report back per task (counters):
+# module -> (state attribute, setting names, counter names)
+_WORKER_STATE = {
+    "pyasl.utils.utils": ("_IMAGE_CACHE", ("max_bytes",), ("hits", "misses")),
+    "pyasl.utils.mricloud_helpers": ("_SEGMENT_CACHE", ("enabled",), ("hits", "misses")),
+    "pyasl.utils.spm_batch": ("_SPM_BATCH", ("enabled",), ("batches", "jobs", "startup_s", "saved_s")),
+}
+
+
+@contextmanager
+def external_job_slot():
+    """
+    Hold one external-job slot (no-op outside a parallel session run).
+
+    Pending derivative-store writes are flushed first, since the external
+    tool reads its inputs from disk.
+    """
+    flush_active_store()
+    if _EXTERNAL_SLOTS is None:
+        yield
+        return
+    with _EXTERNAL_SLOTS:
+        yield
+
+
+def _state_get(state, name):
+    return state[name] if isinstance(state, dict) else getattr(state, name)
+
+
+def _state_set(state, name, value) -> None:
+    if isinstance(state, dict):
+        state[name] = value
+    else:
+        setattr(state, name, value)
+
+
+def _worker_settings() -> Dict[str, Dict[str, Any]]:
+    """Settings of the `_WORKER_STATE` modules imported by this process."""
+    settings = {}
+    for mod_name, (attr, names, _) in _WORKER_STATE.items():
+        mod = sys.modules.get(mod_name)
+        if mod is not None:
+            state = getattr(mod, attr)
+            settings[mod_name] = {name: _state_get(state, name) for name in names}
+    return settings
+
+
+def _take_counters() -> Dict[str, Dict[str, Any]]:
+    """Counters of the `_WORKER_STATE` modules since the last call (reset to 0)."""
+    counters = {}
+    for mod_name, (attr, _, names) in _WORKER_STATE.items():
+        mod = sys.modules.get(mod_name)
+        if mod is not None:
+            state = getattr(mod, attr)
+            counters[mod_name] = {name: _state_get(state, name) for name in names}
+            for name in names:
+                _state_set(state, name, type(counters[mod_name][name])())
+    return counters
+
+
+def _add_counters(counters: Dict[str, Dict[str, Any]]) -> None:
+    """Add a worker's counters to this process's module state."""
+    for mod_name, values in counters.items():
+        state = getattr(importlib.import_module(mod_name), _WORKER_STATE[mod_name][0])
+        for name, value in values.items():
+            _state_set(state, name, _state_get(state, name) + value)
+
+
+def _init_session_worker(slots, settings: Dict[str, Dict[str, Any]]) -> None:
+    """Pool initializer: external-job slots and the parent's module settings."""
+    global _EXTERNAL_SLOTS
+    _EXTERNAL_SLOTS = slots
+    # Workers started with spawn/forkserver do not inherit module globals
+    for mod_name, values in settings.items():
+        state = getattr(importlib.import_module(mod_name), _WORKER_STATE[mod_name][0])
+        for name, value in values.items():
+            _state_set(state, name, value)
+
+
+def session_params(params: dict) -> dict:
+    """
+    Step parameters for a session worker: `n_jobs` is forced to 1 so steps
+    with voxel/thread parallelism stay in-process instead of every session
+    worker starting a pool of its own.
+    """
+    return {**params, "n_jobs": 1}
+
+
+def split_sessions(data_descrip: dict) -> Dict[str, dict]:
+    """One data description per session, each holding a single `Images` entry."""
+    shared = {k: v for k, v in data_descrip.items() if k != "Images"}
+    return {
+        key: {**copy.deepcopy(shared), "Images": {key: copy.deepcopy(value)}}
+        for key, value in data_descrip["Images"].items()
+    }
+
+
+def _run_session_task(session_fn: Callable, session_descrip: dict) -> Tuple[Optional[str], Dict]:
+    """
+    Run one session; returns (formatted traceback on failure or None,
+    the task's `_WORKER_STATE` counters).
+    """
+    cwd = os.getcwd()
+    _take_counters()
+    err = None
+    # Private working directory: nipype writes its pyscript_*.m files to cwd
+    with tempfile.TemporaryDirectory(prefix="pyasl_session_") as tmp:
+        os.chdir(tmp)
+        try:
+            session_fn(session_descrip)
+        except Exception:
+            err = traceback.format_exc()
+        finally:
+            os.chdir(cwd)
+    return err, _take_counters()
+
+
+def run_sessions(
+    session_fn: Callable[[dict], Any],
+    data_descrip: dict,
+    n_jobs: Optional[int] = 1,
+    max_external_jobs: Optional[int] = None,
+) -> Dict[str, str]:
+    """
+    Run `session_fn(session_descrip)` for every session in a process pool.
+
+    Parameters
+    ----------
+    session_fn : callable
+        Picklable function (module-level, or a functools.partial of one)
+        running all pipeline steps for a single-session data description.
+    data_descrip : dict
+        Cohort data description; split with `split_sessions`.
+    n_jobs : int, optional
+        Number of worker processes; None/0/-1 use all cores.
+    max_external_jobs : int, optional
+        Maximum number of concurrent SPM/FSL jobs (default: unlimited).
+
+    Returns
+    -------
+    dict[str, str]
+        Failed sessions mapped to their tracebacks (empty if all succeeded).
+    """
+    return run_tasks(session_fn, split_sessions(data_descrip), n_jobs, max_external_jobs)
+
+
+def run_tasks(
+    task_fn: Callable[[Any], Any],
+    tasks: Dict[str, Any],
+    n_jobs: Optional[int] = 1,
+    max_external_jobs: Optional[int] = None,
+    label: str = "session",
+) -> Dict[str, str]:
+    """
+    Run `task_fn(arg)` for every `(name, arg)` in `tasks` in a process pool.
+
+    Same scheduling and failure handling as `run_sessions`, for work items
+    that are not sessions of a data description (e.g. Bruker scans).
+    `label` is only used in log messages.
+
+    Returns
+    -------
+    dict[str, str]
+        Failed tasks mapped to their tracebacks (empty if all succeeded).
+    """
+    n_workers = max(1, min(resolve_n_jobs(n_jobs), len(tasks)))
+    mp_ctx = multiprocessing.get_context()
+    slots = mp_ctx.BoundedSemaphore(int(max_external_jobs)) if max_external_jobs else None
+    logger.info(
+        "Running %d %ss on %d worker processes (external jobs: %s).",
+        len(tasks), label, n_workers, max_external_jobs or "unlimited",
+    )
+
+    failures: Dict[str, str] = {}
+    if not tasks:
+        return failures
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=mp_ctx,
+        initializer=_init_session_worker,
+        initargs=(slots, _worker_settings()),
+    ) as pool:
+        futures = {
+            pool.submit(_run_session_task, task_fn, arg): key
+            for key, arg in tasks.items()
+        }
+        for done, fut in enumerate(as_completed(futures), 1):
+            key = futures[fut]
+            try:
+                err, counters = fut.result()
+                _add_counters(counters)
+            except Exception:
+                err = traceback.format_exc()
+            if err:
+                failures[key] = err
+                logger.error("%s %s failed:\n%s", label.capitalize(), key, err)
+            else:
+                logger.info("%s %s finished (%d/%d).", label.capitalize(), key, done, len(tasks))
+
+    if failures:
+        logger.error("%d of %d %ss failed: %s", len(failures), len(tasks), label, ", ".join(failures))
+    return failures
@@ -0,0 +1,63 @@
+"""
+Step parameter path resolution.
+
+Relative paths in step parameters are taken from the dataset root rather
+than from the process working directory, so a config behaves the same
+whether sessions run serially or in session workers (which run in a
+private temporary directory).
+
+    params = resolve_paths(step.get("params") or {}, Path(root).resolve())
+
+A string is resolved when its key is in `PATHY_KEYS` or when it looks like
+a path (contains a separator or an image extension). Keys in
+`SELF_RESOLVED_KEYS` are relative to another base and are left to the
+module. `{root}` / `${root}` placeholders are expanded.
+"""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Optional
+
+# Keys that likely refer to paths
+PATHY_KEYS = {
+    "path", "paths", "in", "infile", "infiles", "outfile", "out", "dir",
+    "savedir", "basedir", "root", "mask", "anat", "asl", "m0", "log", "logdir",
+    "data_path", "weights_dir", "onnx_dir", "mask_path", "out_mask",
+}
+
+# Keys the modules resolve against their own base (derivatives, perf dir)
+SELF_RESOLVED_KEYS = {"results_db", "cbf_file"}
+
+
+def looks_like_path(s: str) -> bool:
+    """Heuristically decide if a string looks like a file path."""
+    return any(t in s for t in ("/", "\\", ".nii", ".nii.gz", ".img", ".hdr"))
+
+
+def resolve_one(s: str, base: Path) -> str:
+    """Resolve a single path against a base directory."""
+    if "{root}" in s or "${root}" in s:
+        s = s.replace("${root}", "{root}").format(root=str(base))
+    p = Path(s)
+    return str(p if p.is_absolute() else (base / p).resolve())
+
+
+def resolve_paths(obj: Any, base: Path, parent: Optional[str] = None) -> Any:
+    """
+    Recursively resolve paths in a dict/list/str.
+
+    Any value whose key is in `PATHY_KEYS` or looks like a path
+    will be converted to an absolute path.
+    """
+    if isinstance(obj, dict):
+        return {k: resolve_paths(v, base, k) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [resolve_paths(v, base, parent) for v in obj]
+    if isinstance(obj, str) and parent not in SELF_RESOLVED_KEYS:
+        if (parent and parent in PATHY_KEYS) or looks_like_path(obj):
+            try:
+                return resolve_one(obj, base)
+            except Exception:
+                return obj
+    return obj
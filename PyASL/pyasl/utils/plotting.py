@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import os
 
 def get_plot_array(data: np.ndarray, winf: list):
@@ -14,6 +13,8 @@ def get_plot_array(data: np.ndarray, winf: list):
     return target
 
 def plot_save_fig(data: np.ndarray, fig_title: str, fig_path: str, range=None):
+    import matplotlib.pyplot as plt
+
     os.makedirs(os.path.dirname(fig_path) or ".", exist_ok=True)
     plt.figure()
     if not range:
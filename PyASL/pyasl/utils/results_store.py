@@ -0,0 +1,253 @@
+"""
+Cohort results store.
+
+SQLite database collecting regional and global CBF results as pipelines
+run, so cohort statistics do not need thousands of per-session text files
+to be parsed. Enabled per step with the `results_db` parameter
+(MRICloudT1ROICBFAverage, PerfusionQuantify):
+
+    - name: MRICloudT1ROICBFAverage
+      params: { results_db: results.sqlite }
+
+Relative paths are resolved against the dataset's `derivatives` folder.
+Rows are keyed on (subject, session, asl_file, ...); a re-run replaces all
+rows of its series, so ROIs or pairs that no longer occur are dropped. The database is in WAL mode with a busy timeout, so parallel
+session workers can write to it concurrently.
+
+Tables
+------
+roi_cbf        subject, session, asl_file, level, roi_index, label, acbf, rcbf, nvox
+global_signal  subject, session, asl_file, pair, perf_clean, cbf_clean, perf_whole, cbf_whole
+
+`level` is the number of ROIs of the segmentation level (e.g. 9/19 for
+Type1-L2/L3, 283 for all labels). `cohort_summary` aggregates in SQL
+(standard deviations with Welford's algorithm, registered as the `STDEV`
+aggregate) and returns a pandas DataFrame:
+
+    from pyasl.utils.results_store import cohort_summary
+    df = cohort_summary("derivatives/results.sqlite", level=9)
+"""
+
+from __future__ import annotations
+
+import math
+import os
+import sqlite3
+from contextlib import closing
+from typing import Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS roi_cbf (
+    subject   TEXT NOT NULL,
+    session   TEXT NOT NULL,
+    asl_file  TEXT NOT NULL,
+    level     INTEGER NOT NULL,
+    roi_index INTEGER NOT NULL,
+    label     TEXT NOT NULL,
+    acbf      REAL,
+    rcbf      REAL,
+    nvox      INTEGER NOT NULL,
+    PRIMARY KEY (subject, session, asl_file, level, roi_index)
+);
+CREATE INDEX IF NOT EXISTS roi_cbf_label ON roi_cbf (level, label);
+CREATE TABLE IF NOT EXISTS global_signal (
+    subject    TEXT NOT NULL,
+    session    TEXT NOT NULL,
+    asl_file   TEXT NOT NULL,
+    pair       INTEGER NOT NULL,
+    perf_clean REAL,
+    cbf_clean  REAL,
+    perf_whole REAL,
+    cbf_whole  REAL,
+    PRIMARY KEY (subject, session, asl_file, pair)
+);
+"""
+
+# Seconds a writer waits for another worker's transaction
+BUSY_TIMEOUT = 60.0
+
+
+def session_ids(key: str) -> Tuple[str, str]:
+    """
+    (subject, session) of a data description key: the path components
+    following `derivatives` (or `rawdata`); session is "" if absent.
+    """
+    parts = os.path.normpath(key).split(os.sep)
+    for base in ("derivatives", "rawdata"):
+        if base in parts:
+            rest = parts[len(parts) - parts[::-1].index(base):]
+            if rest:
+                return rest[0], rest[1] if len(rest) > 1 else ""
+    return os.path.basename(os.path.normpath(key)), ""
+
+
+def resolve_db_path(path: str, key: str) -> str:
+    """Absolute database path; relative paths are taken from the `derivatives` folder of `key`."""
+    if os.path.isabs(path):
+        return path
+    parts = os.path.abspath(key).split(os.sep)
+    if "derivatives" in parts:
+        base = os.sep.join(parts[: len(parts) - parts[::-1].index("derivatives")])
+    else:
+        base = os.getcwd()
+    return os.path.join(base, path)
+
+
+def _clean(x) -> Optional[float]:
+    # NaN (empty ROI) is stored as NULL, which SQL aggregates skip
+    x = float(x)
+    return None if np.isnan(x) else x
+
+
+class _Stdev:
+    """SQLite aggregate: sample standard deviation (Welford), NULL below two values."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def step(self, x) -> None:
+        if x is None:
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def finalize(self) -> Optional[float]:
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else None
+
+
+class ResultsStore:
+    """Connection to a results database; use as a context manager."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+
+    def set_roi_stats(
+        self,
+        subject: str,
+        session: str,
+        asl_file: str,
+        levels: Iterable[Tuple[int, Sequence[str], Iterable[float], Iterable[float], Iterable[int]]],
+    ) -> None:
+        """
+        Replace the ROI rows of one series. `levels` holds one
+        (level, labels, acbf, rcbf, nvox) tuple per segmentation level; ROI
+        indices are 1-based.
+        """
+        rows = [
+            (subject, session, asl_file, int(level), ii + 1, str(name), _clean(a), _clean(r), int(n))
+            for level, labels, acbf, rcbf, nvox in levels
+            for ii, (name, a, r, n) in enumerate(zip(labels, acbf, rcbf, nvox))
+        ]
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM roi_cbf WHERE subject = ? AND session = ? AND asl_file = ?",
+                (subject, session, asl_file),
+            )
+            self.conn.executemany("INSERT INTO roi_cbf VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def set_global_signal(self, subject: str, session: str, asl_file: str, gs: np.ndarray) -> None:
+        """
+        Replace the per-pair global signal of one series: `gs` is the
+        (pairs, 4) array written to `*_globalsg.txt`.
+        """
+        rows = [
+            (subject, session, asl_file, p + 1, *(_clean(v) for v in gs[p, :4]))
+            for p in range(gs.shape[0])
+        ]
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM global_signal WHERE subject = ? AND session = ? AND asl_file = ?",
+                (subject, session, asl_file),
+            )
+            self.conn.executemany("INSERT INTO global_signal VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "ResultsStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def query(path: str, sql: str, params: Sequence = ()):
+    """
+    Run a read query on a results database and return a pandas DataFrame;
+    the `STDEV` aggregate is available.
+    """
+    import pandas as pd
+
+    # the connection's context manager only ends transactions; close it here
+    with closing(sqlite3.connect(path, timeout=BUSY_TIMEOUT)) as conn:
+        conn.create_aggregate("STDEV", 1, _Stdev)
+        return pd.read_sql_query(sql, conn, params=list(params))
+
+
+def cohort_summary(
+    path: str,
+    level: Optional[int] = None,
+    table: str = "roi_cbf",
+    min_nvox: int = 1,
+):
+    """
+    Cohort statistics per ROI or of the global signal.
+
+    Parameters
+    ----------
+    path : str
+        Results database.
+    level : int, optional
+        Restrict `roi_cbf` to one segmentation level (number of ROIs).
+    table : str
+        "roi_cbf": one row per (level, roi_index, label) with the number of
+        series and subjects, mean/std/min/max of aCBF and rCBF across
+        series and the voxel-weighted mean aCBF.
+        "global_signal": one row per (subject, session, asl_file) with the
+        mean of each global signal over pairs.
+    min_nvox : int
+        ROIs with fewer voxels in a series are left out of that series.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if table == "global_signal":
+        return query(path, """
+            SELECT subject, session, asl_file, COUNT(*) AS n_pairs,
+                   AVG(perf_clean) AS perf_clean, AVG(cbf_clean) AS cbf_clean,
+                   AVG(perf_whole) AS perf_whole, AVG(cbf_whole) AS cbf_whole
+            FROM global_signal
+            GROUP BY subject, session, asl_file
+            ORDER BY subject, session, asl_file
+        """)
+    if table != "roi_cbf":
+        raise ValueError(f"table must be 'roi_cbf' or 'global_signal', got '{table}'")
+
+    where, params = "nvox >= ?", [int(min_nvox)]
+    if level is not None:
+        where += " AND level = ?"
+        params.append(int(level))
+    return query(path, f"""
+        SELECT level, roi_index, label,
+               COUNT(acbf) AS n_series, COUNT(DISTINCT subject) AS n_subjects,
+               AVG(acbf) AS acbf_mean, STDEV(acbf) AS acbf_std, MIN(acbf) AS acbf_min, MAX(acbf) AS acbf_max,
+               AVG(rcbf) AS rcbf_mean, STDEV(rcbf) AS rcbf_std,
+               SUM(acbf * nvox) / SUM(CASE WHEN acbf IS NULL THEN 0 ELSE nvox END) AS acbf_voxel_mean,
+               AVG(nvox) AS nvox_mean
+        FROM roi_cbf
+        WHERE {where}
+        GROUP BY level, roi_index, label
+        ORDER BY level, roi_index
+    """, params)
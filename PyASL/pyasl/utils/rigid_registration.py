@@ -0,0 +1,569 @@
+"""
+Native rigid-body registration.
+
+NumPy/SciPy replacement for SPM Realign that runs without MATLAB.
+
+Conventions follow SPM:
+  - Rigid transforms are world (mm) 4x4 matrices parameterised like
+    spm_matrix / spm_imatrix: (x, y, z) translations in mm and
+    (pitch, roll, yaw) rotations in radians, M = T * Rx * Ry * Rz.
+  - A transform M maps a point of the reference space to the corresponding
+    point of the moving image, so the moving voxel sampled for reference
+    world point x is inv(A_moving) @ M @ x.
+
+Realignment (`realign_series`) minimises the sum of squared differences
+between each smoothed volume and a reference with Gauss-Newton iterations
+on a coarse-to-fine grid of reference points. Volumes are estimated in a
+thread pool. With `register_to_mean` a second pass registers every volume
+to the mean of the first-pass resliced series. In control/label-aware mode
+that mean is taken per volume type (control, label, M0), so the label
+signal does not bias the estimates.
+
+Coregistration (`estimate_rigid_nmi`, `coregister_files`) follows
+spm_coreg: normalised mutual information of a joint histogram of the two
+images, optimised with Powell's method over a coarse-to-fine list of
+sampling distances.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Sequence
+
+import nibabel as nib
+import numpy as np
+from nibabel.openers import Opener
+from scipy import ndimage
+
+from pyasl.utils.derivative_store import flush_active_store
+from pyasl.utils.parallel import resolve_n_jobs
+from pyasl.utils.utils import load_img, save_img
+
+logger = logging.getLogger(__name__)
+
+_FWHM2SIGMA = 1.0 / np.sqrt(8.0 * np.log(2.0))
+
+
+def rigid_matrix(q: Sequence[float]) -> np.ndarray:
+    """4x4 matrix from (tx, ty, tz, pitch, roll, yaw), as spm_matrix."""
+    tx, ty, tz, p, r, y = q
+    T = np.eye(4)
+    T[:3, 3] = tx, ty, tz
+    c, s = np.cos(p), np.sin(p)
+    R1 = np.array([[1, 0, 0, 0], [0, c, s, 0], [0, -s, c, 0], [0, 0, 0, 1]])
+    c, s = np.cos(r), np.sin(r)
+    R2 = np.array([[c, 0, s, 0], [0, 1, 0, 0], [-s, 0, c, 0], [0, 0, 0, 1]])
+    c, s = np.cos(y), np.sin(y)
+    R3 = np.array([[c, s, 0, 0], [-s, c, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]])
+    return T @ R1 @ R2 @ R3
+
+
+def rigid_params(M: np.ndarray) -> np.ndarray:
+    """(tx, ty, tz, pitch, roll, yaw) of a rigid 4x4 matrix, as spm_imatrix."""
+    R = M[:3, :3]
+    roll = np.arcsin(np.clip(R[0, 2], -1.0, 1.0))
+    c = np.cos(roll)
+    if abs(c) < 1e-12:
+        pitch = 0.0
+        yaw = np.arctan2(-R[1, 0], -R[2, 0] / R[0, 2])
+    else:
+        pitch = np.arctan2(R[1, 2] / c, R[2, 2] / c)
+        yaw = np.arctan2(R[0, 1] / c, R[0, 0] / c)
+    return np.array([M[0, 3], M[1, 3], M[2, 3], pitch, roll, yaw])
+
+
+def _matrix_derivatives(q: np.ndarray, h: float = 1e-6) -> np.ndarray:
+    """d rigid_matrix / d q_k for k = 0..5 (central differences), shape (6, 4, 4)."""
+    out = np.empty((6, 4, 4))
+    for k in range(6):
+        dq = np.zeros(6)
+        dq[k] = h
+        out[k] = (rigid_matrix(q + dq) - rigid_matrix(q - dq)) / (2 * h)
+    return out
+
+
+def voxel_sizes(affine: np.ndarray) -> np.ndarray:
+    return np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+
+
+def smooth_fwhm(vol: np.ndarray, affine: np.ndarray, fwhm) -> np.ndarray:
+    """Gaussian smoothing of a 3D volume with a FWHM in mm."""
+    fwhm = np.broadcast_to(np.asarray(fwhm, dtype=float), (3,))
+    if not np.any(fwhm > 0):
+        return vol
+    sigma = fwhm * _FWHM2SIGMA / voxel_sizes(affine)
+    return ndimage.gaussian_filter(vol, sigma, mode="nearest")
+
+
+def sample_points(ref: np.ndarray, affine: np.ndarray, sep: float, quality: float = 1.0):
+    """
+    Reference sample points on a grid `sep` mm apart.
+
+    Returns voxel (3, n) and world (4, n) coordinates plus reference values.
+    With quality < 1 only that fraction of points with the largest reference
+    gradient (the most informative ones for motion) is kept.
+    """
+    shape = np.array(ref.shape[:3])
+    step = np.maximum(1, np.round(sep / voxel_sizes(affine)).astype(int))
+    grids = [np.arange(0, n, s) for n, s in zip(shape, step)]
+    vox = np.stack(np.meshgrid(*grids, indexing="ij"), axis=0).reshape(3, -1).astype(float)
+    values = ref[tuple(vox.astype(int))]
+    if quality < 1.0 and vox.shape[1] > 64:
+        grad = np.sqrt(sum(g[tuple(vox.astype(int))] ** 2 for g in np.gradient(ref)))
+        keep = np.argsort(grad)[::-1][: max(64, int(quality * vox.shape[1]))]
+        keep.sort()
+        vox, values = vox[:, keep], values[keep]
+    world = affine @ np.vstack([vox, np.ones(vox.shape[1])])
+    return vox, world, values
+
+
+class _Moving:
+    """Smoothed moving volume with its spatial gradients, for sampling."""
+
+    def __init__(self, vol: np.ndarray, affine: np.ndarray):
+        self.vol = vol
+        self.inv_affine = np.linalg.inv(affine)
+        self.grads = np.gradient(vol)
+        self.upper = np.array(vol.shape[:3]) - 1.0
+
+    def sample(self, coords: np.ndarray):
+        valid = np.all((coords >= 0) & (coords <= self.upper[:, None]), axis=0)
+        c = coords[:, valid]
+        f = ndimage.map_coordinates(self.vol, c, order=1, mode="nearest")
+        g = np.stack([ndimage.map_coordinates(gr, c, order=1, mode="nearest") for gr in self.grads])
+        return valid, f, g
+
+
+# Step halvings tried when a Gauss-Newton step increases the SSD
+_MAX_HALVINGS = 4
+
+
+def estimate_rigid_ssd(
+    moving: _Moving,
+    points: Sequence[tuple],
+    q0: Optional[np.ndarray] = None,
+    max_iter: int = 32,
+    tol: float = 1e-4,
+) -> np.ndarray:
+    """
+    Gauss-Newton least-squares rigid registration of one volume.
+
+    `points` is a coarse-to-fine list of (world (4, n), reference values (n,))
+    tuples from `sample_points`; returns the parameters q of the transform
+    mapping reference world to moving world. A step that increases the cost
+    is halved (up to `_MAX_HALVINGS` times) before the level is given up.
+    """
+    q = np.zeros(6) if q0 is None else np.array(q0, dtype=float)
+    for world, ref_vals in points:
+        prev_q, prev_cost, step, halvings = q, np.inf, None, 0
+        for _ in range(max_iter):
+            M = rigid_matrix(q)
+            coords = (moving.inv_affine @ M @ world)[:3]
+            valid, f, g = moving.sample(coords)
+            if valid.sum() < 12:
+                break
+            r = f - ref_vals[valid]
+            cost = float(r @ r) / valid.sum()
+            if cost > prev_cost:
+                if halvings == _MAX_HALVINGS:
+                    q = prev_q
+                    break
+                # last step overshot: retry half of it from the accepted point
+                step = step / 2
+                q = prev_q + step
+                halvings += 1
+                continue
+            halvings = 0
+            # d(voxel coords)/dq for every point: inv(A) @ dM/dq @ x
+            dM = _matrix_derivatives(q)
+            dcoords = np.einsum("ij,kjl,ln->kin", moving.inv_affine[:3], dM, world[:, valid])
+            J = np.einsum("in,kin->nk", g, dcoords)
+            step, *_ = np.linalg.lstsq(J, -r, rcond=None)
+            prev_q, prev_cost = q, cost
+            q = q + step
+            # translations in mm, rotations in rad (x ~50 mm lever arm)
+            if np.max(np.abs(step * [1, 1, 1, 50, 50, 50])) < tol:
+                break
+    return q
+
+
+def reslice_coords(affine: np.ndarray, ref_affine: np.ndarray, shape, M: np.ndarray):
+    """
+    Source voxel coordinates (3, n) of every voxel of the grid (`ref_affine`,
+    `shape`) through transform M.
+    """
+    grids = np.meshgrid(*[np.arange(n, dtype=float) for n in shape[:3]], indexing="ij")
+    vox = np.stack([g.ravel() for g in grids] + [np.ones(grids[0].size)])
+    return (np.linalg.inv(affine) @ M @ ref_affine @ vox)[:3]
+
+
+def _inside(coords: np.ndarray, source_shape) -> np.ndarray:
+    upper = np.array(source_shape[:3])[:, None] - 1.0
+    return np.all((coords >= -1e-3) & (coords <= upper + 1e-3), axis=0)
+
+
+def reslice(vol: np.ndarray, affine: np.ndarray, ref_affine: np.ndarray, shape, M: np.ndarray,
+            order: int = 1):
+    """
+    Resample `vol` onto the grid (`ref_affine`, `shape`) through transform M.
+
+    Returns the resliced volume and a mask of the voxels that fell inside
+    the source field of view.
+    """
+    coords = reslice_coords(affine, ref_affine, shape, M)
+    inside = _inside(coords, vol.shape)
+    out = ndimage.map_coordinates(vol, coords, order=order, mode="nearest", prefilter=order > 1)
+    return out.reshape(shape[:3]), inside.reshape(shape[:3])
+
+
+def realign_series(
+    data: np.ndarray,
+    affine: np.ndarray,
+    quality: float = 0.9,
+    fwhm: float = 5.0,
+    sep: float = 4.0,
+    register_to_mean: bool = True,
+    classes: Optional[Sequence] = None,
+    n_jobs: Optional[int] = -1,
+) -> Dict[str, np.ndarray]:
+    """
+    Estimate rigid motion of every volume of a 4D series.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        (X, Y, Z, N) series sharing one voxel-to-world `affine`.
+    quality, fwhm, sep :
+        SPM-style estimation options: fraction of sample points kept,
+        smoothing kernel (mm) and sampling distance (mm) of the finest level
+        (a level at 2*sep is run first).
+    register_to_mean : bool
+        Second pass against the mean of the first-pass resliced volumes.
+    classes : sequence, optional
+        Volume type per volume (e.g. "control"/"label"/"m0scan"). When given,
+        the second pass registers each volume to the mean of its own type.
+    n_jobs : int, optional
+        Threads used across volumes (None/0/-1: all cores).
+
+    Returns
+    -------
+    dict
+        ``M`` (N, 4, 4) transforms from the registration reference space to
+        each volume, ``rp`` (N, 6) SPM realignment parameters relative to
+        the first volume, and ``ref_affine``, the voxel-to-world matrix of
+        the realigned first volume (the reslice space).
+    """
+    nvol = data.shape[3]
+    n_threads = max(1, min(resolve_n_jobs(n_jobs), nvol))
+    levels = [2.0 * sep, float(sep)]
+
+    def smoothed(v):
+        return smooth_fwhm(np.asarray(v, dtype=np.float32), affine, fwhm)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        movers = list(pool.map(lambda i: _Moving(smoothed(data[..., i]), affine), range(nvol)))
+
+        def register_all(refs, q_init):
+            def one(i):
+                return estimate_rigid_ssd(movers[i], refs[i], q_init[i])
+            return np.array(list(pool.map(one, range(nvol))))
+
+        def points_for(ref):
+            return [sample_points(ref, affine, s, quality)[1:] for s in levels]
+
+        # Pass 1: register everything to the first volume
+        first = points_for(movers[0].vol)
+        q = register_all([first] * nvol, np.zeros((nvol, 6)))
+        q[0] = 0.0
+
+        if register_to_mean and nvol > 1:
+            if classes is None or len(classes) != nvol:
+                classes = ["all"] * nvol
+            resliced = list(pool.map(
+                lambda i: reslice(movers[i].vol, affine, affine, data.shape, rigid_matrix(q[i]))[0],
+                range(nvol),
+            ))
+            refs = {}
+            for c in set(classes):
+                members = [i for i in range(nvol) if classes[i] == c]
+                mean = np.mean([resliced[i] for i in members], axis=0)
+                refs[c] = points_for(mean)
+            # Pass 2: register to the (per-type) mean, starting from pass 1
+            q = register_all([refs[c] for c in classes], q)
+
+    M = np.array([rigid_matrix(qi) for qi in q])
+    # Parameters relative to the first volume, as SPM reports them:
+    # rp_i = imatrix(inv(M_i) @ M_1); resliced images live in the space of
+    # the realigned first volume.
+    rp = np.array([rigid_params(np.linalg.inv(Mi) @ M[0]) for Mi in M])
+    ref_affine = np.linalg.inv(M[0]) @ affine
+    return {"M": M, "rp": rp, "ref_affine": ref_affine}
+
+
+def reslice_series(
+    data: np.ndarray,
+    affine: np.ndarray,
+    M: np.ndarray,
+    ref_affine: np.ndarray,
+    order: int = 4,
+    which: Sequence[int] = (2, 1),
+    mask: bool = True,
+    n_jobs: Optional[int] = -1,
+):
+    """
+    Reslice a series with transforms from `realign_series`.
+
+    `which` follows SPM's write_which: which[0] = 2 reslices all volumes,
+    1 all but the first, 0 none; which[1] = 1 also returns the mean image.
+    With `mask`, voxels not sampled in every volume are set to zero.
+    Returns (resliced (X, Y, Z, n) or None, mean (X, Y, Z) or None).
+    """
+    nvol = data.shape[3]
+    n_threads = max(1, min(resolve_n_jobs(n_jobs), nvol))
+
+    def one(i):
+        vol = np.asarray(data[..., i], dtype=np.float32)
+        return reslice(vol, affine, ref_affine, data.shape, M[i], order=order)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        results = list(pool.map(one, range(nvol)))
+
+    valid = np.all([inside for _, inside in results], axis=0) if mask else None
+    out = None
+    if which[0] > 0:
+        start = 1 if which[0] == 1 else 0
+        out = np.stack([results[i][0] for i in range(start, nvol)], axis=-1)
+        if valid is not None:
+            out *= valid[..., None]
+    mean = None
+    if len(which) > 1 and which[1]:
+        mean = np.mean([r for r, _ in results], axis=0)
+        if valid is not None:
+            mean *= valid
+    return out, mean
+
+
+def write_rp(path: str, rp: np.ndarray) -> None:
+    """Write realignment parameters in SPM's rp_*.txt layout."""
+    np.savetxt(path, rp, fmt="%16.7e", delimiter="")
+
+
+# ---------------------------------------------------------------------------
+# Coregistration (normalised mutual information), as SPM Coregister
+# ---------------------------------------------------------------------------
+
+# SPM Coregister defaults
+COREG_SEPARATION = (4, 2)
+COREG_TOLERANCE = (0.02, 0.02, 0.02, 0.001, 0.001, 0.001)
+COREG_HIST_FWHM = (7, 7)
+
+
+def _rescale_255(vol: np.ndarray) -> np.ndarray:
+    """Intensities mapped to [0, 255] between the minimum and the 99.9th percentile."""
+    vol = np.asarray(vol, dtype=np.float32)
+    finite = vol[np.isfinite(vol)]
+    lo, hi = float(finite.min()), float(np.percentile(finite, 99.9))
+    if hi <= lo:
+        hi = lo + 1.0
+    return np.clip((vol - lo) * (255.0 / (hi - lo)), 0.0, 255.0)
+
+
+def joint_histogram(ref_vals: np.ndarray, mov_vals: np.ndarray, bins: int = 256) -> np.ndarray:
+    """
+    (bins, bins) joint histogram of two [0, bins-1] intensity samples.
+
+    Reference values are binned by rounding down; moving values are split
+    linearly between their two neighbouring bins, which keeps the cost
+    smooth in the transform parameters.
+    """
+    r = np.clip(ref_vals.astype(np.intp), 0, bins - 1)
+    m = np.clip(mov_vals, 0.0, bins - 1.0)
+    m0 = np.minimum(m.astype(np.intp), bins - 2)
+    w1 = m - m0
+    idx = r * bins + m0
+    H = np.bincount(idx, weights=1.0 - w1, minlength=bins * bins)
+    H += np.bincount(idx + 1, weights=w1, minlength=bins * bins)
+    return H.reshape(bins, bins)
+
+
+def nmi(H: np.ndarray, fwhm=COREG_HIST_FWHM) -> float:
+    """Normalised mutual information (H(A) + H(B)) / H(A, B) of a joint histogram."""
+    H = ndimage.gaussian_filter(H, np.asarray(fwhm, dtype=float) * _FWHM2SIGMA, mode="constant")
+    H = H / H.sum() + np.finfo(float).eps
+    s1, s2 = H.sum(axis=1), H.sum(axis=0)
+    return float((s1 @ np.log2(s1) + s2 @ np.log2(s2)) / np.sum(H * np.log2(H)))
+
+
+def estimate_rigid_nmi(
+    ref: np.ndarray,
+    ref_affine: np.ndarray,
+    src: np.ndarray,
+    src_affine: np.ndarray,
+    sep: Sequence[float] = COREG_SEPARATION,
+    tol: Sequence[float] = COREG_TOLERANCE,
+    fwhm=COREG_HIST_FWHM,
+    q0: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Rigid registration of `src` to `ref` maximising normalised mutual information.
+
+    As spm_coreg: both images are rescaled to 256 grey levels and smoothed
+    to the sampling distance of each level in `sep` (mm, coarse to fine);
+    the reference is sampled on a jittered grid at that distance, and the
+    joint histogram (smoothed by `fwhm` bins) is optimised with Powell's
+    method in units of `tol` (translations in mm, rotations in rad; only the
+    first six values are used). Returns q of the transform mapping
+    reference world to source world.
+    """
+    from scipy.optimize import minimize
+
+    sc = np.asarray(tol, dtype=float)[:6]
+    q = np.zeros(6) if q0 is None else np.array(q0, dtype=float)
+    ref255, src255 = _rescale_255(ref), _rescale_255(src)
+    inv_src = np.linalg.inv(src_affine)
+    src_upper = np.array(src.shape[:3])[:, None] - 1.0
+    rng = np.random.default_rng(0)
+
+    for s in sep:
+        ref_s = smooth_fwhm(ref255, ref_affine, np.sqrt(np.maximum(s**2 - voxel_sizes(ref_affine) ** 2, 0)))
+        src_s = smooth_fwhm(src255, src_affine, np.sqrt(np.maximum(s**2 - voxel_sizes(src_affine) ** 2, 0)))
+        # jittered sample grid, so the histogram does not alias with the voxel grid
+        step = s / voxel_sizes(ref_affine)
+        grids = [np.arange(0, n - 1, st) for n, st in zip(ref.shape[:3], step)]
+        vox = np.stack(np.meshgrid(*grids, indexing="ij"), axis=0).reshape(3, -1)
+        vox = np.minimum(vox + rng.random(vox.shape) * step[:, None], np.array(ref.shape[:3])[:, None] - 1)
+        ref_vals = ndimage.map_coordinates(ref_s, vox, order=1)
+        world = ref_affine @ np.vstack([vox, np.ones(vox.shape[1])])
+
+        def cost(u):
+            coords = (inv_src @ rigid_matrix(u * sc) @ world)[:3]
+            valid = np.all((coords >= 0) & (coords <= src_upper), axis=0)
+            f = ndimage.map_coordinates(src_s, coords[:, valid], order=1)
+            return -nmi(joint_histogram(ref_vals[valid], f), fwhm)
+
+        res = minimize(cost, q / sc, method="Powell", options={"xtol": 1e-2, "ftol": 1e-6})
+        q = res.x * sc
+        logger.debug("NMI coregistration at %g mm: nmi %.4f, q %s", s, -res.fun, q)
+    return q
+
+
+def _set_affine(path: str, affine: np.ndarray) -> None:
+    """
+    Replace the sform/qform of an image file, leaving its data block (and
+    so its stored values, dtype and scaling) untouched.
+    """
+    img = nib.load(path)
+    hdr = img.header
+    if not hasattr(hdr, "set_sform"):
+        # Analyze: no orientation fields to update; rewrite as before
+        save_img(nib.Nifti1Image(np.array(img.dataobj), affine, hdr), path)
+        return
+    hdr.set_sform(affine)
+    hdr.set_qform(affine)
+    block = hdr.binaryblock
+    # .nii holds the header in the image file, .hdr/.img pairs separately
+    hdr_file = img.file_map["header" if "header" in img.file_map else "image"].filename
+    if hdr_file.endswith(".gz"):
+        with Opener(hdr_file, "rb") as f:
+            content = f.read()
+        with Opener(hdr_file, "wb") as f:
+            f.write(block + content[len(block):])
+    else:
+        with open(hdr_file, "r+b") as f:
+            f.write(block)
+
+
+def coregister_files(
+    target: str,
+    source: str,
+    apply_to: Sequence[str] = (),
+    jobtype: str = "estwrite",
+    sep: Sequence[float] = COREG_SEPARATION,
+    tol: Sequence[float] = COREG_TOLERANCE,
+    fwhm=COREG_HIST_FWHM,
+    write_interp: int = 4,
+    prefix: str = "r",
+    n_jobs: Optional[int] = -1,
+) -> np.ndarray:
+    """
+    File-level native equivalent of SPM Coregister (NMI cost).
+
+    "estimate" and "estwrite" register `source` to `target` and update the
+    voxel-to-world matrix of `source` and every `apply_to` image in place;
+    "write" and "estwrite" reslice those images onto the target grid as
+    `prefix`-named files, in one pass: the target grid is mapped once per
+    distinct source geometry and all volumes of all images are resampled
+    from it in a thread pool. Voxels outside an image's field of view are
+    zero. As with SPM, all written files are on disk when it returns (the
+    derivative store is flushed). Returns the estimated 4x4 transform
+    (identity for "write").
+    """
+    if jobtype not in ("estimate", "write", "estwrite"):
+        raise ValueError(f"Unknown coregistration jobtype '{jobtype}'")
+    files = list(dict.fromkeys([source, *apply_to]))
+    tgt_img, tgt = load_img(target, dtype=np.float32)
+
+    M = np.eye(4)
+    loaded = {f: load_img(f, dtype=np.float32) for f in files}
+    if jobtype != "write":
+        src_img, src = loaded[source]
+        src = src if src.ndim == 3 else src[..., 0]
+        M = rigid_matrix(estimate_rigid_nmi(
+            tgt if tgt.ndim == 3 else tgt[..., 0], tgt_img.affine, src, src_img.affine,
+            sep=sep, tol=tol, fwhm=fwhm,
+        ))
+        # as spm_run_coreg: new matrix = M \\ old matrix; the data is not rewritten
+        flush_active_store()
+        for f in files:
+            img, data = loaded[f]
+            affine = np.linalg.inv(M) @ img.affine
+            _set_affine(f, affine)
+            loaded[f] = (nib.Nifti1Image(data, affine, img.header.copy()), data)
+        logger.info("Coregistered %s to %s: %s", source, target, np.round(rigid_params(M), 4))
+    if jobtype == "estimate":
+        flush_active_store()
+        return M
+
+    shape = tgt.shape[:3]
+    coords = {}
+    jobs = []
+    for f in files:
+        img, data = loaded[f]
+        key = (img.affine.tobytes(), data.shape[:3])
+        if key not in coords:
+            c = reslice_coords(img.affine, tgt_img.affine, shape, np.eye(4))
+            coords[key] = (c, _inside(c, data.shape).reshape(shape))
+        frames = data[..., None] if data.ndim == 3 else data
+        jobs.extend((f, i, frames[..., i], key) for i in range(frames.shape[3]))
+
+    outputs = {
+        f: np.zeros(shape + loaded[f][1].shape[3:], dtype=np.float32) for f in files
+    }
+
+    def one(job):
+        f, i, vol, key = job
+        c, inside = coords[key]
+        out = ndimage.map_coordinates(vol, c, order=write_interp, mode="nearest",
+                                      prefilter=write_interp > 1).reshape(shape)
+        out[~inside] = 0.0
+        dest = outputs[f]
+        if dest.ndim == 3:
+            dest[...] = out
+        else:
+            dest[..., i] = out
+
+    n_threads = max(1, min(resolve_n_jobs(n_jobs), len(jobs)))
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(one, jobs))
+
+    for f in files:
+        img = loaded[f][0]
+        out = outputs[f]
+        folder, name = os.path.split(f)
+        # header keeps the input data type, as SPM does; nibabel scales on write
+        save_img(nib.Nifti1Image(out, tgt_img.affine, img.header.copy()), os.path.join(folder, prefix + name))
+    # Callers (renames, existence checks) expect the files on disk, as after SPM
+    flush_active_store()
+    return M
@@ -0,0 +1,120 @@
+"""
+Native Gaussian smoothing.
+
+NumPy/SciPy replacement for SPM Smooth. The FWHM is given in mm and
+converted to voxel sigmas from the image affine; 3D volumes and every frame
+of a 4D series are smoothed in one call, in float32, with frames spread
+over a thread pool. Small kernels use separable 1D filtering
+(`scipy.ndimage`); kernels wider than `fft_radius` voxels are applied in
+the Fourier domain on a zero-padded copy. Both treat voxels outside the
+field of view as zero, as SPM does.
+
+    sigma = fwhm_to_sigma([6, 6, 6], img.affine)
+    smoothed = smooth_series(data, img.affine, [6, 6, 6])
+"""
+
+from __future__ import annotations
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
+import scipy.fft
+from nibabel.affines import voxel_sizes
+from scipy import ndimage
+
+from pyasl.utils.parallel import resolve_n_jobs
+
+logger = logging.getLogger(__name__)
+
+_FWHM2SIGMA = 1.0 / np.sqrt(8.0 * np.log(2.0))
+
+# Kernel half-width in sigmas (SPM truncates at 6)
+TRUNCATE = 6.0
+
+
+def fwhm_to_sigma(fwhm, affine: np.ndarray) -> np.ndarray:
+    """Per-axis Gaussian sigma in voxels for a FWHM in mm (scalar or 3 values)."""
+    fwhm = np.broadcast_to(np.asarray(fwhm, dtype=float), (3,))
+    return fwhm * _FWHM2SIGMA / voxel_sizes(affine)
+
+
+def _smooth_separable(vol: np.ndarray, sigma: np.ndarray) -> np.ndarray:
+    return ndimage.gaussian_filter(
+        vol, sigma, mode="constant", cval=0.0, truncate=TRUNCATE, output=np.float32
+    )
+
+
+def _smooth_fft(vol: np.ndarray, sigma: np.ndarray) -> np.ndarray:
+    # Zero padding against wrap-around: the kernel half-width, but no more
+    # than the axis length (data beyond it are zeros anyway), rounded up to
+    # a fast FFT length
+    pad = [min(int(np.ceil(TRUNCATE * s)), n) for s, n in zip(sigma, vol.shape)]
+    padded = np.pad(vol, [
+        (p, scipy.fft.next_fast_len(n + 2 * p, real=True) - n - p) for p, n in zip(pad, vol.shape)
+    ])
+    shape = padded.shape
+    F = scipy.fft.rfftn(padded)
+    # Gaussian transfer function exp(-2 pi^2 sigma^2 f^2), separable per axis
+    freqs = [scipy.fft.fftfreq(n) for n in shape[:-1]] + [scipy.fft.rfftfreq(shape[-1])]
+    for axis, (f, s) in enumerate(zip(freqs, sigma)):
+        g = np.exp(-2.0 * (np.pi * s * f) ** 2)
+        F *= g.reshape([-1 if a == axis else 1 for a in range(3)])
+    out = scipy.fft.irfftn(F, s=shape)
+    crop = tuple(slice(p, p + n) for p, n in zip(pad, vol.shape))
+    return out[crop].astype(np.float32)
+
+
+def smooth_series(
+    data: np.ndarray,
+    affine: np.ndarray,
+    fwhm,
+    n_jobs: Optional[int] = -1,
+    fft_radius: int = 256,
+) -> np.ndarray:
+    """
+    Gaussian smoothing of a 3D volume or of every frame of a 4D series.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        (X, Y, Z) or (X, Y, Z, N) array.
+    affine : np.ndarray
+        Voxel-to-world matrix, used for the voxel sizes.
+    fwhm : float or sequence of 3 floats
+        Kernel FWHM in mm.
+    n_jobs : int, optional
+        Threads across frames (None/0/-1: all cores).
+    fft_radius : int
+        Use the FFT path when the kernel half-width exceeds this many voxels
+        along any axis. Separable filtering is faster for the kernels used on
+        ASL data; the FFT cost does not grow with the kernel width.
+
+    Returns
+    -------
+    np.ndarray
+        float32 array of the same shape as `data`.
+    """
+    sigma = fwhm_to_sigma(fwhm, affine)
+    frames = data[..., None] if data.ndim == 3 else data
+    out = np.empty(frames.shape, dtype=np.float32)
+    if not np.any(sigma > 0):
+        out[...] = frames
+        return out.reshape(data.shape)
+
+    use_fft = np.max(TRUNCATE * sigma) > fft_radius
+    smooth = _smooth_fft if use_fft else _smooth_separable
+    logger.debug("Smoothing %s with sigma %s voxels (%s).", data.shape, sigma, "fft" if use_fft else "separable")
+
+    def one(i):
+        out[..., i] = smooth(np.asarray(frames[..., i], dtype=np.float32), sigma)
+
+    n_threads = max(1, min(resolve_n_jobs(n_jobs), frames.shape[3]))
+    if n_threads == 1:
+        for i in range(frames.shape[3]):
+            one(i)
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(one, range(frames.shape[3])))
+    return out.reshape(data.shape)
@@ -0,0 +1,361 @@
+"""
+Content-addressed step cache for custom pipelines.
+
+Every step gets a key built from its name, call style, resolved params,
+the content hashes of the files named in its params, and a running digest
+of everything upstream. That digest starts from the data description plus
+the raw session files, and then folds in each step's key and output
+hashes. A change anywhere upstream therefore invalidates all later steps.
+
+On a miss the step runs. The files it creates or modifies under
+``derivatives/`` and the session folders are found by comparing
+(size, mtime) snapshots taken before and after, and are stored as
+content-addressed objects. The context entries it adds or replaces, and
+its edits to the data description, are stored as well. On a hit those
+outputs are restored and the step is skipped.
+
+Layout (under ``<root>/derivatives/.pyasl_cache``)::
+
+    manifest.json        entries, last use times and a file-hash memo
+    objects/ab/abcd...   stored output files and pickled context values
+
+YAML
+----
+    cache:
+      enabled: true
+      max_size_mb: 20480      # least recently used entries are evicted
+
+Unreferenced objects are only collected once the store exceeds its budget.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIRNAME = ".pyasl_cache"
+_CHUNK = 1 << 20
+
+
+def _sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _canonical(obj: Any) -> str:
+    """Stable JSON text for params / data descriptions."""
+    return json.dumps(obj, sort_keys=True, default=str)
+
+
+class StepCache:
+    """
+    Step-level result cache rooted at ``<root>/derivatives/.pyasl_cache``.
+
+    Parameters
+    ----------
+    root : str or Path
+        Dataset root; outputs are tracked relative to it.
+    max_size_mb : float, optional
+        Size budget of the object store; None disables eviction.
+    force : bool
+        Re-run every step (results are still stored, refreshing the cache).
+    """
+
+    def __init__(self, root, max_size_mb: Optional[float] = None, force: bool = False):
+        self.root = Path(root).resolve()
+        self.dir = self.root / "derivatives" / CACHE_DIRNAME
+        self.objects = self.dir / "objects"
+        self.manifest_path = self.dir / "manifest.json"
+        self.max_bytes = None if max_size_mb is None else int(float(max_size_mb) * 2**20)
+        self.force = force
+        self._bytes: Optional[int] = None  # object store size, computed on first use
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.manifest = {"version": 1, "entries": {}, "hashes": {}}
+        if self.manifest_path.exists():
+            try:
+                with self.manifest_path.open("r") as f:
+                    self.manifest.update(json.load(f))
+            except (OSError, ValueError):
+                logger.warning("Unreadable cache manifest %s; starting empty.", self.manifest_path)
+
+    @classmethod
+    def from_config(cls, root, conf: Any, force: bool = False) -> Optional["StepCache"]:
+        """Build a cache from the YAML `cache:` value (bool or mapping)."""
+        if not conf:
+            return None
+        if conf is True:
+            conf = {}
+        if not conf.get("enabled", True):
+            return None
+        return cls(root, max_size_mb=conf.get("max_size_mb"), force=force)
+
+    # ------------------------------------------------------------------ hashing
+
+    def file_hash(self, path: Path) -> str:
+        """SHA-256 of a file, memoized on (size, mtime_ns)."""
+        st = path.stat()
+        memo = self.manifest["hashes"].get(str(path))
+        if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+            return memo[2]
+        h = hashlib.sha256()
+        with path.open("rb") as f:
+            for block in iter(lambda: f.read(_CHUNK), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        self.manifest["hashes"][str(path)] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def _known_outputs(self) -> set:
+        """Absolute paths written by cached steps (covered by the upstream digest)."""
+        return {
+            str(self.root / rel)
+            for entry in self.manifest["entries"].values()
+            for rel in entry["outputs"]
+        }
+
+    def _tree_hash(self, path: Path, skip: frozenset = frozenset()) -> str:
+        h = hashlib.sha256()
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if d != CACHE_DIRNAME)
+            for fn in sorted(filenames):
+                fp = Path(dirpath) / fn
+                if str(fp) in skip:
+                    continue
+                h.update(str(fp.relative_to(path)).encode())
+                h.update(self.file_hash(fp).encode())
+        return h.hexdigest()
+
+    def _params_files_hash(self, params: Any, skip: frozenset) -> Dict[str, str]:
+        """
+        Content hashes of existing files/dirs named in params (except `root`).
+
+        Files in `skip` are outputs of earlier cached steps; they are already
+        part of the upstream digest and may not exist yet on a first run.
+        """
+        found: Dict[str, str] = {}
+        if isinstance(params, dict):
+            for k, v in params.items():
+                if k != "root":
+                    found.update(self._params_files_hash(v, skip))
+        elif isinstance(params, (list, tuple)):
+            for v in params:
+                found.update(self._params_files_hash(v, skip))
+        elif isinstance(params, str) and os.path.isabs(params) and params not in skip:
+            p = Path(params)
+            if p.is_file():
+                found[params] = self.file_hash(p)
+            elif p.is_dir() and p.resolve() != self.root:
+                found[params] = self._tree_hash(p, skip)
+        return found
+
+    def initial_digest(self, data_desc: dict) -> str:
+        """Digest of the data description and the raw session files."""
+        h = hashlib.sha256(_canonical(data_desc).encode())
+        for session in sorted((data_desc or {}).get("Images", {})):
+            if os.path.isdir(session):
+                h.update(self._tree_hash(Path(session)).encode())
+        return h.hexdigest()
+
+    def step_key(self, name: str, style: str, params: Any, digest: str) -> str:
+        payload = {
+            "name": name,
+            "style": style,
+            "params": params,
+            "files": self._params_files_hash(params, frozenset(self._known_outputs())),
+            "upstream": digest,
+        }
+        return _sha256_bytes(_canonical(payload).encode())
+
+    # ------------------------------------------------------------------ lookup
+
+    def lookup(self, key: str) -> Optional[dict]:
+        """Return the entry for `key` if all its objects are present."""
+        if self.force:
+            return None
+        entry = self.manifest["entries"].get(key)
+        if entry is None:
+            return None
+        shas = list(entry["outputs"].values()) + ([entry["ctx"]] if entry.get("ctx") else [])
+        if not all(self._object_path(s).exists() for s in shas):
+            logger.debug("Cache entry %s is incomplete; ignoring it.", key[:12])
+            return None
+        return entry
+
+    def restore(self, key: str, entry: dict, ctx: dict, data_desc: dict) -> str:
+        """Put a cached step's outputs back in place; returns the new digest."""
+        for rel, sha in entry["outputs"].items():
+            dst = self.root / rel
+            if dst.exists() and self.file_hash(dst) == sha:
+                continue
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(self._object_path(sha), dst)
+        if entry.get("ctx"):
+            with self._object_path(entry["ctx"]).open("rb") as f:
+                delta = pickle.load(f)
+            for k in delta["removed"]:
+                ctx.pop(k, None)
+            ctx.update(delta["changed"])
+        if entry.get("data_desc") is not None:
+            data_desc.clear()
+            data_desc.update(json.loads(entry["data_desc"]))
+        entry["last_used"] = time.time()
+        self._save()
+        return entry["digest"]
+
+    # ------------------------------------------------------------------ store
+
+    def begin_step(self, ctx: dict, data_desc: dict) -> Tuple[dict, dict, str, List[Path]]:
+        """State captured before running a step (file snapshot, ctx ids, data_desc, watched dirs)."""
+        dirs = self._watch_dirs(data_desc)
+        return self._snapshot(dirs), {k: id(v) for k, v in ctx.items()}, _canonical(data_desc), dirs
+
+    def end_step(
+        self, key: str, name: str, token: Tuple[dict, dict, str, List[Path]], ctx: dict, data_desc: dict
+    ) -> str:
+        """Store the outputs of a step that just ran; returns the new digest."""
+        before, ctx_ids, desc_before, dirs = token
+        # sessions the step added to the data description are watched too
+        after = self._snapshot(dirs + [d for d in self._watch_dirs(data_desc) if d not in dirs])
+        outputs = {}
+        for rel, sig in after.items():
+            if before.get(rel) != sig:
+                sha = self.file_hash(self.root / rel)
+                self._put_file(self.root / rel, sha)
+                outputs[rel] = sha
+
+        changed = {k: v for k, v in ctx.items() if ctx_ids.get(k) != id(v)}
+        removed = [k for k in ctx_ids if k not in ctx]
+        ctx_sha = None
+        if changed or removed:
+            try:
+                blob = pickle.dumps({"changed": changed, "removed": removed}, protocol=4)
+            except Exception as e:
+                logger.info("Step %s left unpicklable context (%s); not cached.", name, e)
+                return _sha256_bytes((key + _canonical(sorted(outputs.items()))).encode())
+            ctx_sha = _sha256_bytes(blob)
+            self._put_bytes(blob, ctx_sha)
+
+        desc_after = _canonical(data_desc)
+        digest = _sha256_bytes(
+            (key + _canonical(sorted(outputs.items())) + (ctx_sha or "") + desc_after).encode()
+        )
+        self.manifest["entries"][key] = {
+            "step": name,
+            "outputs": outputs,
+            "ctx": ctx_sha,
+            "data_desc": desc_after if desc_after != desc_before else None,
+            "digest": digest,
+            "created": time.time(),
+            "last_used": time.time(),
+        }
+        logger.info("Cached step %s: %d output file(s).", name, len(outputs))
+        self.evict()
+        self._save()
+        return digest
+
+    # ------------------------------------------------------------------ eviction
+
+    def size(self) -> int:
+        """Bytes in the object store (scanned once, then kept up to date)."""
+        if self._bytes is None:
+            self._bytes = sum(p.stat().st_size for p in self.objects.rglob("*") if p.is_file())
+        return self._bytes
+
+    def evict(self) -> None:
+        """
+        Drop unreferenced objects, then least recently used entries, until
+        the store fits `max_size_mb` (nothing to do while it fits).
+        """
+        if self.max_bytes is None or self.size() <= self.max_bytes:
+            return
+        self._collect_garbage()
+        entries = self.manifest["entries"]
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if self.size() <= self.max_bytes:
+                break
+            logger.info("Evicting cached step %s (%s).", entries[key]["step"], key[:12])
+            del entries[key]
+            self._collect_garbage()
+
+    def _collect_garbage(self) -> int:
+        """Delete objects no entry refers to; returns the bytes freed."""
+        live = set()
+        for entry in self.manifest["entries"].values():
+            live.update(entry["outputs"].values())
+            if entry.get("ctx"):
+                live.add(entry["ctx"])
+        freed = 0
+        for p in self.objects.rglob("*"):
+            if p.is_file() and p.name not in live:
+                freed += p.stat().st_size
+                p.unlink()
+        if self._bytes is not None:
+            self._bytes -= freed
+        return freed
+
+    # ------------------------------------------------------------------ helpers
+
+    def _object_path(self, sha: str) -> Path:
+        return self.objects / sha[:2] / sha
+
+    def _put_file(self, src: Path, sha: str) -> None:
+        dst = self._object_path(sha)
+        if not dst.exists():
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            tmp = dst.with_suffix(".tmp")
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+            self._grow(dst)
+
+    def _put_bytes(self, blob: bytes, sha: str) -> None:
+        dst = self._object_path(sha)
+        if not dst.exists():
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            dst.write_bytes(blob)
+            self._grow(dst)
+
+    def _grow(self, obj: Path) -> None:
+        if self._bytes is not None:
+            self._bytes += obj.stat().st_size
+
+    def _watch_dirs(self, data_desc: dict) -> List[Path]:
+        """Directories steps write to: ``derivatives/`` and the session folders outside it."""
+        dirs = [self.dir.parent]
+        for session in sorted((data_desc or {}).get("Images", {})):
+            p = Path(session).resolve()
+            if p.is_dir() and not any(p == d or d in p.parents for d in dirs):
+                dirs.append(p)
+        return dirs
+
+    def _snapshot(self, dirs: List[Path]) -> Dict[str, Tuple[int, int]]:
+        """(size, mtime_ns) of every file under `dirs` (paths relative to root), cache excluded."""
+        snap = {}
+        for top in dirs:
+            for dirpath, dirnames, filenames in os.walk(top):
+                dirnames[:] = [d for d in dirnames if d not in (CACHE_DIRNAME, "__pycache__")]
+                for fn in filenames:
+                    fp = os.path.join(dirpath, fn)
+                    try:
+                        st = os.stat(fp)
+                    except OSError:
+                        continue
+                    snap[os.path.relpath(fp, self.root)] = (st.st_size, st.st_mtime_ns)
+        return snap
+
+    def _save(self) -> None:
+        # forget hashes of files that no longer exist
+        hashes = self.manifest["hashes"]
+        for path in [p for p in hashes if not os.path.exists(p)]:
+            del hashes[path]
+        tmp = self.manifest_path.with_suffix(".tmp")
+        with tmp.open("w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.manifest_path)
@@ -1,6 +1,14 @@
+import hashlib
+import logging
+import os
+
 import numpy as np
 from scipy.optimize import curve_fit
 
+from pyasl.utils.batch_fit import batch_curve_fit
+
+logger = logging.getLogger(__name__)
+
 def T1fit_function(xdata: np.ndarray, a: float, T1: float, A: float):
     return a + np.abs(A * (1 - 2 * np.exp(-xdata / T1)))
 
@@ -14,4 +22,181 @@ def T1fit(xdata: np.ndarray, ydata: np.ndarray):
             ftol=1e-4, xtol=1e-4, gtol=1e-4, bounds=param_bounds,
         )
         x0 = x_bef
-    return x0
\ No newline at end of file
+    return x0
+
+
+def T1fit_jac(params: np.ndarray, xdata: np.ndarray):
+    """
+    Batched `T1fit_function` and its Jacobian for `batch_curve_fit`.
+
+    params is (n, 3) ordered (a, T1, A), xdata (n, m); returns f (n, m) and
+    J (n, m, 3).
+    """
+    a, T1, A = params[:, 0:1], params[:, 1:2], params[:, 2:3]
+    e = np.exp(-xdata / T1)
+    g = 1 - 2 * e
+    u = A * g
+    s = np.where(u < 0, -1.0, 1.0)
+    f = a + np.abs(u)
+    J = np.empty(f.shape + (3,))
+    J[..., 0] = 1.0
+    J[..., 1] = -2.0 * s * A * e * xdata / T1**2
+    J[..., 2] = s * g
+    return f, J
+
+
+def T1_lookup(xdata: np.ndarray, grid: np.ndarray = None):
+    """
+    Precompute the grid-search table used to initialise `T1fit_batch`.
+
+    For a fixed T1 the model is linear in (a, |A|): y = a + |A| * |1 - 2 exp(-TI/T1)|.
+    Returns the T1 grid (G,), the basis curves (G, m) and the pseudo-inverses
+    (G, 2, m) of the [1, basis] design matrices. The default grid spans
+    1% to 10x the longest TI on a log scale.
+    """
+    x = np.asarray(xdata, dtype=float)
+    if grid is None:
+        grid = np.geomspace(0.01 * x.max(), 10.0 * x.max(), 160)
+    grid = np.asarray(grid, dtype=float)
+    basis = np.abs(1 - 2 * np.exp(-x[None, :] / grid[:, None]))
+    design = np.stack([np.ones_like(basis), basis], axis=2)  # (G, m, 2)
+    return grid, basis, np.linalg.pinv(design)
+
+
+def T1_grid_init(xdata: np.ndarray, ydata: np.ndarray, lookup=None):
+    """Best (a, T1, A) per voxel over the lookup grid, as an (n, 3) array."""
+    grid, basis, pinv = lookup if lookup is not None else T1_lookup(xdata)
+    y = np.asarray(ydata, dtype=float)
+    n = y.shape[0]
+    y_mean = y.mean(axis=1)
+
+    best_cost = np.full(n, np.inf)
+    p0 = np.zeros((n, 3))
+    for T1, g, P in zip(grid, basis, pinv):
+        a, A = y @ P[0], y @ P[1]
+        # |A| cannot be negative: fall back to a constant curve
+        neg = A < 0
+        a[neg], A[neg] = y_mean[neg], 0.0
+        r = y - a[:, None] - A[:, None] * g
+        cost = np.einsum("nm,nm->n", r, r)
+        better = cost < best_cost
+        best_cost[better] = cost[better]
+        p0[better] = np.column_stack([a[better], np.full(better.sum(), T1), A[better]])
+    return p0
+
+
+def T1fit_batch(xdata: np.ndarray, ydata: np.ndarray, lookup=None, max_iter: int = 100):
+    """
+    Fit `T1fit_function` to every row of `ydata` (n, m) in one batched solve.
+
+    Starting values come from `T1_grid_init`; all voxels are then refined
+    together by `batch_curve_fit` with the analytic Jacobian `T1fit_jac`,
+    with the same bounds as `T1fit` (T1 > 0). Returns (n, 3) parameters
+    ordered (a, T1, A) like `T1fit`, with A >= 0.
+    """
+    y = np.asarray(ydata, dtype=float)
+    p0 = T1_grid_init(xdata, y, lookup)
+    params, _ = batch_curve_fit(
+        T1fit_jac, xdata, y, p0,
+        bounds=([-np.inf, 1e-9, -np.inf], [np.inf, np.inf, np.inf]),
+        max_iter=max_iter, xtol=1e-6, ftol=1e-9,
+    )
+    params[:, 2] = np.abs(params[:, 2])
+    return params
+
+
+def _t1_dictionary_dir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pyasl", "t1_dictionary")
+
+
+def T1_dictionary(xdata: np.ndarray, n_atoms: int = 1000, t1_range=None, cache_dir=None):
+    """
+    Dictionary of inversion-recovery curves for one TI list.
+
+    Atoms are the curves |1 - 2 exp(-TI/T1)| for `n_atoms` log-spaced T1
+    values (default range: 1% to 10x the longest TI), de-meaned and scaled
+    to unit norm, so that the best match for a voxel is the atom with the
+    largest dot product with its de-meaned curve. The dictionary is stored
+    as an .npz in `cache_dir` (default: $XDG_CACHE_HOME/pyasl/t1_dictionary)
+    keyed by a hash of the TI list and grid, and loaded from there next time;
+    pass cache_dir=False to disable the disk cache.
+
+    Returns a dict with "T1" (G,), "atoms" (G, m), "mean" (G,) and "norm" (G,)
+    (mean and norm of the basis curves before normalisation).
+    """
+    x = np.asarray(xdata, dtype=float)
+    if t1_range is None:
+        t1_range = (0.01 * x.max(), 10.0 * x.max())
+    lo, hi = float(t1_range[0]), float(t1_range[1])
+
+    path = None
+    if cache_dir is not False:
+        h = hashlib.sha1(x.tobytes())
+        h.update(np.array([n_atoms, lo, hi], dtype=float).tobytes())
+        path = os.path.join(cache_dir or _t1_dictionary_dir(), f"{h.hexdigest()}.npz")
+        try:
+            with np.load(path) as z:
+                return {k: z[k] for k in ("T1", "atoms", "mean", "norm")}
+        except (OSError, KeyError, ValueError):
+            pass
+
+    grid = np.geomspace(lo, hi, int(n_atoms))
+    basis = np.abs(1 - 2 * np.exp(-x[None, :] / grid[:, None]))
+    mean = basis.mean(axis=1)
+    centred = basis - mean[:, None]
+    norm = np.linalg.norm(centred, axis=1)
+    # T1 so short (or long) that the curve is flat cannot be told apart
+    keep = norm > 1e-6 * norm.max()
+    dictionary = {
+        "T1": grid[keep],
+        "atoms": centred[keep] / norm[keep, None],
+        "mean": mean[keep],
+        "norm": norm[keep],
+    }
+
+    if path is not None:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp, **dictionary)
+            os.replace(tmp, path)
+        except OSError as err:
+            logger.debug("Could not cache T1 dictionary at %s: %s", path, err)
+    return dictionary
+
+
+def T1fit_dictionary(xdata: np.ndarray, ydata: np.ndarray, dictionary=None,
+                     refine_iter: int = 0, chunk_size: int = 8192):
+    """
+    Estimate (a, T1, A) per row of `ydata` (n, m) by dictionary matching.
+
+    The de-meaned voxel curves are matched against all atoms with one matrix
+    product per chunk of `chunk_size` voxels; a and A follow in closed form
+    from the best atom. This is the exact least-squares solution on the
+    dictionary's T1 grid. With `refine_iter` > 0 the estimates are polished
+    with that many batched Gauss-Newton (Levenberg-Marquardt) iterations of
+    the full model. Returns (n, 3) parameters ordered like `T1fit`.
+    """
+    d = dictionary if dictionary is not None else T1_dictionary(xdata)
+    y = np.asarray(ydata, dtype=float)
+    n = y.shape[0]
+    params = np.zeros((n, 3))
+    for start in range(0, n, chunk_size):
+        yc = y[start:start + chunk_size]
+        y_mean = yc.mean(axis=1)
+        corr = (yc - y_mean[:, None]) @ d["atoms"].T  # (chunk, G)
+        best = np.argmax(corr, axis=1)
+        A = np.maximum(corr[np.arange(len(yc)), best], 0.0) / d["norm"][best]
+        params[start:start + chunk_size] = np.column_stack(
+            [y_mean - A * d["mean"][best], d["T1"][best], A]
+        )
+
+    if refine_iter > 0:
+        params, _ = batch_curve_fit(
+            T1fit_jac, xdata, y, params,
+            bounds=([-np.inf, 1e-9, -np.inf], [np.inf, np.inf, np.inf]),
+            max_iter=int(refine_iter), xtol=1e-6, ftol=1e-9,
+        )
+        params[:, 2] = np.abs(params[:, 2])
+    return params
@@ -1,8 +1,16 @@
 import os
 import json
+import logging
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import nibabel as nib
 
+from pyasl.utils.derivative_store import active_store
+
+logger = logging.getLogger(__name__)
+
 
 def read_data_description(root: str):
     description_file = os.path.join(root, "data_description.json")
@@ -18,9 +26,122 @@ def read_data_description(root: str):
     return data_descrip
 
 
-def load_img(P: str):
+class _ImageCache:
+    """LRU cache of decoded images keyed on (path, mtime, size, dtype)."""
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (path, dtype) -> (signature, img, data)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, sig):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != sig:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key, sig, img, data):
+        if data.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2].nbytes
+            self.entries[key] = (sig, img, data)
+            self.nbytes += data.nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+_IMAGE_CACHE = _ImageCache(int(float(os.environ.get("PYASL_IMAGE_CACHE_MB", 0)) * 2**20))
+
+
+def set_image_cache(max_mb: float):
+    """Set the `load_img` cache budget in MB (0 disables and empties the cache)."""
+    _IMAGE_CACHE.max_bytes = int(float(max_mb) * 2**20)
+    if _IMAGE_CACHE.max_bytes <= 0:
+        _IMAGE_CACHE.clear()
+
+
+def image_cache_stats():
+    """Hit/miss counters and current size of the `load_img` cache."""
+    c = _IMAGE_CACHE
+    return {
+        "hits": c.hits,
+        "misses": c.misses,
+        "entries": len(c.entries),
+        "bytes": c.nbytes,
+        "max_bytes": c.max_bytes,
+    }
+
+
+def log_image_cache_stats():
+    """Log the cache counters (if the cache is enabled)."""
+    if _IMAGE_CACHE.max_bytes > 0:
+        stats = image_cache_stats()
+        # Counters include session workers; entries are this process's only
+        if stats["entries"]:
+            logger.info(
+                "Image cache: %d hits, %d misses, %d entries (%.1f MB).",
+                stats["hits"], stats["misses"], stats["entries"], stats["bytes"] / 2**20,
+            )
+        else:
+            logger.info("Image cache: %d hits, %d misses.", stats["hits"], stats["misses"])
+
+
+def load_img(P: str, dtype=np.float64):
+    """
+    Load a NIfTI/Analyze image as (nibabel image, NaN-free data array).
+
+    With the image cache enabled (`set_image_cache` or the
+    PYASL_IMAGE_CACHE_MB environment variable) repeated loads of an unchanged
+    file return the same read-only array; copy it before modifying.
+    """
+    dtype = np.dtype(dtype)
+    store = active_store()
+    if store is not None:
+        cached = store.get(P)
+        if cached is not None:
+            V, data = cached
+            return V, data if data.dtype == dtype else data.astype(dtype)
+
+    if _IMAGE_CACHE.max_bytes > 0:
+        st = os.stat(P)
+        key = (os.path.abspath(P), dtype.str)
+        sig = (st.st_mtime_ns, st.st_size)
+        cached = _IMAGE_CACHE.get(key, sig)
+        if cached is not None:
+            return cached
+
     V = nib.load(P)
-    data = V.get_fdata()
-    data = np.nan_to_num(data)
+    # "unchanged": the image object keeps no second copy of the data
+    data = V.get_fdata(caching="unchanged", dtype=dtype)
+    np.nan_to_num(data, copy=False)
+
+    if _IMAGE_CACHE.max_bytes > 0:
+        data.flags.writeable = False
+        _IMAGE_CACHE.put(key, sig, V, data)
 
     return V, data
+
+
+def save_img(img, P: str):
+    """Write `img` to `P`, through the active derivative store if there is one."""
+    store = active_store()
+    if store is not None and isinstance(img, nib.Nifti1Image) and str(P).endswith(".nii"):
+        store.put(img, P)
+    else:
+        img.to_filename(P)